@@ -0,0 +1,89 @@
+from dataclasses import dataclass, field
+from typing import Literal
+import time
+
+
+ALERT_CLEAR_Z = 1.5  # |Z-score| below which a firing alert counts as clear (hysteresis)
+ALERT_RESOLVE_CHECKS = 3  # Consecutive clear checks before an alert resolves
+ALERT_COOLDOWN_S = 5 * 60  # A new anomaly within this time after resolving reopens the same alert
+ALERT_DIGEST_INTERVAL_S = 10 * 60  # Re-render a firing alert's plot at most this often
+
+AlertState = Literal['normal', 'firing', 'resolved']
+# fire: send a new alert, reopen/digest/resolve: re-render the alert message,
+# update: only edit its caption
+AlertAction = Literal['fire', 'reopen', 'update', 'digest', 'resolve']
+
+
+@dataclass
+class Alert:
+    state: AlertState = 'normal'
+    message_ids: dict[int, int] = field(default_factory=dict)  # Chat -> alert message
+    text: str = ""
+    range_caption: str = ""
+    fired_at: float = 0.0
+    rendered_at: float = 0.0
+    resolved_at: float = 0.0
+    clear_checks: int = 0
+
+
+class AlertManager:
+    def __init__(
+        self,
+        clear_z: float = ALERT_CLEAR_Z,
+        resolve_checks: int = ALERT_RESOLVE_CHECKS,
+        cooldown_s: float = ALERT_COOLDOWN_S,
+        digest_interval_s: float = ALERT_DIGEST_INTERVAL_S
+    ) -> None:
+        self.clear_z = clear_z
+        self.resolve_checks = resolve_checks
+        self.cooldown_s = cooldown_s
+        self.digest_interval_s = digest_interval_s
+        self.alerts: dict[str, Alert] = {}
+
+    # Advance the alert of `metric` with this check's anomaly descriptions and the
+    # largest |Z-score| among its columns, return what to do with the alert message
+    def update(
+        self,
+        metric: str,
+        anomalies: list[str],
+        max_abs_z: float,
+        now: float | None = None
+    ) -> AlertAction | None:
+        alert = self.alerts.setdefault(metric, Alert())
+        now = time.monotonic() if now is None else now
+
+        if anomalies:
+            alert.text = "\n".join(anomalies)
+
+        # Past the cooldown a resolved alert is over, whether or not this check
+        # is the one that notices, so a later anomaly fires a new alert
+        if alert.state == 'resolved' and now - alert.resolved_at >= self.cooldown_s:
+            alert.state = 'normal'
+            alert.message_ids = {}
+
+        if alert.state != 'firing':
+            if not anomalies:
+                return None
+
+            reopen = alert.state == 'resolved' and bool(alert.message_ids)
+            alert.state = 'firing'
+            alert.fired_at = alert.fired_at if reopen else now
+            alert.rendered_at = now
+            alert.clear_checks = 0
+            return 'reopen' if reopen else 'fire'
+
+        if anomalies or max_abs_z >= self.clear_z:
+            alert.clear_checks = 0
+            if now - alert.rendered_at >= self.digest_interval_s:
+                alert.rendered_at = now
+                return 'digest'
+            return 'update' if anomalies else None
+
+        alert.clear_checks += 1
+        if alert.clear_checks < self.resolve_checks:
+            return None
+
+        alert.state = 'resolved'
+        alert.resolved_at = now
+        alert.rendered_at = now
+        return 'resolve'
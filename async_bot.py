@@ -0,0 +1,304 @@
+from __future__ import annotations
+
+# Asyncio engine: same menus, plots and alerts as bot.py, but every update is
+# handled in its own task and the blocking Hetzner fetches, analysis and text
+# building run in a thread pool, so a slow 30d plot does not hold up other
+# button presses. Run with `python async_bot.py` instead of `python bot.py`.
+
+import time
+STARTED_AT = time.perf_counter()
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
+from datetime import datetime
+from functools import partial, wraps
+from typing import Callable, TypeVar
+import asyncio
+
+from telebot import types, asyncio_helper
+from telebot.async_telebot import AsyncTeleBot
+from telebot.asyncio_helper import ApiTelegramException
+
+from bot import config, chat_id, logger, renderer, get_plot, RENDER_BUSY_TEXT, remember_file_id, send_alert, \
+                lookback_from_callback, start_export, memory_command, enforce_memory_budget, check_alerts, pace_monitor, is_allowed, subscribers, outbox, \
+                menu_markup, menu_cmd, cpu_cmd, disk_cmd, network_cmd, server_cmd, \
+                cpu_plot_cmd, disk_plot_cmd, network_plot_cmd, \
+                cpu_stats_menu_markup, disk_stats_menu_markup, network_stats_menu_markup, \
+                stats_update_markup, plot_markup, servers_markup, split_callback, selected_servers, \
+                selected_server, server_title, escape_markdown, monitor_pacer, MONITOR_COLUMNS, SERVERS_PER_PAGE, OUTBOX_FLUSH_S
+from get_stats import server_names, MAX_METRICS_VALUES
+from render import RenderQueueFull
+from get_text import get_cpu_stats_text, get_disk_stats_text, get_network_stats_text
+from detector import StreamingDetector
+from fleet import poll_fleet, new_detector, fleet_executor, stop_building, baseline_builds
+import perf
+
+T = TypeVar('T')
+
+BLOCKING_WORKERS = 8  # Threads for fetches and plots, i.e. interactive requests in flight
+
+executor = ThreadPoolExecutor(BLOCKING_WORKERS, thread_name_prefix="blocking")
+
+if config.get("TELEGRAM_API_URL"):
+    asyncio_helper.API_URL = config["TELEGRAM_API_URL"]
+
+bot = AsyncTeleBot(
+    token=config["TELEGRAM_TOKEN"],
+    parse_mode="Markdown"
+)
+
+STATS = {  # Metric -> (text builder, menu label, menu markup)
+    'cpu': (get_cpu_stats_text, "Cpu menu", cpu_stats_menu_markup),
+    'disk': (get_disk_stats_text, "Disk menu", disk_stats_menu_markup),
+    'network': (get_network_stats_text, "Network menu", network_stats_menu_markup),
+}
+
+STATS_COMMANDS = {cpu_cmd: 'cpu', disk_cmd: 'disk', network_cmd: 'network'}
+PLOT_COMMANDS = {cpu_plot_cmd: 'cpu', disk_plot_cmd: 'disk', network_plot_cmd: 'network'}
+
+async def run_blocking(fn: Callable[..., T], *args) -> T:
+    return await asyncio.get_running_loop().run_in_executor(executor, partial(fn, *args))
+
+# Plot handlers answer a full render queue instead of failing without a reply:
+# more blocking threads than render slots can ask for plots at once
+def reply_when_busy(fn: Callable) -> Callable:
+    @wraps(fn)
+    async def wrapper(update: types.Message | types.CallbackQuery):
+        try:
+            return await fn(update)
+        except RenderQueueFull:
+            if isinstance(update, types.CallbackQuery):
+                await bot.answer_callback_query(update.id, RENDER_BUSY_TEXT)
+            else:
+                await bot.send_message(update.chat.id, RENDER_BUSY_TEXT)
+    return wrapper
+
+@bot.message_handler(commands=["start"])
+@perf.timed('handler.welcome_user')
+async def welcome_user(message: types.Message):
+    if is_allowed(message.chat.id):
+        await bot.send_message(message.chat.id, f"Hello, {message.from_user.full_name}!", reply_markup=menu_markup)
+
+# Admin only: stage latencies and counters since startup
+@bot.message_handler(commands=["perf"])
+async def perf_report(message: types.Message):
+    if message.chat.id == chat_id:
+        await bot.send_message(chat_id, perf.report())
+
+# Admin only: RSS, cache sizes and tracemalloc snapshots
+@bot.message_handler(commands=["memory"])
+async def memory_report(message: types.Message):
+    if message.chat.id == chat_id:
+        await bot.send_message(chat_id, await run_blocking(memory_command, message.text))
+
+@bot.message_handler(commands=["subscribe"])
+@perf.timed('handler.subscribe')
+async def subscribe(message: types.Message):
+    if is_allowed(message.chat.id):
+        await run_blocking(subscribers.subscribe, message.chat.id)
+        await bot.send_message(message.chat.id, "Alerts will be sent to this chat, /unsubscribe to stop them.")
+
+@bot.message_handler(commands=["unsubscribe"])
+@perf.timed('handler.unsubscribe')
+async def unsubscribe(message: types.Message):
+    if is_allowed(message.chat.id):
+        await run_blocking(subscribers.unsubscribe, message.chat.id)
+        await bot.send_message(message.chat.id, "Alerts will no longer be sent to this chat, /subscribe to get them again.")
+
+@bot.message_handler(commands=["export"])
+@perf.timed('handler.export')
+async def export(message: types.Message):
+    if is_allowed(message.chat.id):
+        server = await run_blocking(selected_server, message.from_user.id)
+        reply = await run_blocking(start_export, message.chat.id, message.text, server)
+        await bot.send_message(message.chat.id, reply)
+
+# Fleet mode: pick the server the menus show
+@bot.message_handler(commands=["servers"])
+@bot.message_handler(func=lambda message: message.text == server_cmd)
+@perf.timed('handler.servers')
+async def servers(message: types.Message):
+    if is_allowed(message.chat.id):
+        server = await run_blocking(selected_server, message.from_user.id)
+        page = server_names().index(server) // SERVERS_PER_PAGE
+        await bot.send_message(message.chat.id, f"*Server:* {escape_markdown(server)}", reply_markup=servers_markup(page))
+
+@bot.callback_query_handler(func=lambda call: isinstance(call.data, str) and call.data.startswith('servers_'))
+@perf.timed('handler.servers_page')
+async def servers_page(call: types.CallbackQuery):
+    if is_allowed(call.message.chat.id):
+        page = int(call.data.split('_')[-1])
+        await bot.edit_message_reply_markup(call.message.chat.id, call.message.id, reply_markup=servers_markup(page))
+
+@bot.callback_query_handler(func=lambda call: isinstance(call.data, str) and call.data.startswith('server_'))
+@perf.timed('handler.select_server')
+async def select_server(call: types.CallbackQuery):
+    if is_allowed(call.message.chat.id):
+        server = server_names()[int(call.data.split('_')[-1])]
+        selected_servers[call.from_user.id] = server
+        await bot.edit_message_text(f"*Server:* {escape_markdown(server)}", call.message.chat.id, call.message.id)
+
+@bot.message_handler(func=lambda message: message.text == menu_cmd)
+@perf.timed('handler.main_menu')
+async def main_menu(message: types.Message):
+    if is_allowed(message.chat.id):
+        await bot.send_message(message.chat.id, "Main menu:", reply_markup=menu_markup)
+
+@bot.message_handler(func=lambda message: message.text in STATS_COMMANDS)
+@perf.timed('handler.command_stats')
+async def command_stats(message: types.Message):
+    if is_allowed(message.chat.id):
+        metric = STATS_COMMANDS[message.text]
+        get_text, menu_text, menu_stats_markup = STATS[metric]
+        await bot.send_chat_action(message.chat.id, action="typing")
+        server = await run_blocking(selected_server, message.from_user.id)
+
+        text = server_title(server) + await run_blocking(get_text, None, server)
+
+        await bot.send_message(message.chat.id, text=text, reply_markup=stats_update_markup(metric, server))
+        await bot.send_message(message.chat.id, text=menu_text, reply_markup=menu_stats_markup)
+
+@bot.callback_query_handler(func=lambda call: isinstance(call.data, str) and call.data.partition('@')[0] in ("cpu_stats_update", "disk_stats_update", "network_stats_update"))
+@perf.timed('handler.stats_update')
+async def stats_update(call: types.CallbackQuery):
+    if is_allowed(call.message.chat.id):
+        data, server = await run_blocking(split_callback, call.data)
+        metric = data.split('_')[0]
+        get_text, _, _ = STATS[metric]
+
+        text = server_title(server) + await run_blocking(get_text, None, server)
+
+        await bot.edit_message_text(text, call.message.chat.id, call.message.id, reply_markup=stats_update_markup(metric, server))
+
+@bot.message_handler(func=lambda message: message.text in PLOT_COMMANDS)
+@perf.timed('handler.plot')
+@reply_when_busy
+async def plot(message: types.Message):
+    if is_allowed(message.chat.id):
+        metric = PLOT_COMMANDS[message.text]
+        await bot.send_chat_action(message.chat.id, "upload_photo")
+        lookback_period_s = 30 * 60 # 30 minutes default
+        server = await run_blocking(selected_server, message.from_user.id)
+
+        photo, caption, key = await run_blocking(get_plot, metric, lookback_period_s, None, None, server)
+        with perf.span('upload'):
+            sent = await bot.send_photo(
+                chat_id=message.chat.id,
+                photo=photo,
+                caption=server_title(server) + caption,
+                reply_markup=plot_markup(metric, server)
+            )
+        remember_file_id(key, sent)
+
+@bot.callback_query_handler(func=lambda call: isinstance(call.data, str) and call.data.split('_')[0] in ('cpuplot', 'diskplot', 'networkplot'))
+@perf.timed('handler.plot_update')
+@reply_when_busy
+async def plot_update(call: types.CallbackQuery):
+    if is_allowed(call.message.chat.id):
+        metric = call.data.split('_')[0].removesuffix('plot')
+        await bot.send_chat_action(call.message.chat.id, "upload_photo")
+
+        _, server = await run_blocking(split_callback, call.data)
+        lookback_period_s = lookback_from_callback(call.data)
+
+        photo, caption, key = await run_blocking(get_plot, metric, lookback_period_s, None, None, server)
+        try:
+            with perf.span('upload'):
+                sent = await bot.edit_message_media(
+                    media=types.InputMediaPhoto(
+                        media=photo,
+                        caption=server_title(server) + caption,
+                        parse_mode="Markdown"
+                    ),
+                    chat_id=call.message.chat.id,
+                    message_id=call.message.id,
+                    reply_markup=plot_markup(metric, server)
+                )
+        except ApiTelegramException as e:
+            # Same cached plot pressed twice, nothing to update
+            if "message is not modified" in e.description:
+                return
+            raise
+
+        remember_file_id(key, sent)
+
+async def monitor():
+    detectors: dict[str, StreamingDetector] = {}
+    step = monitor_pacer.step
+
+    while True:
+        end = datetime.now().astimezone()
+
+        # Windows at another step are not comparable, restart from the new one
+        if monitor_pacer.step != step:
+            step = monitor_pacer.step
+            for detector in detectors.values():
+                detector.reset()
+
+        try:
+            for server in await run_blocking(server_names):
+                if server not in detectors:
+                    detectors[server] = new_detector(server, MONITOR_COLUMNS)
+        except Exception as e:
+            logger.error(e)
+            await asyncio.sleep(monitor_pacer.next_delay())
+            continue
+
+        monitor_pacer.record_call(calls=len(detectors))
+        latest_points = []
+
+        for server, result in (await run_blocking(poll_fleet, detectors, end, step)).items():
+            if isinstance(result, Exception):
+                logger.error(f"{server}: {result}")
+                detectors[server].reset()
+                continue
+
+            # Nothing to check without a new data point
+            load, latest_point = result
+            if latest_point is None:
+                continue
+            latest_points.append(latest_point)
+
+            for metric, action in check_alerts(latest_point, server):
+                try:
+                    with perf.span('monitor.alert'):
+                        await run_blocking(send_alert, server, metric, action, step * MAX_METRICS_VALUES, end, load)
+                except Exception as e:
+                    logger.error(e)
+
+        if latest_points:
+            pace_monitor(latest_points)
+        await run_blocking(enforce_memory_budget)
+        await asyncio.sleep(monitor_pacer.next_delay())
+
+async def main():
+    outbox.start()
+    monitor_task = asyncio.create_task(monitor(), name="monitor")
+
+    try:
+        await bot.infinity_polling()
+    finally:
+        monitor_task.cancel()
+        with suppress(asyncio.CancelledError):
+            await monitor_task
+        logger.info("monitor closed!")
+
+        await bot.close_session()
+        executor.shutdown(wait=False, cancel_futures=True)
+        fleet_executor.shutdown(wait=False, cancel_futures=True)
+        stop_building.set()
+        baseline_builds.shutdown(wait=False, cancel_futures=True)
+        renderer.shutdown()
+        await asyncio.to_thread(outbox.stop, OUTBOX_FLUSH_S)
+
+if __name__ == "__main__":
+    logger.info(f"Started in {(time.perf_counter() - STARTED_AT) * 1000:.0f} ms")
+
+    # Optional Prometheus endpoint, bound to localhost only
+    if config.get("PERF_PORT"):
+        perf.serve_metrics(int(config["PERF_PORT"]))
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        logger.info("Exiting program...")
@@ -0,0 +1,185 @@
+from __future__ import annotations
+
+from datetime import datetime, timedelta
+from pathlib import Path
+from threading import Lock
+from typing import Callable, TYPE_CHECKING
+import time
+
+import numpy as np
+
+from scheduler import TokenBucket
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+
+WEEK_S = 7 * 24 * 60 * 60
+BASELINE_BUCKET_S = 60 * 60  # One bucket per hour of the week
+BASELINE_WEEKS = 4  # History the baseline is built from, and remembers afterwards
+BASELINE_STEP_S = 60  # Resolution of that history
+BASELINE_MIN_S = 30 * 60  # Data a bucket needs (in seconds covered) before it scores points
+BASELINE_MAX_POINT_S = 10 * 60  # Seconds a single live point can stand for, after a gap
+BASELINE_SAVE_INTERVAL_S = 60 * 60
+BASELINE_REQUESTS_PER_HOUR = 600  # API requests the builds of all servers together may make, about 41 per server
+
+# Shared by every build, which then take turns with the monitor's fetches
+# rather than the whole background budget, however many servers there are
+build_limit = TokenBucket(BASELINE_REQUESTS_PER_HOUR)
+
+
+# Local wall clock seconds of tz-aware datetimes, so that buckets follow the
+# server's daily schedule across DST changes
+def wall_seconds(datetimes: pd.Series) -> np.ndarray:
+    import pandas as pd
+
+    return ((datetimes.dt.tz_localize(None) - pd.Timestamp(0)) // pd.Timedelta(seconds=1)).to_numpy()
+
+
+# Mean and standard deviation of every column per hour of the week (or any
+# bucket dividing a week), kept as exponentially decaying sums weighted by the
+# seconds each point covers. Points are added in vectorized batches and
+# scored with a single bucket lookup.
+class SeasonalBaseline:
+    def __init__(
+        self,
+        columns: list[str],
+        bucket_s: int = BASELINE_BUCKET_S,
+        weeks: float = BASELINE_WEEKS,
+        min_s: float = BASELINE_MIN_S,
+        path: Path | None = None
+    ) -> None:
+        if WEEK_S % bucket_s:
+            raise ValueError("Baseline buckets must divide a week")
+
+        self.columns = columns
+        self.bucket_s = bucket_s
+        self.n_buckets = WEEK_S // bucket_s
+        # A bucket gets bucket_s seconds of data a week, older weeks fade out
+        self.memory_s = weeks * bucket_s
+        self.min_s = min_s
+        self.path = path
+        self.ready = False  # Built from history, or loaded
+        self.until: float | None = None  # Timestamp of the newest point added
+
+        shape = (self.n_buckets, len(columns))
+        self._weight = np.zeros(shape)
+        self._sum = np.zeros(shape)
+        self._sum_sq = np.zeros(shape)
+        self._saved_at = time.monotonic()
+        self._lock = Lock()
+
+    def bucket(self, wall_s: np.ndarray | float) -> np.ndarray | int:
+        return (np.asarray(wall_s, dtype=np.int64) // self.bucket_s) % self.n_buckets
+
+    # Add rows of `values` (one column per baseline column) at `wall_s`, each
+    # covering `duration_s` seconds (one for all rows or one per row)
+    def add(self, wall_s: np.ndarray, values: np.ndarray, duration_s: np.ndarray | float) -> None:
+        values = np.asarray(values, dtype=float)
+        buckets = self.bucket(wall_s)
+        valid = ~np.isnan(values)
+        x = np.where(valid, values, 0.0)
+        duration_s = np.reshape(duration_s, (-1, 1))
+
+        weight = np.zeros_like(self._weight)
+        total = np.zeros_like(self._sum)
+        total_sq = np.zeros_like(self._sum_sq)
+        np.add.at(weight, buckets, valid * duration_s)
+        np.add.at(total, buckets, x * duration_s)
+        np.add.at(total_sq, buckets, x * x * duration_s)
+
+        decay = np.exp(-weight / self.memory_s)
+        with self._lock:
+            self._weight = self._weight * decay + weight
+            self._sum = self._sum * decay + total
+            self._sum_sq = self._sum_sq * decay + total_sq
+
+    # Mean and standard deviation of the bucket of `wall_s`, NaN for columns
+    # whose bucket has too little data
+    def stats(self, wall_s: float) -> tuple[np.ndarray, np.ndarray]:
+        b = self.bucket(wall_s)
+        with self._lock:
+            weight, total, total_sq = self._weight[b], self._sum[b], self._sum_sq[b]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = total / weight
+            std = np.sqrt(np.maximum(total_sq / weight - mean * mean, 0.0))
+
+        ready = weight >= self.min_s
+        return np.where(ready, mean, np.nan), np.where(ready, std, np.nan)
+
+    def score(self, wall_s: float, values: np.ndarray) -> np.ndarray:
+        mean, std = self.stats(wall_s)
+        diff = np.asarray(values, dtype=float) - mean
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(
+                std > 0, diff / std,
+                np.where((diff == 0) | np.isnan(diff), np.nan, np.copysign(np.inf, diff))
+            )
+
+    def save(self) -> None:
+        if self.path is None:
+            return
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        with self._lock, tmp.open('wb') as f:
+            np.savez(
+                f, columns=np.array(self.columns), bucket_s=self.bucket_s,
+                weight=self._weight, sum=self._sum, sum_sq=self._sum_sq,
+                until=np.nan if self.until is None else self.until
+            )
+        tmp.replace(self.path)
+        self._saved_at = time.monotonic()
+
+    # Save at most every BASELINE_SAVE_INTERVAL_S, from the monitor loop
+    def autosave(self) -> None:
+        if self.ready and time.monotonic() - self._saved_at >= BASELINE_SAVE_INTERVAL_S:
+            self.save()
+
+    # Load a saved baseline with the same columns and buckets, if any
+    def load(self) -> bool:
+        if self.path is None or not self.path.exists():
+            return False
+
+        try:
+            with np.load(self.path) as data:
+                if list(data['columns']) != self.columns or int(data['bucket_s']) != self.bucket_s:
+                    return False
+                with self._lock:
+                    self._weight, self._sum, self._sum_sq = data['weight'], data['sum'], data['sum_sq']
+                until = float(data['until']) if 'until' in data.files else np.nan
+                self.until = None if np.isnan(until) else until
+        except (OSError, ValueError, KeyError):
+            # Unreadable, it is rebuilt
+            return False
+
+        self.ready = True
+        return True
+
+
+# Build `baseline` from the last BASELINE_WEEKS weeks of `server` at
+# BASELINE_STEP_S, fetched and added chunk by chunk like an export within
+# build_limit. Gives up, leaving it not ready, once `stopped` returns True.
+def build_baseline(
+    baseline: SeasonalBaseline,
+    server: str,
+    end: datetime | None = None,
+    stopped: Callable[[], bool] = lambda: False
+) -> None:
+    from export import fetch_chunks
+    from get_stats import ALL_METRICS
+
+    end = end or datetime.now().astimezone()
+    start = end - timedelta(seconds=BASELINE_WEEKS * WEEK_S)
+    for df in fetch_chunks(ALL_METRICS, start, end, BASELINE_STEP_S, server, build_limit):
+        if stopped():
+            return
+        if not df.empty:
+            values = df.reindex(columns=baseline.columns).to_numpy(dtype=float)
+            baseline.add(wall_seconds(df['datetime']), values, BASELINE_STEP_S)
+
+    # Live points up to `end` are in the history already
+    baseline.until = end.timestamp()
+    baseline.ready = True
+    baseline.save()
@@ -0,0 +1,688 @@
+from datetime import datetime, timedelta
+from functools import reduce
+from io import BytesIO
+from pathlib import Path
+from timeit import repeat
+from types import SimpleNamespace
+from typing import Callable
+import argparse, json, statistics, subprocess, sys, os, tempfile, time, tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from get_stats import time_series_to_frame, analyze, save_cpu_plot, save_disk_plot, \
+                      save_network_plot, MAX_METRICS_VALUES
+from detector import StreamingDetector
+from store import MetricsStore
+from sketch import DDSketch
+import get_stats, get_text
+
+# Benchmarks never read or write the bot's own history, nor resolve its servers
+get_stats.METRICS_DB = Path(tempfile.mkdtemp()) / "metrics.db"
+get_stats.SERVER_NAMES = ["bench"]
+
+
+def make_time_series(n_points: int, n_series: int, step: int = 60) -> dict:
+    rng = np.random.default_rng(0)
+    timestamps = 1_700_000_000 + np.arange(n_points) * step
+    return {
+        f"network.{i // 4}.{('pps', 'bandwidth')[i // 2 % 2]}.{('in', 'out')[i % 2]}": {
+            "values": [[float(ts), str(v)] for ts, v in zip(timestamps, rng.gamma(2, 5, n_points))]
+        }
+        for i in range(n_series)
+    }
+
+SERIES_KEYS = {
+    'cpu': lambda n_interfaces: ["cpu"],
+    'disk': lambda n_interfaces: [f"disk.0.{m}.{d}" for m in ("iops", "bandwidth") for d in ("read", "write")],
+    'network': lambda n_interfaces: [
+        f"network.{i}.{m}.{d}" for i in range(n_interfaces) for m in ("pps", "bandwidth") for d in ("in", "out")
+    ],
+}
+
+# Local stand-in for an hcloud BoundServer: get_metrics() answers with synthetic
+# time series shaped like the real API response, without a token or network
+class FakeServer:
+    def __init__(self, n_interfaces: int = 1, latency_s: float = 0.0, seed: int = 0) -> None:
+        self.n_interfaces = n_interfaces
+        self.latency_s = latency_s
+        self.seed = seed
+        self.calls = 0
+
+    def get_metrics(
+        self,
+        type: str | list[str],
+        start: datetime,
+        end: datetime,
+        step: float | None = None
+    ) -> SimpleNamespace:
+        self.calls += 1
+        if self.latency_s:
+            time.sleep(self.latency_s)
+
+        step = int(step or 1) or 1
+        first = (int(start.timestamp()) // step + 1) * step
+        timestamps = np.arange(first, int(end.timestamp()) + 1, step)
+        rng = np.random.default_rng(self.seed + first)
+
+        time_series = {}
+        for t in (type if isinstance(type, list) else [type]):
+            for key in SERIES_KEYS[t](self.n_interfaces):
+                values = rng.gamma(2, 5, len(timestamps))
+                time_series[key] = {
+                    "values": [[float(ts), str(v)] for ts, v in zip(timestamps, values)]
+                }
+
+        return SimpleNamespace(metrics=SimpleNamespace(
+            start=start, end=end, step=step, time_series=time_series
+        ))
+
+# get_stats() decoding before decode_time_series(), kept as a baseline. Column
+# names are made unique the same way, the plain merge fails on a second interface
+def merge_decode(time_series: dict) -> pd.DataFrame:
+    dfs = []
+    col_names = set()
+    for key in time_series:
+        col_name = '_'.join(key.split(".")[-2:])
+        if col_name in col_names:
+            col_name = '_'.join(key.split("."))
+        col_names.add(col_name)
+
+        dfs.append(pd.DataFrame(
+            data=time_series[key]["values"],
+            columns=["datetime", col_name],
+            dtype="float"
+        ))
+
+    df = reduce(lambda left, right: pd.merge(left, right, on='datetime', how='outer'), dfs)
+
+    df['datetime'] = pd.to_datetime(
+        df['datetime'].astype(int), unit='s', utc=True
+    ).dt.tz_convert('Europe/Rome')
+
+    return df
+
+def bench_decode(number: int = 5) -> None:
+    # 30d at the bot's step (lookback // MAX_METRICS_VALUES) and at 1 min resolution
+    for n_points in (500, 43200):
+        for n_series in (1, 4, 16):
+            time_series = make_time_series(n_points, n_series)
+            merge_s = min(repeat(lambda: merge_decode(time_series), number=number, repeat=3)) / number
+            columnar_s = min(repeat(lambda: time_series_to_frame(time_series), number=number, repeat=3)) / number
+            print(f"decode {n_points:>6} points x {n_series:>2} series: "
+                  f"merge {merge_s * 1000:8.2f} ms, columnar {columnar_s * 1000:8.2f} ms, "
+                  f"x{merge_s / columnar_s:.1f}")
+
+def make_frame(n_points: int, n_columns: int, step: int = 4) -> pd.DataFrame:
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame(rng.gamma(2, 5, (n_points, n_columns)), columns=[f"col_{i}" for i in range(n_columns)])
+    df.insert(0, 'datetime', pd.date_range('2024-01-01', periods=n_points, freq=f'{step}s', tz='UTC'))
+    return df
+
+# One vectorized detector over all columns against analyze() per column, both
+# for the first 500-point window and for a monitor tick of 5 new rows
+def bench_detector(number: int = 5) -> None:
+    for n_columns in (1, 9, 36, 144):
+        df = make_frame(505, n_columns)
+        columns = [c for c in df.columns if c != 'datetime']
+        thresholds = {c: (3.5, -3, 2) for c in columns}
+
+        per_column_s = min(repeat(lambda: [analyze(df, c) for c in columns], number=number, repeat=3)) / number
+        window_s = min(repeat(lambda: StreamingDetector(columns, thresholds=thresholds).feed(df.iloc[:500]),
+                              number=number, repeat=3)) / number
+
+        detector = StreamingDetector(columns, thresholds=thresholds)
+        detector.feed(df.iloc[:500])
+        rows = df[columns].to_numpy()[500:]
+        tick_s = min(repeat(lambda: [detector.update(row) for row in rows], number=number, repeat=3)) / number
+        print(f"detect {n_columns:>3} columns: analyze() per column {per_column_s * 1000:8.2f} ms, "
+              f"streaming window {window_s * 1000:7.2f} ms, tick {tick_s * 1000:6.3f} ms")
+
+LIVE_CHECK_COLUMNS = 4  # Series also fed as live frames, analyze() per frame is slow
+
+# The monitor relies on StreamingDetector flagging exactly what analyze()
+# flags: random series with spikes, NaN gaps and constant runs (where the
+# rolling std is 0) are fed point by point and every flag is compared
+def check_detector(n_series: int = 40, n_points: int = 600, seeds: int = 10) -> None:
+    flags = ['is_high_anomaly', 'is_low_anomaly', 'is_anomaly', 'is_sustained_anomaly']
+    columns = [f"col_{i}" for i in range(n_series)]
+    thresholds = {c: (get_stats.HIGH_ANOMALY_THRESHOLD, get_stats.LOW_ANOMALY_THRESHOLD,
+                      get_stats.SUSTAINED_ANOMALY_THRESHOLD) for c in columns}
+    n_flagged = n_revised = 0
+    for seed in range(seeds):
+        rng = np.random.default_rng(seed)
+        values = rng.gamma(2, 5, (n_points, n_series))
+        for j in range(n_series):
+            for _ in range(rng.integers(0, 6)):
+                i = rng.integers(0, n_points - 40)
+                kind = rng.integers(0, 3)
+                if kind == 0:
+                    values[i:i + rng.integers(1, 20), j] = np.nan
+                elif kind == 1:
+                    values[i:i + rng.integers(2, 40), j] = rng.integers(0, 50)
+                else:
+                    values[i:i + rng.integers(1, 15), j] += rng.uniform(20, 100)
+
+        df = pd.DataFrame(values, columns=columns)
+        detector = StreamingDetector(columns, thresholds=thresholds)
+        streamed = [detector.update(row) for row in values]
+
+        for j, col_name in enumerate(columns):
+            expected = analyze(df, col_name)
+            for flag in flags:
+                got = np.array([result[flag][j] for result in streamed])
+                mismatches = np.flatnonzero(got != expected[flag].to_numpy())
+                assert not len(mismatches), \
+                    f"seed {seed}: {col_name} {flag} differs from analyze() at rows {mismatches[:10]}"
+                n_flagged += got.sum()
+
+        # Live frames like the monitor's: overlapping, a few new rows each,
+        # the newest one partial until the next frame revises it. Every feed
+        # must score the newest row as analyze() does the data known so far.
+        dated = df.assign(datetime=pd.date_range('2026-01-01', periods=n_points, freq='10s', tz='UTC'))
+        live_columns = columns[:LIVE_CHECK_COLUMNS]
+        detector = StreamingDetector(live_columns, thresholds=thresholds)
+        end = 0
+        while end < n_points:
+            end = min(end + rng.integers(1, 6), n_points)
+            frame = dated.iloc[max(end - 3 * get_stats.WINDOW_SIZE, 0):end].copy()
+            if end < n_points:
+                frame.iloc[-1, :n_series] *= rng.uniform(0.2, 1.0)
+            known = pd.concat([dated.iloc[:end - 1], frame.iloc[-1:]], ignore_index=True)
+            result = detector.feed(frame)
+
+            for j, col_name in enumerate(live_columns):
+                expected = analyze(known, col_name).iloc[-1]
+                for flag in flags:
+                    assert result[flag][j] == expected[flag], \
+                        f"seed {seed}: {col_name} {flag} of a live frame differs from analyze() at row {end - 1}"
+                    n_revised += result[flag][j]
+
+    print(f"detector check: {seeds} x {n_series} series of {n_points} points, {n_flagged} flags equal to analyze(), "
+          f"{n_revised} with revised newest rows")
+
+# Percentiles over 1d and 7d merged from stored per-bucket sketches against
+# exact ones from all the raw points, with the sketch relative error
+def bench_quantiles(days: int = 7, step: int = 60) -> None:
+    rng = np.random.default_rng(0)
+    n_points = days * 24 * 60 * 60 // step
+    end = pd.Timestamp.now(tz='UTC').floor(f'{step}s')
+    df = pd.DataFrame({
+        'datetime': pd.date_range(end=end, periods=n_points, freq=f'{step}s'),
+        'cpu': rng.gamma(2, 5, n_points),
+    })
+
+    store = MetricsStore(Path(tempfile.mkdtemp()) / "metrics.db")
+    started = time.perf_counter()
+    for i in range(0, n_points, MAX_METRICS_VALUES):
+        store.append(df.iloc[i:i + MAX_METRICS_VALUES])
+    append_s = time.perf_counter() - started
+
+    qs = (0.5, 0.95, 0.99)
+    for window_days in (1, days):
+        start = (end - pd.Timedelta(days=window_days)).to_pydatetime()
+        values = df['cpu'].to_numpy()[-window_days * 24 * 60 * 60 // step:]
+
+        sketch_s = min(repeat(lambda: store.quantiles(['cpu'], start, end.to_pydatetime(), qs), number=5, repeat=3)) / 5
+        exact_s = min(repeat(lambda: np.quantile(values, qs), number=5, repeat=3)) / 5
+        approx = store.quantiles(['cpu'], start, end.to_pydatetime(), qs)['cpu']
+        exact = np.quantile(values, qs)
+        error = np.max(np.abs(np.array(approx) / exact - 1))
+        print(f"quantiles {window_days:>2}d ({len(values)} points): sketches {sketch_s * 1000:.2f} ms, "
+              f"exact on in-memory raw points {exact_s * 1000:.2f} ms, max relative error {error:.2%}")
+
+        # Edges are rounded to whole buckets, hence some slack over the sketch accuracy
+        assert error < 3 * DDSketch().relative_accuracy, f"{window_days}d percentiles off by {error:.2%}"
+
+    print(f"quantiles: appending {n_points} points took {append_s:.2f} s")
+
+STARTUP_BUDGET_S = 0.5
+
+# Importing the bot modules must stay cheap and offline: no pandas, matplotlib
+# or hcloud until first use, and no server lookup
+def bench_startup(budget_s: float = STARTUP_BUDGET_S) -> None:
+    code = (
+        "import sys, time; t = time.perf_counter(); import get_stats, get_text; "
+        "print(time.perf_counter() - t); "
+        "print(','.join(m for m in ('pandas', 'matplotlib', 'hcloud') if m in sys.modules))"
+    )
+    # Any HTTP request made during the import would fail against this proxy
+    env = dict(os.environ, HTTP_PROXY="http://127.0.0.1:9", HTTPS_PROXY="http://127.0.0.1:9", NO_PROXY="")
+    result = subprocess.run(
+        [sys.executable, "-c", code], cwd=Path(__file__).parent,
+        env=env, capture_output=True, text=True, check=True
+    )
+    import_s, loaded = result.stdout.splitlines()
+    print(f"startup: import {float(import_s) * 1000:.1f} ms, heavy modules loaded: {loaded or 'none'}")
+
+    assert float(import_s) < budget_s, f"import took {float(import_s):.2f}s, budget {budget_s}s"
+    assert not loaded, f"{loaded} imported at startup"
+
+
+WINDOWS_S = {
+    '5m': 5 * 60,
+    '1h': 60 * 60,
+    '1d': 24 * 60 * 60,
+    '7d': 7 * 24 * 60 * 60,
+    '30d': 30 * 24 * 60 * 60,
+}
+
+def measure(fn: Callable[[], object], runs: int) -> dict[str, float]:
+    durations = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        fn()
+        durations.append(time.perf_counter() - started)
+
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    quantiles = statistics.quantiles(durations, n=20, method='inclusive') if runs > 1 else durations * 19
+    return {
+        'p50_ms': statistics.median(durations) * 1000,
+        'p95_ms': quantiles[18] * 1000,
+        'peak_kib': peak / 1024,
+    }
+
+# Time every stage of the plot and stats pipelines for each window, fed by
+# FakeServer payloads of `points_per_window` points (the bot asks for
+# MAX_METRICS_VALUES) and `n_interfaces` network interfaces
+def bench_pipeline(
+    windows: list[str],
+    points_per_window: int = MAX_METRICS_VALUES,
+    n_interfaces: int = 1,
+    runs: int = 20,
+    render_runs: int = 3
+) -> dict[str, dict[str, float]]:
+    server = FakeServer(n_interfaces)
+    end = datetime.now().astimezone()
+    results = {}
+
+    for window in windows:
+        lookback_s = WINDOWS_S[window]
+        start = end - timedelta(seconds=lookback_s)
+        step = max(lookback_s // points_per_window, 1)
+        time_series = server.get_metrics(['cpu', 'disk', 'network'], start, end, step).metrics.time_series
+        df = time_series_to_frame(time_series)
+        analyzed = analyze(df, 'cpu')
+
+        stages = {
+            'decode': (lambda: time_series_to_frame(time_series), runs),
+            'merge': (lambda: merge_decode(time_series), runs),
+            'analyze': (lambda: analyze(df, 'cpu'), runs),
+            'render_cpu': (lambda: save_cpu_plot(BytesIO(), analyzed), render_runs),
+            'render_disk': (lambda: save_disk_plot(BytesIO(), df), render_runs),
+            'render_network': (lambda: save_network_plot(BytesIO(), df), render_runs),
+            'text': (lambda: (get_text.get_cpu_stats_text(df), get_text.get_disk_stats_text(df), get_text.get_network_stats_text(df)), runs),
+        }
+        for stage, (fn, stage_runs) in stages.items():
+            name = f"{window}/{stage}"
+            results[name] = measure(fn, stage_runs)
+            print(f"{name:<22} p50 {results[name]['p50_ms']:9.2f} ms  p95 {results[name]['p95_ms']:9.2f} ms  "
+                  f"peak {results[name]['peak_kib']:9.0f} KiB")
+
+    return results
+
+# Stages whose p50 got slower than `tolerance` times the baseline
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    return [
+        f"{name}: p50 {result['p50_ms']:.2f} ms vs {baseline[name]['p50_ms']:.2f} ms"
+        for name, result in results.items()
+        if name in baseline and result['p50_ms'] > baseline[name]['p50_ms'] * tolerance
+    ]
+
+
+# Building a fresh figure per plot (what every render used to do) against
+# reusing the per-metric template, then the reused template at a few output
+# formats and resolutions with the resulting upload size
+def bench_render(runs: int = 5) -> None:
+    from figures import CpuPlot, TwoPanelPlot, DISK_PANELS, get_template
+    from get_stats import PLOT_SIZE, PLOT_DPI, PLOT_WIDTH_PX, PLOT_POINTS, WINDOW_SIZE
+    from downsample import downsample
+
+    end = datetime.now().astimezone()
+    time_series = FakeServer().get_metrics(
+        ['cpu', 'disk', 'network'], end - timedelta(hours=6), end, 6 * 60 * 60 // PLOT_WIDTH_PX
+    ).metrics.time_series
+    df = time_series_to_frame(time_series)
+    cpu_df = downsample(analyze(df, 'cpu'), ['cpu'], PLOT_POINTS)
+    disk_df = df.assign(**{f'rolling_{c}': df[c].rolling(WINDOW_SIZE).mean() for c in df.columns if c != 'datetime'})
+
+    plots = {
+        'cpu': (lambda: CpuPlot(PLOT_SIZE, PLOT_DPI), cpu_df),
+        'disk': (lambda: TwoPanelPlot(PLOT_SIZE, PLOT_DPI, DISK_PANELS), disk_df),
+    }
+    for metric, (build, data) in plots.items():
+        fresh = measure(lambda: build().render(data), runs)
+        template = get_template(metric, PLOT_SIZE, PLOT_DPI)
+        reused = measure(lambda: template.render(data), runs)
+        print(f"render {metric:<4} fresh figure p50 {fresh['p50_ms']:7.1f} ms, "
+              f"template p50 {reused['p50_ms']:7.1f} ms, x{fresh['p50_ms'] / reused['p50_ms']:.2f}")
+
+    for dpi in (PLOT_DPI, 100):
+        template = get_template('cpu', PLOT_SIZE, dpi)
+        for format in ('png', 'webp', 'jpeg'):
+            result = measure(lambda: template.render(cpu_df, format), runs)
+            size_kib = len(template.render(cpu_df, format)) / 1024
+            print(f"render cpu {format:<4} at {dpi:>3} dpi: p50 {result['p50_ms']:7.1f} ms, {size_kib:6.0f} KiB")
+
+FLEET_CHECK_BUDGET_S = 20  # The monitor's default check interval
+
+# One monitor check of `n_servers` FakeServers answering in `latency_s` each
+# (about what the metrics endpoint takes), through the fleet pool: the first
+# check fetches full windows, the next ones only the new points
+def bench_fleet(
+    n_servers: int = 100,
+    latency_s: float = 0.3,
+    checks: int = 3,
+    step: int = 4,
+    budget_s: float = FLEET_CHECK_BUDGET_S
+) -> None:
+    from fleet import poll_fleet
+    from get_stats import ALL_METRICS, METRIC_COLUMNS, FLEET_WORKERS
+
+    fleet = {f"bench-{i:03}": FakeServer(latency_s=latency_s, seed=i) for i in range(n_servers)}
+    saved = get_stats.get_fleet, get_stats.SERVER_NAMES, get_stats.FLEET_MODE
+    get_stats.get_fleet, get_stats.SERVER_NAMES, get_stats.FLEET_MODE = lambda: fleet, list(fleet), True
+
+    columns = [col_name for metric in ALL_METRICS for col_name in METRIC_COLUMNS[metric]]
+    detectors = {server: StreamingDetector(columns) for server in fleet}
+    end = datetime.now().astimezone()
+    try:
+        for check in range(checks):
+            started = time.perf_counter()
+            results = poll_fleet(detectors, end + timedelta(seconds=check * 5 * step), step)
+            elapsed_s = time.perf_counter() - started
+
+            errors = [result for result in results.values() if isinstance(result, Exception)]
+            print(f"fleet check {check + 1}: {n_servers} servers, {latency_s * 1000:.0f} ms per call, "
+                  f"{FLEET_WORKERS} workers: {elapsed_s:.2f} s ({len(errors)} errors, "
+                  f"one at a time {n_servers * latency_s:.0f}+ s)")
+
+            assert not errors, errors[0]
+            assert elapsed_s < budget_s, f"fleet check took {elapsed_s:.1f}s, budget {budget_s}s"
+    finally:
+        get_stats.get_fleet, get_stats.SERVER_NAMES, get_stats.FLEET_MODE = saved
+
+# /export of 1, 7 and 30 days at a 1 min step from a FakeServer answering in
+# `latency_s`: time, file size and peak memory, which must not grow with the range
+def bench_export(latency_s: float = 0.05, step: int = 60, format: str = 'csv') -> None:
+    from export import export_metrics, EXPORT_SUFFIXES
+    from get_stats import ALL_METRICS
+
+    server = FakeServer(latency_s=latency_s)
+    saved = get_stats.get_fleet
+    get_stats.get_fleet = lambda: {"bench": server}
+
+    end = datetime.now().astimezone()
+    peaks = {}
+    try:
+        for days in (1, 7, 30):
+            path = Path(tempfile.mkdtemp()) / f"export{EXPORT_SUFFIXES[format]}"
+            calls = server.calls
+            tracemalloc.start()
+            started = time.perf_counter()
+            rows = export_metrics(path, ALL_METRICS, end - timedelta(days=days), end, "bench", format, step)
+            elapsed_s = time.perf_counter() - started
+            peaks[days] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            print(f"export {days:>2}d: {rows} rows in {server.calls - calls} requests, {elapsed_s:.2f} s, "
+                  f"{path.stat().st_size / 1024:.0f} KiB {format}, peak {peaks[days] / 1024 / 1024:.1f} MiB")
+            assert rows == days * 24 * 60 * 60 // step, f"{days}d export has {rows} rows"
+    finally:
+        get_stats.get_fleet = saved
+
+    assert peaks[30] < 1.5 * peaks[7], "export memory grows with the range"
+
+# A CPU with a daily 5 minute cron spike at 03:00 and a few real 10 minute
+# spikes in its last week, checked by rolling, seasonal and both detectors:
+# false alerts, real spikes caught, and the cost of building the baseline
+# from `weeks` weeks and of a lookup
+def bench_seasonal(weeks: int = 4, step: int = 60, batch: int = 15) -> None:
+    from baseline import SeasonalBaseline, wall_seconds, WEEK_S
+
+    rng = np.random.default_rng(0)
+    points_per_week = WEEK_S // step
+    datetimes = pd.date_range('2024-01-01', periods=(weeks + 1) * points_per_week, freq=f'{step}s', tz='Europe/Rome')
+    minute_of_day = (datetimes.hour * 60 + datetimes.minute).to_numpy()
+    cpu = 10 + 5 * np.sin(2 * np.pi * minute_of_day / 1440) + rng.normal(0, 1.5, len(datetimes))
+    cron = (minute_of_day >= 3 * 60) & (minute_of_day < 3 * 60 + 5)
+    cpu[cron] = 70 + rng.gamma(2, 1.5, cron.sum())
+
+    live = np.zeros(len(datetimes), dtype=bool)
+    live[weeks * points_per_week:] = True
+    spike_starts = weeks * points_per_week + rng.choice(points_per_week - 10, 5, replace=False)
+    real = np.zeros(len(datetimes), dtype=bool)
+    for i in spike_starts:
+        real[i:i + 10] = True
+    cpu[real] = 70 + rng.gamma(2, 1.5, real.sum())
+    df = pd.DataFrame({'datetime': datetimes, 'cpu': cpu})
+    history, week = df[~live], df[live].reset_index(drop=True)
+    real = real[live]
+
+    def build() -> SeasonalBaseline:
+        baseline = SeasonalBaseline(['cpu'])
+        baseline.add(wall_seconds(history['datetime']), history[['cpu']].to_numpy(), step)
+        baseline.until = history['datetime'].iloc[-1].timestamp()
+        baseline.ready = True
+        return baseline
+
+    build_s = min(repeat(build, number=1, repeat=3))
+    baseline = build()
+    wall_s = wall_seconds(week['datetime'])
+    lookup_s = min(repeat(lambda: baseline.score(wall_s[0], cpu[:1]), number=1000, repeat=3)) / 1000
+    print(f"seasonal baseline of {len(history)} points: built in {build_s * 1000:.1f} ms, lookup {lookup_s * 1e6:.1f} us")
+
+    caught, false_alerts = {}, {}
+    for mode in ('rolling', 'seasonal', 'both'):
+        detector = StreamingDetector(['cpu'], baseline=build(), mode=mode)
+        detector.feed(history.iloc[-MAX_METRICS_VALUES:])
+        values = week[['cpu']].to_numpy()
+        flagged = np.zeros(len(week), dtype=bool)
+        for i in range(len(week)):
+            result = detector.update(values[i], wall_s[i])
+            flagged[i] = result['is_anomaly'][0] | result['is_sustained_anomaly'][0]
+            # Points join the baseline once checked, as in feed()
+            if i % batch == batch - 1:
+                detector.baseline.add(wall_s[i + 1 - batch:i + 1], values[i + 1 - batch:i + 1], step)
+
+        # Alerts are the starts of flagged runs
+        starts = flagged & ~np.concatenate([[False], flagged[:-1]])
+        false_alerts[mode] = int((starts & ~real).sum())
+        caught[mode] = sum(flagged[i:i + 10].any() for i in spike_starts - weeks * points_per_week)
+        print(f"seasonal {mode:>8}: {false_alerts[mode]:>3} false alerts in a week, caught {caught[mode]}/{len(spike_starts)} real spikes")
+
+    # The hour of the cron spike expects 70%, a real spike within it may pass
+    outside_cron = sum(week['datetime'][i].hour != 3 for i in spike_starts - weeks * points_per_week)
+    assert caught['both'] >= outside_cron and false_alerts['both'] == 0, "both modes together still alert on the cron spike"
+
+SOAK_MAX_GROWTH_BYTES = 2 * 1024 * 1024
+
+# The monitor and plot paths `iterations` times against a FakeServer, with
+# the caches capped like MEMORY_BUDGET_MB=`budget_mb` does. Over the second
+# half of the run, traced memory beyond what the caches hold may not grow by
+# more than `max_growth`, nor may the caches outgrow their caps.
+def bench_soak(
+    iterations: int = 2000,
+    plot_every: int = 20,
+    step: int = 4,
+    budget_mb: int = 32,
+    max_growth: int = SOAK_MAX_GROWTH_BYTES
+) -> None:
+    from cache import PlotCache
+    from fleet import poll_metrics
+    from get_stats import ALL_METRICS, METRIC_COLUMNS, PLOT_FETCH_VALUES
+    from memory import memory_caps, rss_bytes, release_memory, format_bytes
+
+    caps = memory_caps(budget_mb)
+    server = FakeServer()
+    saved = get_stats.get_fleet, get_stats.MEMORY_CAPS
+    get_stats.get_fleet, get_stats.MEMORY_CAPS = lambda: {"bench": server}, caps
+    get_stats.stats_caches.pop("bench", None)
+
+    columns = [col_name for metric in ALL_METRICS for col_name in METRIC_COLUMNS[metric]]
+    detector = StreamingDetector(columns)
+    plot_cache = PlotCache(max_bytes=caps.plot_cache_bytes)
+    cache = get_stats.get_cache("bench")
+    end = datetime.now().astimezone()
+    lookbacks_s = [60 * 60, 3 * 60 * 60, 24 * 60 * 60]
+
+    def tick(i: int) -> None:
+        now = end + timedelta(seconds=i * step)
+        poll_metrics(detector, now, step, "bench")
+        if i % plot_every == 0:
+            lookback_s = lookbacks_s[i // plot_every % len(lookbacks_s)]
+            fetch_step = max(lookback_s // PLOT_FETCH_VALUES, 1)
+            df = cache.get('cpu', now - timedelta(seconds=lookback_s), now, fetch_step)
+            scale = get_stats.window_scale(lookback_s, fetch_step)
+            buffer = BytesIO()
+            save_cpu_plot(buffer, analyze(df, 'cpu', scale))
+            plot_cache.put(("bench", 'cpu', lookback_s, now), buffer.getvalue(), "")
+
+    # Traced memory not held by the caches
+    def live() -> int:
+        release_memory()
+        return tracemalloc.get_traced_memory()[0] - plot_cache.size - cache.size
+
+    half = iterations // 2
+    started = time.perf_counter()
+    tracemalloc.start()
+    try:
+        for i in range(half):
+            tick(i)
+        live_before, rss_before = live(), rss_bytes()
+        for i in range(half, iterations):
+            tick(i)
+        growth, rss_growth = live() - live_before, rss_bytes() - rss_before
+    finally:
+        tracemalloc.stop()
+        get_stats.get_fleet, get_stats.MEMORY_CAPS = saved
+        get_stats.stats_caches.pop("bench", None)
+
+    print(f"soak {iterations} monitor ticks, {iterations // plot_every} plots in {time.perf_counter() - started:.0f} s: "
+          f"second half growth {format_bytes(growth)} traced, {format_bytes(rss_growth)} RSS, "
+          f"caches {format_bytes(plot_cache.size)} plots / {format_bytes(cache.size)} metrics")
+    assert growth < max_growth, f"memory grew by {format_bytes(growth)} over the second half of the soak"
+    assert plot_cache.size <= caps.plot_cache_bytes and cache.size <= caps.metrics_cache_bytes
+
+# A recorded text message update, as Telegram posts it to the webhook
+SAMPLE_UPDATE = {
+    "update_id": 1,
+    "message": {
+        "message_id": 1,
+        "date": 1700000000,
+        "chat": {"id": 1, "type": "private", "first_name": "Admin"},
+        "from": {"id": 1, "is_bot": False, "first_name": "Admin"},
+        "text": "ping"
+    }
+}
+
+# Post updates to a local WebhookServer from `clients` threads, against a
+# handler taking `handler_s`: delivery latency, throughput and 429s under load
+def bench_webhook(n_updates: int = 200, clients: int = 8, handler_s: float = 0.01) -> None:
+    from concurrent.futures import ThreadPoolExecutor
+    from urllib.error import HTTPError
+    from urllib.request import Request, urlopen
+    from telebot import TeleBot
+    from webhook import WebhookServer
+
+    handled = []
+    bot = TeleBot("1:offline", threaded=False)
+
+    @bot.message_handler(func=lambda message: True)
+    def handle(message):
+        time.sleep(handler_s)
+        handled.append(time.perf_counter())
+
+    server = WebhookServer(bot, secret_token="bench-secret", port=0)
+    server.start()
+    url = "http://%s:%d/" % server.address
+
+    def post(update_id: int, secret: str = "bench-secret") -> tuple[int, float]:
+        body = json.dumps(dict(SAMPLE_UPDATE, update_id=update_id)).encode()
+        request = Request(url, body, {"X-Telegram-Bot-Api-Secret-Token": secret})
+        started = time.perf_counter()
+        try:
+            status = urlopen(request).status
+        except HTTPError as e:
+            status = e.code
+        return status, time.perf_counter() - started
+
+    assert post(0, secret="wrong")[0] == 403
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(clients) as pool:
+        responses = list(pool.map(post, range(1, n_updates + 1)))
+    server.stop()
+    elapsed_s = time.perf_counter() - started
+
+    statuses = [status for status, _ in responses]
+    latencies_ms = sorted(latency * 1000 for _, latency in responses)
+    print(f"webhook {n_updates} updates from {clients} clients, handler {handler_s * 1000:.0f} ms: "
+          f"{statuses.count(200)} accepted, {statuses.count(429)} refused (429), "
+          f"{len(handled)} handled in {elapsed_s:.2f} s, "
+          f"response p50 {latencies_ms[len(latencies_ms) // 2]:.1f} ms, "
+          f"p95 {latencies_ms[int(len(latencies_ms) * 0.95)]:.1f} ms")
+
+    assert len(handled) == statuses.count(200)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline benchmarks against a local hcloud stand-in")
+    parser.add_argument("--windows", nargs="+", default=list(WINDOWS_S), choices=list(WINDOWS_S))
+    parser.add_argument("--points", type=int, default=MAX_METRICS_VALUES, help="points per window")
+    parser.add_argument("--interfaces", type=int, default=1, help="network interfaces (series = 9 + 4 * (n - 1))")
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--save", type=Path, help="write the results as JSON")
+    parser.add_argument("--compare", type=Path, help="fail if slower than these saved results")
+    parser.add_argument("--tolerance", type=float, default=1.25, help="allowed slowdown factor")
+    parser.add_argument("--micro", action="store_true", help="also run the startup, decode, detector and quantile benchmarks")
+    parser.add_argument("--check", action="store_true", help="also check the streaming detector against analyze()")
+    parser.add_argument("--render", action="store_true", help="also run the figure template and output format benchmark")
+    parser.add_argument("--webhook", action="store_true", help="also run the webhook delivery benchmark")
+    parser.add_argument("--fleet", action="store_true", help="also run the fleet monitor check benchmark")
+    parser.add_argument("--export", action="store_true", help="also run the streaming export benchmark")
+    parser.add_argument("--seasonal", action="store_true", help="also run the seasonal baseline detector check")
+    parser.add_argument("--soak", action="store_true", help="also run the memory soak check of the monitor and plot paths")
+    args = parser.parse_args()
+
+    if args.micro:
+        bench_startup()
+        bench_decode()
+        bench_detector()
+        bench_quantiles()
+
+    if args.micro or args.check:
+        check_detector()
+
+    if args.render:
+        bench_render()
+
+    if args.webhook:
+        bench_webhook()
+
+    if args.fleet:
+        bench_fleet()
+
+    if args.export:
+        for format in ("csv", "parquet"):
+            bench_export(format=format)
+
+    if args.seasonal:
+        bench_seasonal()
+
+    if args.soak:
+        bench_soak()
+
+    results = bench_pipeline(args.windows, args.points, args.interfaces, args.runs)
+
+    if args.save:
+        args.save.write_text(json.dumps(results, indent=2))
+
+    if args.compare:
+        regressions = compare(results, json.loads(args.compare.read_text()), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        sys.exit(1 if regressions else 0)
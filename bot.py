@@ -1,35 +1,82 @@
+from __future__ import annotations
+
+import time
+STARTED_AT = time.perf_counter()
+
 from datetime import datetime, timedelta
 from dotenv import dotenv_values
-from pathlib import Path
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial, wraps
+from pathlib import Path
+from typing import Callable, TYPE_CHECKING
+from urllib.parse import urlparse
 
 import telebot
 from telebot import types
+import numpy as np
 
-from get_stats import get_stats, analyze, save_cpu_plot, \
-                      save_disk_plot, save_network_plot, MAX_METRICS_VALUES
+from get_stats import get_cache, analyze, save_cpu_plot, \
+                      save_disk_plot, save_network_plot, MAX_METRICS_VALUES, ALL_METRICS, \
+                      PLOT_FETCH_VALUES, window_scale, METRIC_COLUMNS, fetch_scheduler, stats_caches, \
+                      server_names, default_server, FLEET_MODE, MEMORY_BUDGET_MB, MEMORY_CAPS
 from get_text import get_cpu_stats_text, get_disk_stats_text, get_network_stats_text
-
-import time, logging, threading, signal
-import pandas as pd
-import matplotlib.pyplot as plt
-
-plt.switch_backend('agg')
+from detector import StreamingDetector
+from fleet import poll_fleet, new_detector, stop_building, baseline_builds
+from render import Renderer, RenderQueueFull
+from cache import PlotCache
+from alerts import AlertManager
+from export import export_metrics, EXPORT_SUFFIXES, EXPORT_MAX_RANGE_S
+from outbox import Outbox
+from subscribers import SubscriberRegistry
+from scheduler import MonitorPacer
+from memory import MemoryTracker, rss_bytes, release_memory, format_bytes
+import perf
+
+import logging, threading, signal, os, re, tempfile
+
+if TYPE_CHECKING:
+    import pandas as pd
+    from hcloud.servers.domain import MetricsType
+    from alerts import AlertAction
+    from export import ExportFormat
+
+IMPORTS_DONE_AT = time.perf_counter()
 
 RUNNING = True
-CHECK_INTERVAL_S = 20
-CPU_PLOT_FILENAME = "cpu.png"
-DISK_PLOT_FILENAME = "disk.png"
-NETWORK_PLOT_FILENAME = "network.png"
+OUTBOX_FLUSH_S = 10  # On exit, time left to deliver queued messages
 
 config = dotenv_values()
 
-tmp = Path("./tmp")
-
-tmp.mkdir(exist_ok=True)
+# In memory budget mode (MEMORY_BUDGET_MB) each cache and queue gets its cap from the budget
+renderer = Renderer(tasks_per_worker=MEMORY_CAPS.render_tasks_per_worker) if MEMORY_CAPS else Renderer()
+plot_cache = PlotCache(max_bytes=MEMORY_CAPS.plot_cache_bytes) if MEMORY_CAPS else PlotCache()
+alert_manager = AlertManager()
+memory_tracker = MemoryTracker()
+
+perf.gauge('metrics_cache_hits', lambda: sum(cache.hits for cache in list(stats_caches.values())))
+perf.gauge('metrics_cache_deltas', lambda: sum(cache.deltas for cache in list(stats_caches.values())))
+perf.gauge('metrics_cache_misses', lambda: sum(cache.misses for cache in list(stats_caches.values())))
+perf.gauge('plot_cache_hits', lambda: plot_cache.hits)
+perf.gauge('plot_cache_misses', lambda: plot_cache.misses)
+perf.gauge('api_calls_coalesced', lambda: fetch_scheduler.coalesced)
+perf.gauge('api_tokens', lambda: fetch_scheduler.tokens)
+perf.gauge('rss_bytes', rss_bytes)
+perf.gauge('plot_cache_bytes', lambda: plot_cache.size)
+perf.gauge('metrics_cache_bytes', lambda: sum(cache.size for cache in list(stats_caches.values())))
+
+# With WEBHOOK_URL set, updates arrive through webhook.py, whose workers run
+# the handlers themselves instead of telebot's unbounded worker pool
+WEBHOOK_MODE = bool(config.get("WEBHOOK_URL"))
+
+# TELEGRAM_API_URL points the bot at a local Bot API server (or loadtest.py's
+# stand-in), e.g. "http://127.0.0.1:8081/bot{0}/{1}"
+if config.get("TELEGRAM_API_URL"):
+    telebot.apihelper.API_URL = config["TELEGRAM_API_URL"]
 
 bot = telebot.TeleBot(
     token=config["TELEGRAM_TOKEN"],
+    threaded=not WEBHOOK_MODE,
     parse_mode="Markdown"
 )
 
@@ -37,6 +84,20 @@ messages: deque[int] = deque([], 10)
 
 chat_id = int(config['TELEGRAM_CHAT_ID'])
 
+# Admin chat plus the users and groups (comma separated chat ids) allowed to
+# use the menus and subscribe to alerts
+allowed_chats = {chat_id} | {
+    int(chat) for chat in config.get("TELEGRAM_SUBSCRIBERS", "").split(",") if chat.strip()
+}
+
+def is_allowed(chat: int) -> bool:
+    return chat in allowed_chats
+
+subscribers = SubscriberRegistry(Path(config.get("SUBSCRIBERS_FILE", "tmp/subscribers.json")), [chat_id])
+outbox = Outbox(max_queued=MEMORY_CAPS.outbox_messages) if MEMORY_CAPS else Outbox()
+
+perf.gauge('outbox_queued', lambda: outbox.queued)
+
 telebot.logger.setLevel(logging.INFO)
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -49,11 +110,15 @@ cpu_cmd = "\U0001F39B " + "CPU"
 disk_cmd = "\U0001F4BE " + "DISK"
 network_cmd = "\U0001F4E1 " + "NETWORK"
 
+server_cmd = "\U0001F5A5 " + "SERVER"
+
 menu_markup = types.ReplyKeyboardMarkup()
 cpu_kb = types.KeyboardButton(cpu_cmd)
 disk_kb = types.KeyboardButton(disk_cmd)
 network_kb = types.KeyboardButton(network_cmd)
 menu_markup.row(cpu_kb, disk_kb, network_kb)
+if FLEET_MODE:
+    menu_markup.row(types.KeyboardButton(server_cmd))
 
 menu_cmd = "\U0001F519 Back"
 cpu_plot_cmd = "\U0001F39B Plot"
@@ -78,348 +143,715 @@ network_stats_menu_markup.row(
     types.KeyboardButton(menu_cmd)
 )
 
-cpu_stats_update_markup = types.InlineKeyboardMarkup()
-cpu_stats_update_markup.row(
-    types.InlineKeyboardButton(text=("Update"), callback_data="cpu_stats_update")
-)
-
-disk_stats_update_markup = types.InlineKeyboardMarkup()
-disk_stats_update_markup.row(
-    types.InlineKeyboardButton(text=("Update"), callback_data="disk_stats_update")
-)
-
-network_stats_update_markup = types.InlineKeyboardMarkup()
-network_stats_update_markup.row(
-    types.InlineKeyboardButton(text=("Update"), callback_data="network_stats_update")
-)
+PLOT_PERIODS = [
+    ["5m", "10m", "30m", "1h", "3h"],
+    ["6h", "12h", "1d", "7d", "30d"],
+]
+SERVERS_PER_PAGE = 24
+
+# Inline buttons carry the index of their server in server_names() after an
+# "@", e.g. "cpuplot_30m@2"; buttons sent before fleet mode carry none
+def with_server(data: str, server: str) -> str:
+    return f"{data}@{server_names().index(server)}"
+
+def split_callback(data: str) -> tuple[str, str]:
+    data, _, index = data.partition('@')
+    names = server_names()
+    return data, names[int(index)] if index and int(index) < len(names) else default_server()
+
+@lru_cache(maxsize=None)
+def stats_update_markup(metric: str, server: str) -> types.InlineKeyboardMarkup:
+    markup = types.InlineKeyboardMarkup()
+    markup.row(
+        types.InlineKeyboardButton(text=("Update"), callback_data=with_server(f"{metric}_stats_update", server))
+    )
+    return markup
+
+@lru_cache(maxsize=None)
+def plot_markup(metric: str, server: str) -> types.InlineKeyboardMarkup:
+    markup = types.InlineKeyboardMarkup()
+    for periods in PLOT_PERIODS:
+        markup.row(*(
+            types.InlineKeyboardButton(text=period, callback_data=with_server(f"{metric}plot_{period}", server))
+            for period in periods
+        ))
+    return markup
+
+# One page of the server picker, with buttons to the pages around it
+def servers_markup(page: int = 0) -> types.InlineKeyboardMarkup:
+    names = server_names()
+    first = page * SERVERS_PER_PAGE
+
+    markup = types.InlineKeyboardMarkup(row_width=3)
+    markup.add(*(
+        types.InlineKeyboardButton(text=name, callback_data=f"server_{i}")
+        for i, name in enumerate(names[first:first + SERVERS_PER_PAGE], first)
+    ))
+
+    pages = []
+    if page > 0:
+        pages.append(types.InlineKeyboardButton(text="\u00AB", callback_data=f"servers_{page - 1}"))
+    if first + SERVERS_PER_PAGE < len(names):
+        pages.append(types.InlineKeyboardButton(text="\u00BB", callback_data=f"servers_{page + 1}"))
+    if pages:
+        markup.row(*pages)
+
+    return markup
+
+selected_servers: dict[int, str] = {}  # User id -> server their menus show
+
+def selected_server(user_id: int) -> str:
+    return selected_servers.get(user_id) or default_server()
+
+# Text such as a server name (from .env or the labels of the Hetzner API) set
+# in a Markdown message. Legacy Markdown has no escapes inside an entity, so
+# the text goes outside one with its special characters escaped.
+def escape_markdown(text: str) -> str:
+    return re.sub(r"([_*`\[])", r"\\\1", text)
+
+# Prefix naming the server of a message, only when there is more than one
+def server_title(server: str) -> str:
+    return f"\U0001F5A5 {escape_markdown(server)}\n" if FLEET_MODE else ""
+
+PLOT_FUNCTIONS = {
+    'cpu': save_cpu_plot,
+    'disk': save_disk_plot,
+    'network': save_network_plot,
+}
+
+METRIC_LABELS = {  # Column -> (label, unit) used in alerts
+    'cpu': ("CPU usage", "%"),
+    'iops_read': ("disk read IOPS", " iop/s"),
+    'iops_write': ("disk write IOPS", " iop/s"),
+    'bandwidth_read': ("disk read bandwidth", " B/s"),
+    'bandwidth_write': ("disk write bandwidth", " B/s"),
+    'pps_in': ("incoming packets", " packets/s"),
+    'pps_out': ("outgoing packets", " packets/s"),
+    'bandwidth_in': ("incoming bandwidth", " B/s"),
+    'bandwidth_out': ("outgoing bandwidth", " B/s"),
+}
+
+# Rendered plot (or the file_id of its first upload) for the window ending at
+# `end`, cached per step bucket so repeated requests skip fetch, render and upload
+def get_plot(
+    metric: str,
+    lookback_period_s: int,
+    end: datetime | None = None,
+    df: pd.DataFrame | None = None,
+    server: str | None = None
+) -> tuple[bytes | str, str, tuple]:
+    server = server or default_server()
+    step = lookback_period_s // MAX_METRICS_VALUES
+    end = end or datetime.now().astimezone()
+    key = (server, metric, lookback_period_s, int(end.timestamp()) // max(step, 1))
+
+    cached = plot_cache.get(key)
+    if cached is not None:
+        return cached.file_id or cached.image, cached.caption, key
+
+    start = end - timedelta(seconds=lookback_period_s)
+    # A frame from the monitor is at its step already, a finer fetched one
+    # gets wider rolling windows
+    scale = 1.0
+    if df is None:
+        fetch_step = max(lookback_period_s // PLOT_FETCH_VALUES, 1)
+        df = get_cache(server).get(metric, start, end, fetch_step)
+        scale = window_scale(lookback_period_s, fetch_step)
+    if metric == 'cpu':
+        with perf.span('analyze'):
+            df = analyze(df, 'cpu', scale)
+
+    # The cpu frame has its rolling columns from analyze() already, the other
+    # plots add theirs
+    kwargs = {} if metric == 'cpu' else {'scale': scale}
+    image = renderer.render(PLOT_FUNCTIONS[metric], df, **kwargs)
+    caption = f"*{start.strftime('%Y-%m-%d %H:%M')} -> {end.strftime('%Y-%m-%d %H:%M')}*"
+    plot_cache.put(key, image, caption)
+
+    return image, caption, key
+
+def remember_file_id(key: tuple, message: types.Message | bool) -> None:
+    if isinstance(message, types.Message) and message.photo:
+        plot_cache.set_file_id(key, message.photo[-1].file_id)
+
+def edit_plot_message(
+    call: types.CallbackQuery,
+    photo: bytes | str,
+    caption: str,
+    key: tuple,
+    markup: types.InlineKeyboardMarkup
+) -> None:
+    try:
+        with perf.span('upload'):
+            sent = bot.edit_message_media(
+                media=types.InputMediaPhoto(
+                    media=photo,
+                    caption=caption,
+                    parse_mode="Markdown"
+                ), 
+                chat_id=call.message.chat.id,
+                message_id=call.message.id,
+                reply_markup=markup
+            )
+    except telebot.apihelper.ApiTelegramException as e:
+        # Same cached plot pressed twice, nothing to update
+        if "message is not modified" in e.description:
+            return
+        raise
 
-cpu_plot_markup = types.InlineKeyboardMarkup()
-cpu_plot_markup.row(
-    types.InlineKeyboardButton(text="5m", callback_data="cpuplot_5m"),
-    types.InlineKeyboardButton(text="10m", callback_data="cpuplot_10m"),
-    types.InlineKeyboardButton(text="30m", callback_data="cpuplot_30m"),
-    types.InlineKeyboardButton(text="1h", callback_data="cpuplot_1h"),
-    types.InlineKeyboardButton(text="3h", callback_data="cpuplot_3h"),
-)
-cpu_plot_markup.row(
-    types.InlineKeyboardButton(text="6h", callback_data="cpuplot_6h"),
-    types.InlineKeyboardButton(text="12h", callback_data="cpuplot_12h"),
-    types.InlineKeyboardButton(text="1d", callback_data="cpuplot_1d"),
-    types.InlineKeyboardButton(text="7d", callback_data="cpuplot_7d"),
-    types.InlineKeyboardButton(text="30d", callback_data="cpuplot_30d"),
-)
+    remember_file_id(key, sent)
 
-disk_plot_markup = types.InlineKeyboardMarkup()
-disk_plot_markup.row(
-    types.InlineKeyboardButton(text="5m", callback_data="diskplot_5m"),
-    types.InlineKeyboardButton(text="10m", callback_data="diskplot_10m"),
-    types.InlineKeyboardButton(text="30m", callback_data="diskplot_30m"),
-    types.InlineKeyboardButton(text="1h", callback_data="diskplot_1h"),
-    types.InlineKeyboardButton(text="3h", callback_data="diskplot_3h"),
-)
-disk_plot_markup.row(
-    types.InlineKeyboardButton(text="6h", callback_data="diskplot_6h"),
-    types.InlineKeyboardButton(text="12h", callback_data="diskplot_12h"),
-    types.InlineKeyboardButton(text="1d", callback_data="diskplot_1d"),
-    types.InlineKeyboardButton(text="7d", callback_data="diskplot_7d"),
-    types.InlineKeyboardButton(text="30d", callback_data="diskplot_30d"),
-)
+RENDER_BUSY_TEXT = "Busy rendering other plots, try again in a moment."
 
-network_plot_markup = types.InlineKeyboardMarkup()
-network_plot_markup.row(
-    types.InlineKeyboardButton(text="5m", callback_data="networkplot_5m"),
-    types.InlineKeyboardButton(text="10m", callback_data="networkplot_10m"),
-    types.InlineKeyboardButton(text="30m", callback_data="networkplot_30m"),
-    types.InlineKeyboardButton(text="1h", callback_data="networkplot_1h"),
-    types.InlineKeyboardButton(text="3h", callback_data="networkplot_3h"),
-)
-network_plot_markup.row(
-    types.InlineKeyboardButton(text="6h", callback_data="networkplot_6h"),
-    types.InlineKeyboardButton(text="12h", callback_data="networkplot_12h"),
-    types.InlineKeyboardButton(text="1d", callback_data="networkplot_1d"),
-    types.InlineKeyboardButton(text="7d", callback_data="networkplot_7d"),
-    types.InlineKeyboardButton(text="30d", callback_data="networkplot_30d"),
-)
+# Plot handlers answer a full render queue instead of failing without a reply
+def reply_when_busy(fn: Callable) -> Callable:
+    @wraps(fn)
+    def wrapper(update: types.Message | types.CallbackQuery):
+        try:
+            return fn(update)
+        except RenderQueueFull:
+            if isinstance(update, types.CallbackQuery):
+                bot.answer_callback_query(update.id, RENDER_BUSY_TEXT)
+            else:
+                bot.send_message(update.chat.id, RENDER_BUSY_TEXT)
+    return wrapper
+
+# Seconds in a period such as "30m", "6h" or "7d"
+def parse_period(period: str) -> int:
+    p = period[-1]
+    n = int(period[:-1])
+    if p == "m": # case minutes
+        return n * 60
+    elif p == "h": # case hours
+        return n * 60 * 60
+    elif p == "d": # case days
+        return n * 24 * 60 * 60
+    raise ValueError(f"Unknown period {period}")
+
+# Lookback in seconds of a plot button, e.g. "cpuplot_30m"
+def lookback_from_callback(data: str) -> int:
+    return parse_period(data.partition('@')[0].split('_')[-1])
+
+EXPORT_USAGE = "Usage: /export <cpu|disk|network|all> <range, e.g. 6h or 7d> [csv|parquet]"
+
+EXPORT_BUSY_TEXT = "Too many exports queued, try again once they are done."
+MAX_PENDING_EXPORTS = 8  # Exports queued or running, without a memory budget
+
+export_jobs = ThreadPoolExecutor(1, thread_name_prefix="export_job")  # One export at a time
+# The executor's own queue is unbounded, so a slot is taken before a submit
+# and given back once the job is done
+export_slots = threading.BoundedSemaphore(MEMORY_CAPS.pending_exports if MEMORY_CAPS else MAX_PENDING_EXPORTS)
+
+# Fetch, write and send one export, then drop the file
+def run_export(
+    chat: int,
+    metric_types: list[MetricsType],
+    lookback_period_s: int,
+    format: ExportFormat,
+    server: str,
+    name: str
+) -> None:
+    end = datetime.now().astimezone()
+    fd, tmp = tempfile.mkstemp(suffix=EXPORT_SUFFIXES[format])
+    os.close(fd)
+    path = Path(tmp)
+
+    try:
+        with perf.span('export'):
+            rows = export_metrics(path, metric_types, end - timedelta(seconds=lookback_period_s), end, server, format)
+    except Exception as e:
+        logger.error(e)
+        path.unlink(missing_ok=True)
+        outbox.submit(chat, lambda: bot.send_message(chat, f"Export of {escape_markdown(name)} failed."))
+        return
+
+    def send() -> types.Message:
+        with path.open('rb') as f:
+            return bot.send_document(chat, f, caption=f"{server_title(server)}{rows} rows", visible_file_name=name)
+
+    outbox.submit(chat, send, lambda chat, message: path.unlink(missing_ok=True))
+
+# Parse an /export command and queue the export, return the reply
+def start_export(chat: int, text: str, server: str) -> str:
+    args = text.split()[1:]
+    if len(args) not in (2, 3) or (args[0] not in ALL_METRICS and args[0] != 'all'):
+        return EXPORT_USAGE
+
+    metric, period = args[0], args[1]
+    format = args[2] if len(args) == 3 else 'csv'
+    try:
+        lookback_period_s = parse_period(period)
+    except ValueError:
+        return EXPORT_USAGE
+    if format not in EXPORT_SUFFIXES or not 0 < lookback_period_s <= EXPORT_MAX_RANGE_S:
+        return EXPORT_USAGE
+
+    metric_types = ALL_METRICS if metric == 'all' else [metric]
+    name = f"{server}-{metric}-{period}{EXPORT_SUFFIXES[format]}"
+    if not export_slots.acquire(blocking=False):
+        perf.incr('export_rejected')
+        return EXPORT_BUSY_TEXT
+    job = export_jobs.submit(run_export, chat, metric_types, lookback_period_s, format, server, name)
+    job.add_done_callback(lambda job: export_slots.release())
+    return f"Exporting {metric} over the last {period}, the file follows."
 
 @bot.message_handler(commands=["start"])
+@perf.timed('handler.welcome_user')
 def welcome_user(message: types.Message):
-    if message.from_user.id == chat_id:
-        bot.send_message(chat_id, f"Hello, {message.from_user.full_name}!" ,reply_markup=menu_markup)
+    if is_allowed(message.chat.id):
+        bot.send_message(message.chat.id, f"Hello, {message.from_user.full_name}!" ,reply_markup=menu_markup)
+
+# Admin only: stage latencies and counters since startup
+@bot.message_handler(commands=["perf"])
+def perf_report(message: types.Message):
+    if message.chat.id == chat_id:
+        bot.send_message(chat_id, perf.report())
+
+def memory_sizes() -> dict[str, str]:
+    return {
+        'plot_cache': format_bytes(plot_cache.size),
+        'metrics_caches': format_bytes(sum(cache.size for cache in list(stats_caches.values()))),
+        'outbox': f"{outbox.queued} messages",
+    }
+
+# "/memory trace" starts tracing allocations (which slows the bot down) and
+# "/memory stop" stops it, "/memory" reports, per subsystem when tracing
+def memory_command(text: str) -> str:
+    arg = text.split()[1] if len(text.split()) > 1 else ""
+    if arg == "stop":
+        memory_tracker.stop()
+        return "Allocations are no longer traced."
+    if arg == "trace":
+        memory_tracker.start()
+    return memory_tracker.report(memory_sizes(), MEMORY_BUDGET_MB)
+
+# Admin only: RSS, cache sizes and tracemalloc snapshots
+@bot.message_handler(commands=["memory"])
+def memory_report(message: types.Message):
+    if message.chat.id == chat_id:
+        bot.send_message(chat_id, memory_command(message.text))
+
+# Over the memory budget, empty the caches and hand the freed memory back
+def enforce_memory_budget() -> None:
+    metrics_caches = list(stats_caches.values())
+    if not MEMORY_BUDGET_MB or rss_bytes() <= MEMORY_BUDGET_MB * 1024 * 1024 or \
+       plot_cache.size + sum(cache.size for cache in metrics_caches) == 0:
+        return
+
+    plot_cache.clear()
+    for cache in metrics_caches:
+        cache.clear()
+    release_memory()
+    perf.incr('memory_sheds')
+    logger.warning(f"Over the {MEMORY_BUDGET_MB} MiB memory budget, caches emptied, RSS now {format_bytes(rss_bytes())}")
+
+@bot.message_handler(commands=["subscribe"])
+@perf.timed('handler.subscribe')
+def subscribe(message: types.Message):
+    if is_allowed(message.chat.id):
+        subscribers.subscribe(message.chat.id)
+        bot.send_message(message.chat.id, "Alerts will be sent to this chat, /unsubscribe to stop them.")
+
+@bot.message_handler(commands=["unsubscribe"])
+@perf.timed('handler.unsubscribe')
+def unsubscribe(message: types.Message):
+    if is_allowed(message.chat.id):
+        subscribers.unsubscribe(message.chat.id)
+        bot.send_message(message.chat.id, "Alerts will no longer be sent to this chat, /subscribe to get them again.")
+
+@bot.message_handler(commands=["export"])
+@perf.timed('handler.export')
+def export(message: types.Message):
+    if is_allowed(message.chat.id):
+        server = selected_server(message.from_user.id)
+        bot.send_message(message.chat.id, start_export(message.chat.id, message.text, server))
+
+# Fleet mode: pick the server the menus show
+@bot.message_handler(commands=["servers"])
+@bot.message_handler(func=lambda message: message.text == server_cmd)
+@perf.timed('handler.servers')
+def servers(message: types.Message):
+    if is_allowed(message.chat.id):
+        server = selected_server(message.from_user.id)
+        page = server_names().index(server) // SERVERS_PER_PAGE
+        bot.send_message(message.chat.id, f"*Server:* {escape_markdown(server)}", reply_markup=servers_markup(page))
+
+@bot.callback_query_handler(func=lambda call: isinstance(call.data, str) and call.data.startswith('servers_'))
+@perf.timed('handler.servers_page')
+def servers_page(call: types.CallbackQuery):
+    if is_allowed(call.message.chat.id):
+        page = int(call.data.split('_')[-1])
+        bot.edit_message_reply_markup(call.message.chat.id, call.message.id, reply_markup=servers_markup(page))
+
+@bot.callback_query_handler(func=lambda call: isinstance(call.data, str) and call.data.startswith('server_'))
+@perf.timed('handler.select_server')
+def select_server(call: types.CallbackQuery):
+    if is_allowed(call.message.chat.id):
+        server = server_names()[int(call.data.split('_')[-1])]
+        selected_servers[call.from_user.id] = server
+        bot.edit_message_text(f"*Server:* {escape_markdown(server)}", call.message.chat.id, call.message.id)
 
 @bot.message_handler(func=lambda message: message.text == menu_cmd)
+@perf.timed('handler.main_menu')
 def main_menu(message: types.Message):
-    if message.from_user.id == chat_id:
-        bot.send_message(chat_id, f"Main menu:" ,reply_markup=menu_markup)
+    if is_allowed(message.chat.id):
+        bot.send_message(message.chat.id, f"Main menu:" ,reply_markup=menu_markup)
 
 
 @bot.message_handler(func=lambda message: message.text == cpu_cmd)
+@perf.timed('handler.command_cpu')
 def command_cpu(message: types.Message):
-    if message.from_user.id == chat_id:
-        bot.send_chat_action(message.from_user.id, action="typing")
+    if is_allowed(message.chat.id):
+        bot.send_chat_action(message.chat.id, action="typing")
+        server = selected_server(message.from_user.id)
         
-        text = get_cpu_stats_text()
+        text = server_title(server) + get_cpu_stats_text(server=server)
         
-        bot.send_message(message.from_user.id, text=text, reply_markup=cpu_stats_update_markup)
-        bot.send_message(message.from_user.id, text="Cpu menu", reply_markup=cpu_stats_menu_markup)
+        bot.send_message(message.chat.id, text=text, reply_markup=stats_update_markup('cpu', server))
+        bot.send_message(message.chat.id, text="Cpu menu", reply_markup=cpu_stats_menu_markup)
 
 @bot.message_handler(func=lambda message: message.text == disk_cmd)
+@perf.timed('handler.command_disk')
 def command_disk(message: types.Message):
-    if message.from_user.id == chat_id:
-        bot.send_chat_action(message.from_user.id, action="typing")
+    if is_allowed(message.chat.id):
+        bot.send_chat_action(message.chat.id, action="typing")
+        server = selected_server(message.from_user.id)
         
-        text = get_disk_stats_text()
+        text = server_title(server) + get_disk_stats_text(server=server)
         
-        bot.send_message(message.from_user.id, text=text, reply_markup=disk_stats_update_markup)
-        bot.send_message(message.from_user.id, text="Disk menu", reply_markup=disk_stats_menu_markup)
+        bot.send_message(message.chat.id, text=text, reply_markup=stats_update_markup('disk', server))
+        bot.send_message(message.chat.id, text="Disk menu", reply_markup=disk_stats_menu_markup)
 
 @bot.message_handler(func=lambda message: message.text == network_cmd)
+@perf.timed('handler.command_network')
 def command_network(message: types.Message):
-    if message.from_user.id == chat_id:
-        bot.send_chat_action(message.from_user.id, action="typing")
+    if is_allowed(message.chat.id):
+        bot.send_chat_action(message.chat.id, action="typing")
+        server = selected_server(message.from_user.id)
         
-        text = get_network_stats_text()
+        text = server_title(server) + get_network_stats_text(server=server)
         
-        bot.send_message(message.from_user.id, text=text, reply_markup=network_stats_update_markup)
-        bot.send_message(message.from_user.id, text="Network menu", reply_markup=network_stats_menu_markup)
+        bot.send_message(message.chat.id, text=text, reply_markup=stats_update_markup('network', server))
+        bot.send_message(message.chat.id, text="Network menu", reply_markup=network_stats_menu_markup)
 
-@bot.callback_query_handler(func=lambda call: call.data == "cpu_stats_update")
+@bot.callback_query_handler(func=lambda call: isinstance(call.data, str) and call.data.partition('@')[0] == "cpu_stats_update")
+@perf.timed('handler.cpu_stats_update')
 def cpu_stats_update(call: types.CallbackQuery):
-    if call.from_user.id == chat_id:
-        text = get_cpu_stats_text()
+    if is_allowed(call.message.chat.id):
+        _, server = split_callback(call.data)
+        text = server_title(server) + get_cpu_stats_text(server=server)
 
-        bot.edit_message_text(text, call.from_user.id, call.message.id, reply_markup=cpu_stats_update_markup)
+        bot.edit_message_text(text, call.message.chat.id, call.message.id, reply_markup=stats_update_markup('cpu', server))
 
-@bot.callback_query_handler(func=lambda call: call.data == "disk_stats_update")
+@bot.callback_query_handler(func=lambda call: isinstance(call.data, str) and call.data.partition('@')[0] == "disk_stats_update")
+@perf.timed('handler.disk_stats_update')
 def disk_stats_update(call: types.CallbackQuery):
-    if call.from_user.id == chat_id:
-        text = get_disk_stats_text()
+    if is_allowed(call.message.chat.id):
+        _, server = split_callback(call.data)
+        text = server_title(server) + get_disk_stats_text(server=server)
 
-        bot.edit_message_text(text, call.from_user.id, call.message.id, reply_markup=disk_stats_update_markup)
+        bot.edit_message_text(text, call.message.chat.id, call.message.id, reply_markup=stats_update_markup('disk', server))
 
-@bot.callback_query_handler(func=lambda call: call.data == "network_stats_update")
+@bot.callback_query_handler(func=lambda call: isinstance(call.data, str) and call.data.partition('@')[0] == "network_stats_update")
+@perf.timed('handler.network_stats_update')
 def network_stats_update(call: types.CallbackQuery):
-    if call.from_user.id == chat_id:
-        text = get_network_stats_text()
+    if is_allowed(call.message.chat.id):
+        _, server = split_callback(call.data)
+        text = server_title(server) + get_network_stats_text(server=server)
 
-        bot.edit_message_text(text, call.from_user.id, call.message.id, reply_markup=network_stats_update_markup)
+        bot.edit_message_text(text, call.message.chat.id, call.message.id, reply_markup=stats_update_markup('network', server))
 
 @bot.message_handler(func=lambda message: message.text == cpu_plot_cmd)
+@perf.timed('handler.cpu_plot')
+@reply_when_busy
 def cpu_plot(message: types.Message):
-    if message.from_user.id == chat_id:
-        bot.send_chat_action(message.from_user.id, "upload_photo")
+    if is_allowed(message.chat.id):
+        bot.send_chat_action(message.chat.id, "upload_photo")
         lookback_period_s = 30 * 60 # 30 minutes default
-        step = lookback_period_s // MAX_METRICS_VALUES
-        end = datetime.now().astimezone()
-        start = end - timedelta(seconds=lookback_period_s)
-
-        load = analyze(
-            get_stats('cpu', start, end, step),
-            'cpu'
-        )
-
-        save_cpu_plot(tmp / CPU_PLOT_FILENAME, load)
-        with open(tmp / CPU_PLOT_FILENAME, 'rb') as image:
-            bot.send_photo(
-                chat_id=message.from_user.id,
-                photo=image,
-                caption=f"*{start.strftime('%Y-%m-%d %H:%M')} -> {end.strftime('%Y-%m-%d %H:%M')}*",
-                reply_markup=cpu_plot_markup
+        server = selected_server(message.from_user.id)
+
+        photo, caption, key = get_plot('cpu', lookback_period_s, server=server)
+        with perf.span('upload'):
+            sent = bot.send_photo(
+                chat_id=message.chat.id,
+                photo=photo,
+                caption=server_title(server) + caption,
+                reply_markup=plot_markup('cpu', server)
             )
+        remember_file_id(key, sent)
 
 @bot.message_handler(func=lambda message: message.text == disk_plot_cmd)
+@perf.timed('handler.disk_plot')
+@reply_when_busy
 def disk_plot(message: types.Message):
-    if message.from_user.id == chat_id:
-        bot.send_chat_action(message.from_user.id, "upload_photo")
+    if is_allowed(message.chat.id):
+        bot.send_chat_action(message.chat.id, "upload_photo")
         lookback_period_s = 30 * 60 # 30 minutes default
-        step = lookback_period_s // MAX_METRICS_VALUES
-        end = datetime.now().astimezone()
-        start = end - timedelta(seconds=lookback_period_s)
-
-        df = get_stats('disk', start, end, step)
-
-        save_disk_plot(tmp / DISK_PLOT_FILENAME, df)
-        with open(tmp / DISK_PLOT_FILENAME, 'rb') as image:
-            bot.send_photo(
-                chat_id=message.from_user.id,
-                photo=image,
-                caption=f"*{start.strftime('%Y-%m-%d %H:%M')} -> {end.strftime('%Y-%m-%d %H:%M')}*",
-                reply_markup=disk_plot_markup
+        server = selected_server(message.from_user.id)
+
+        photo, caption, key = get_plot('disk', lookback_period_s, server=server)
+        with perf.span('upload'):
+            sent = bot.send_photo(
+                chat_id=message.chat.id,
+                photo=photo,
+                caption=server_title(server) + caption,
+                reply_markup=plot_markup('disk', server)
             )
+        remember_file_id(key, sent)
 
 @bot.message_handler(func=lambda message: message.text == network_plot_cmd)
+@perf.timed('handler.network_plot')
+@reply_when_busy
 def network_plot(message: types.Message):
-    if message.from_user.id == chat_id:
-        bot.send_chat_action(message.from_user.id, "upload_photo")
+    if is_allowed(message.chat.id):
+        bot.send_chat_action(message.chat.id, "upload_photo")
         lookback_period_s = 30 * 60 # 30 minutes default
-        step = lookback_period_s // MAX_METRICS_VALUES
-        end = datetime.now().astimezone()
-        start = end - timedelta(seconds=lookback_period_s)
-
-        df = get_stats('network', start, end, step)
-
-        save_network_plot(tmp / NETWORK_PLOT_FILENAME, df)
-        with open(tmp / NETWORK_PLOT_FILENAME, 'rb') as image:
-            bot.send_photo(
-                chat_id=message.from_user.id,
-                photo=image,
-                caption=f"*{start.strftime('%Y-%m-%d %H:%M')} -> {end.strftime('%Y-%m-%d %H:%M')}*",
-                reply_markup=network_plot_markup
+        server = selected_server(message.from_user.id)
+
+        photo, caption, key = get_plot('network', lookback_period_s, server=server)
+        with perf.span('upload'):
+            sent = bot.send_photo(
+                chat_id=message.chat.id,
+                photo=photo,
+                caption=server_title(server) + caption,
+                reply_markup=plot_markup('network', server)
             )
+        remember_file_id(key, sent)
 
 @bot.callback_query_handler(func=lambda call: isinstance(call.data, str) and call.data.startswith('cpuplot_'))
+@perf.timed('handler.cpu_plot_update')
+@reply_when_busy
 def cpu_plot_update(call: types.CallbackQuery):
-    if call.from_user.id == chat_id:
-        bot.send_chat_action(call.from_user.id, "upload_photo")
-
-        p = call.data[-1]
-        n = int(call.data.split('_')[-1][:-1])
-        if p == "m": # case minutes
-            lookback_period_s = n * 60
-        elif p == "h": # case hours
-            lookback_period_s = n * 60 * 60
-        elif p == "d": # case days
-            lookback_period_s = n * 24 * 60 * 60
-        
-        step = lookback_period_s // MAX_METRICS_VALUES
-        end = datetime.now().astimezone()
-        start = end - timedelta(seconds=lookback_period_s)
+    if is_allowed(call.message.chat.id):
+        bot.send_chat_action(call.message.chat.id, "upload_photo")
 
-        load = analyze(
-            get_stats('cpu', start, end, step),
-            'cpu'
-        )
+        _, server = split_callback(call.data)
+        lookback_period_s = lookback_from_callback(call.data)
 
-        save_cpu_plot(tmp / CPU_PLOT_FILENAME, load)
-        with open(tmp / CPU_PLOT_FILENAME, 'rb') as image:
-            bot.edit_message_media(
-                media=types.InputMediaPhoto(
-                    media=image,
-                    caption=f"*{start.strftime('%Y-%m-%d %H:%M')} -> {end.strftime('%Y-%m-%d %H:%M')}*",
-                    parse_mode="Markdown"
-                ), 
-                chat_id=call.from_user.id, 
-                message_id=call.message.id,
-                reply_markup=cpu_plot_markup
-            )
+        photo, caption, key = get_plot('cpu', lookback_period_s, server=server)
+        edit_plot_message(call, photo, server_title(server) + caption, key, plot_markup('cpu', server))
 
 @bot.callback_query_handler(func=lambda call: isinstance(call.data, str) and call.data.startswith('diskplot_'))
+@perf.timed('handler.disk_plot_update')
+@reply_when_busy
 def disk_plot_update(call: types.CallbackQuery):
-    if call.from_user.id == chat_id:
-        bot.send_chat_action(call.from_user.id, "upload_photo")
-
-        p = call.data[-1]
-        n = int(call.data.split('_')[-1][:-1])
-        if p == "m": # case minutes
-            lookback_period_s = n * 60
-        elif p == "h": # case hours
-            lookback_period_s = n * 60 * 60
-        elif p == "d": # case days
-            lookback_period_s = n * 24 * 60 * 60
-        
-        step = lookback_period_s // MAX_METRICS_VALUES
-        end = datetime.now().astimezone()
-        start = end - timedelta(seconds=lookback_period_s)
+    if is_allowed(call.message.chat.id):
+        bot.send_chat_action(call.message.chat.id, "upload_photo")
 
-        df =  get_stats('disk', start, end, step)
+        _, server = split_callback(call.data)
+        lookback_period_s = lookback_from_callback(call.data)
 
-        save_disk_plot(tmp / DISK_PLOT_FILENAME, df)
-        with open(tmp / DISK_PLOT_FILENAME, 'rb') as image:
-            bot.edit_message_media(
-                media=types.InputMediaPhoto(
-                    media=image,
-                    caption=f"*{start.strftime('%Y-%m-%d %H:%M')} -> {end.strftime('%Y-%m-%d %H:%M')}*",
-                    parse_mode="Markdown"
-                ), 
-                chat_id=call.from_user.id, 
-                message_id=call.message.id,
-                reply_markup=disk_plot_markup
-            )
+        photo, caption, key = get_plot('disk', lookback_period_s, server=server)
+        edit_plot_message(call, photo, server_title(server) + caption, key, plot_markup('disk', server))
 
 @bot.callback_query_handler(func=lambda call: isinstance(call.data, str) and call.data.startswith('networkplot_'))
+@perf.timed('handler.network_plot_update')
+@reply_when_busy
 def network_plot_update(call: types.CallbackQuery):
-    if call.from_user.id == chat_id:
-        bot.send_chat_action(call.from_user.id, "upload_photo")
-
-        p = call.data[-1]
-        n = int(call.data.split('_')[-1][:-1])
-        if p == "m": # case minutes
-            lookback_period_s = n * 60
-        elif p == "h": # case hours
-            lookback_period_s = n * 60 * 60
-        elif p == "d": # case days
-            lookback_period_s = n * 24 * 60 * 60
-        
-        step = lookback_period_s // MAX_METRICS_VALUES
-        end = datetime.now().astimezone()
-        start = end - timedelta(seconds=lookback_period_s)
-
-        df =  get_stats('network', start, end, step)
+    if is_allowed(call.message.chat.id):
+        bot.send_chat_action(call.message.chat.id, "upload_photo")
+
+        _, server = split_callback(call.data)
+        lookback_period_s = lookback_from_callback(call.data)
+
+        photo, caption, key = get_plot('network', lookback_period_s, server=server)
+        edit_plot_message(call, photo, server_title(server) + caption, key, plot_markup('network', server))
+
+def sleep_wait_run(seconds: float):
+    deadline = time.monotonic() + seconds
+    while RUNNING and time.monotonic() < deadline:
+        time.sleep(min(1, max(deadline - time.monotonic(), 0)))
+
+# Alerts are tracked per server and metric type
+def alert_key(server: str, metric: str) -> str:
+    return f"{server}/{metric}"
+
+def alert_header(server: str, metric: str, action: AlertAction) -> str:
+    alert = alert_manager.alerts[alert_key(server, metric)]
+    firing_for = round((time.monotonic() - alert.fired_at) / 60)
+
+    if action == 'resolve':
+        return f"{server_title(server)}\u2705 Resolved after {firing_for} min, last anomaly:"
+    return f"{server_title(server)}\U0001F525 Firing for {firing_for} min:"
+
+# Queue the alert message updates for every subscriber, the plot is rendered
+# once and uploaded once, the delivery itself never blocks the monitor
+def send_alert(
+    server: str,
+    metric: str,
+    action: AlertAction,
+    lookback_period_s: int,
+    end: datetime,
+    df: pd.DataFrame
+) -> None:
+    alert = alert_manager.alerts[alert_key(server, metric)]
+    header = alert_header(server, metric, action)
+    markup = plot_markup(metric, server)
+    message_ids = alert.message_ids
+
+    # Only the caption changes between renders
+    if action == 'update':
+        caption = f"{header}\n{alert.text}\n{alert.range_caption}"
+
+        def edit_caption(chat: int) -> types.Message | bool | None:
+            if chat not in message_ids:
+                return None
+            return bot.edit_message_caption(
+                caption=caption,
+                chat_id=chat,
+                message_id=message_ids[chat],
+                reply_markup=markup
+            )
 
-        save_network_plot(tmp / NETWORK_PLOT_FILENAME, df)
-        with open(tmp / NETWORK_PLOT_FILENAME, 'rb') as image:
-            bot.edit_message_media(
+        for chat in subscribers.chats():
+            outbox.submit(chat, partial(edit_caption, chat))
+        return
+
+    photo, range_caption, key = get_plot(metric, lookback_period_s, end, df, server)
+    alert.range_caption = range_caption
+    caption = f"{header}\n{alert.text}\n{range_caption}"
+
+    if action == 'fire':
+        def send(chat: int, photo: bytes | str) -> types.Message:
+            return bot.send_photo(
+                chat_id=chat,
+                photo=photo,
+                caption=caption,
+                reply_markup=markup
+            )
+    else:
+        def send(chat: int, photo: bytes | str) -> types.Message | bool | None:
+            # Sent before this chat subscribed, or still queued
+            if chat not in message_ids:
+                return None
+            return bot.edit_message_media(
                 media=types.InputMediaPhoto(
-                    media=image,
-                    caption=f"*{start.strftime('%Y-%m-%d %H:%M')} -> {end.strftime('%Y-%m-%d %H:%M')}*",
+                    media=photo,
+                    caption=caption,
                     parse_mode="Markdown"
-                ), 
-                chat_id=call.from_user.id, 
-                message_id=call.message.id,
-                reply_markup=network_plot_markup
+                ),
+                chat_id=chat,
+                message_id=message_ids[chat],
+                reply_markup=markup
             )
 
-def sleep_wait_run():
-    i = 0
-    while RUNNING and i < CHECK_INTERVAL_S:
-        time.sleep(1)
-        i += 1
+    def sent(chat: int, message: types.Message | bool | None) -> None:
+        if action == 'fire' and isinstance(message, types.Message):
+            message_ids[chat] = message.message_id
+        remember_file_id(key, message)
+
+    outbox.broadcast_photo(subscribers.chats(), photo, send, sent)
+
+MONITOR_COLUMNS = [col_name for metric in ALL_METRICS for col_name in METRIC_COLUMNS[metric]]
+
+# Interval limits and API budget of the monitor can be tuned in .env
+monitor_pacer = MonitorPacer(**{
+    arg: int(config[name]) for arg, name in (
+        ('min_interval_s', "MONITOR_MIN_INTERVAL_S"),
+        ('max_interval_s', "MONITOR_MAX_INTERVAL_S"),
+        ('calls_per_hour', "MONITOR_CALLS_PER_HOUR"),
+        ('min_step', "MONITOR_MIN_STEP"),
+    ) if config.get(name)
+})
+
+perf.gauge('monitor_interval_s', lambda: monitor_pacer.interval_s)
+
+# Check for anomalies in the most recent data point of `server`, one alert per
+# metric type, return the alert actions to carry out
+def check_alerts(latest_point: dict[str, np.ndarray], server: str) -> list[tuple[str, AlertAction]]:
+    cpu = MONITOR_COLUMNS.index('cpu')
+    logger.info(f"{server} load: current {round(latest_point['value'][cpu], 2)}%, Z-score: {round(latest_point['z_score'][cpu], 2)}")
+
+    actions = []
+    for metric in ALL_METRICS:
+        anomalies = []
+        for col_name in METRIC_COLUMNS[metric]:
+            i = MONITOR_COLUMNS.index(col_name)
+            label, unit = METRIC_LABELS[col_name]
+
+            if latest_point['is_high_anomaly'][i]:
+                anomaly_type = f"High {label} spike"
+            elif latest_point['is_low_anomaly'][i]:
+                anomaly_type = f"Low {label}"
+            elif latest_point['is_sustained_anomaly'][i]:
+                anomaly_type = f"Sustained unusual {label}"
+            else:
+                continue
 
-def monitor_cpu():
-    lookback_period_s = 2000
-    step = lookback_period_s // MAX_METRICS_VALUES
+            logger.warning(f"{server}: {anomaly_type} detected!")
+            anomalies.append(
+                f"{anomaly_type} detected! Current: {round(latest_point['value'][i], 2)}{unit}, " + \
+                f"Z-score: {round(latest_point['z_score'][i], 2)}"
+            )
+
+        indices = [MONITOR_COLUMNS.index(col_name) for col_name in METRIC_COLUMNS[metric]]
+        z_scores = np.abs(latest_point['z_score'][indices])
+        max_abs_z = np.nanmax(z_scores) if not np.isnan(z_scores).all() else 0.0
+
+        action = alert_manager.update(alert_key(server, metric), anomalies, max_abs_z)
+        if action is not None:
+            perf.incr(f'alerts_{action}')
+            actions.append((metric, action))
+
+    return actions
+
+# Next check interval from the newest point of every column of every server
+def pace_monitor(latest_points: list[dict[str, np.ndarray]]) -> None:
+    abs_z = np.abs(np.concatenate([point['z_score'] for point in latest_points]))
+    mean_abs_z = np.concatenate([point['mean_abs_z'] for point in latest_points])
+    monitor_pacer.update(
+        np.nanmax(abs_z) if not np.isnan(abs_z).all() else 0.0,
+        np.nanmax(mean_abs_z) if not np.isnan(mean_abs_z).all() else 0.0
+    )
+
+def monitor():
+    detectors: dict[str, StreamingDetector] = {}
+    step = monitor_pacer.step
 
     while RUNNING:
         end = datetime.now().astimezone()
-        start = end - timedelta(seconds=lookback_period_s)
+
+        # Windows at another step are not comparable, restart from the new one
+        if monitor_pacer.step != step:
+            step = monitor_pacer.step
+            for detector in detectors.values():
+                detector.reset()
 
         try:
-            load = get_stats('cpu', start, end, step)
-            load = analyze(load, "cpu")
+            for server in server_names():
+                if server not in detectors:
+                    detectors[server] = new_detector(server, MONITOR_COLUMNS)
         except Exception as e:
             logger.error(e)
-            sleep_wait_run()
+            sleep_wait_run(monitor_pacer.next_delay())
             continue
-        
-        # Check for anomalies in the most recent data point
-        latest_point = load.iloc[-1]
-        is_high_anomaly = latest_point['is_high_anomaly']
-        is_low_anomaly = latest_point['is_low_anomaly']
-        is_sustained_anomaly = latest_point['is_sustained_anomaly']
-
-        logger.info(f"Load: current {round(latest_point['cpu'], 2)}%, Z-score: {round(latest_point['z_score'], 2)}")
-
-        if is_high_anomaly or is_low_anomaly or is_sustained_anomaly:
-            if is_high_anomaly:
-                anomaly_type = "High CPU usage spike"
-            elif is_low_anomaly:
-                anomaly_type = "Low CPU usage"
-            else:
-                anomaly_type = "Sustained unusual behavior"
-            
-            logger.warning(f"{anomaly_type} detected in CPU usage!")
-
-            save_cpu_plot(tmp / CPU_PLOT_FILENAME, load)
-
-            with open(tmp / CPU_PLOT_FILENAME, 'rb') as photo:
-                bot.send_photo(
-                    chat_id=chat_id,
-                    photo=photo,
-                    caption=f"{anomaly_type} detected! Current load: {round(latest_point['cpu'], 2)}%, Z-score: {round(latest_point['z_score'], 2)}\n" + \
-                            f"*{start.strftime('%Y-%m-%d %H:%M')} -> {end.strftime('%Y-%m-%d %H:%M')}*",
-                    reply_markup=cpu_plot_markup
-                )
-
-        sleep_wait_run()
+
+        monitor_pacer.record_call(calls=len(detectors))
+        latest_points = []
+
+        for server, result in poll_fleet(detectors, end, step).items():
+            if isinstance(result, Exception):
+                logger.error(f"{server}: {result}")
+                detectors[server].reset()
+                continue
+
+            # No new data point since the last check
+            load, latest_point = result
+            if latest_point is None:
+                continue
+            latest_points.append(latest_point)
+
+            for metric, action in check_alerts(latest_point, server):
+                try:
+                    with perf.span('monitor.alert'):
+                        send_alert(server, metric, action, step * MAX_METRICS_VALUES, end, load)
+                except Exception as e:
+                    logger.error(e)
+
+        if latest_points:
+            pace_monitor(latest_points)
+        enforce_memory_budget()
+        sleep_wait_run(monitor_pacer.next_delay())
     
     logger.info(f"{threading.current_thread().name} closed!")
 
@@ -428,12 +860,48 @@ def sigint_handler(signum, frame):
     RUNNING = False
     logger.info("Exiting program...")
     bot.stop_bot()
-    plt.close('all')
+    renderer.shutdown()
+    stop_building.set()
+    baseline_builds.shutdown(wait=False, cancel_futures=True)
 
 if __name__ == "__main__":
     signal.signal(signal.SIGINT, sigint_handler)
 
-    monitor_cpu_thread = threading.Thread(name="monitor_cpu", target=monitor_cpu)
-    monitor_cpu_thread.start()
-
-    bot.infinity_polling()
\ No newline at end of file
+    # The Hetzner server is only resolved on the first metrics request
+    logger.info(
+        f"Started in {(time.perf_counter() - STARTED_AT) * 1000:.0f} ms "
+        f"(imports {(IMPORTS_DONE_AT - STARTED_AT) * 1000:.0f} ms, "
+        f"setup {(time.perf_counter() - IMPORTS_DONE_AT) * 1000:.0f} ms)"
+    )
+
+    # Optional Prometheus endpoint, bound to localhost only
+    if config.get("PERF_PORT"):
+        perf.serve_metrics(int(config["PERF_PORT"]))
+        logger.info(f"Serving metrics on http://127.0.0.1:{config['PERF_PORT']}/metrics")
+
+    outbox.start()
+    monitor_thread = threading.Thread(name="monitor", target=monitor)
+    monitor_thread.start()
+
+    if WEBHOOK_MODE:
+        from webhook import WebhookServer
+
+        webhook_server = WebhookServer(
+            bot,
+            secret_token=config["WEBHOOK_SECRET"],
+            host=config.get("WEBHOOK_HOST", "127.0.0.1"),
+            port=int(config.get("WEBHOOK_PORT", 8080)),
+            path=urlparse(config["WEBHOOK_URL"]).path or "/"
+        )
+        webhook_server.start()
+        bot.set_webhook(url=config["WEBHOOK_URL"], secret_token=config["WEBHOOK_SECRET"])
+        logger.info(f"Receiving updates on {webhook_server.address}")
+
+        # Ends on SIGINT, once the monitor has stopped
+        monitor_thread.join()
+        bot.remove_webhook()
+        webhook_server.stop()
+    else:
+        bot.infinity_polling()
+
+    outbox.stop(timeout=OUTBOX_FLUSH_S)
\ No newline at end of file
@@ -0,0 +1,173 @@
+from __future__ import annotations
+
+from datetime import datetime, timedelta
+from collections import OrderedDict
+from dataclasses import dataclass
+from threading import Lock
+from typing import Callable, TYPE_CHECKING
+import time
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+
+MAX_CACHED_SERIES = 32  # Number of (type, step) series kept before LRU eviction
+MAX_CACHED_POINTS = 5000  # Points kept per series, oldest are dropped first
+
+
+class MetricsCache:
+    def __init__(
+        self,
+        fetch: Callable[[str | list[str], datetime, datetime, int | None], pd.DataFrame],
+        max_series: int = MAX_CACHED_SERIES,
+        max_points: int = MAX_CACHED_POINTS,
+        max_bytes: int | None = None
+    ) -> None:
+        self.fetch = fetch
+        self.max_series = max_series
+        self.max_points = max_points
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.deltas = 0  # Served from the cache plus a fetch of the newer points
+        self.misses = 0
+        self._series: OrderedDict[tuple[str, int], pd.DataFrame] = OrderedDict()
+        self._sizes: dict[tuple[str, int], int] = {}
+        self._size = 0
+        self._lock = Lock()
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def _pop(self, key: tuple[str, int]) -> None:
+        del self._series[key]
+        self._size -= self._sizes.pop(key)
+
+    def get(
+        self,
+        type: str | list[str],
+        start: datetime,
+        end: datetime,
+        step: int | None = None
+    ) -> pd.DataFrame:
+        # Without a fixed step the API picks the resolution from the range,
+        # so deltas would not line up with what is cached
+        if step is None:
+            return self.fetch(type, start, end, step)
+
+        key = (','.join(type) if isinstance(type, list) else type, step)
+        with self._lock:
+            cached = self._series.get(key)
+
+        # A tail older than `start` would make the delta longer than the
+        # window itself, the window alone is cheaper
+        if cached is None or cached.empty or \
+           cached['datetime'].iloc[0] > start + timedelta(seconds=step) or \
+           cached['datetime'].iloc[-1] < start:
+            df = self.fetch(type, start, end, step)
+            with self._lock:
+                self.misses += 1
+        elif cached['datetime'].iloc[-1] + timedelta(seconds=step) > end:
+            df = cached
+            with self._lock:
+                self.hits += 1
+        else:
+            import pandas as pd
+
+            # Re-fetch the last cached bucket too, it may have been incomplete
+            last = cached['datetime'].iloc[-1]
+            delta = self.fetch(type, last.to_pydatetime(), end, step)
+            df = pd.concat([cached[cached['datetime'] < last], delta], ignore_index=True)
+            df = df.drop_duplicates('datetime', keep='last').sort_values('datetime')
+            with self._lock:
+                self.deltas += 1
+
+        df = df.tail(self.max_points).reset_index(drop=True)
+
+        with self._lock:
+            if key in self._series:
+                self._pop(key)
+            self._series[key] = df
+            self._sizes[key] = int(df.memory_usage().sum())
+            self._size += self._sizes[key]
+            while len(self._series) > self.max_series or \
+                  (self.max_bytes is not None and self._size > self.max_bytes and len(self._series) > 1):
+                self._pop(next(iter(self._series)))
+
+        window = df[(df['datetime'] >= start) & (df['datetime'] <= end)]
+        return window.reset_index(drop=True)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._series.clear()
+            self._sizes.clear()
+            self._size = 0
+
+
+PLOT_CACHE_TTL_S = 10 * 60
+PLOT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+
+@dataclass
+class CachedPlot:
+    image: bytes
+    caption: str
+    expires: float
+    file_id: str | None = None
+
+
+class PlotCache:
+    def __init__(self, ttl_s: float = PLOT_CACHE_TTL_S, max_bytes: int = PLOT_CACHE_MAX_BYTES) -> None:
+        self.ttl_s = ttl_s
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._plots: OrderedDict[tuple, CachedPlot] = OrderedDict()
+        self._size = 0
+        self._lock = Lock()
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def _pop(self, key: tuple) -> None:
+        self._size -= len(self._plots.pop(key).image)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._plots.clear()
+            self._size = 0
+
+    def get(self, key: tuple) -> CachedPlot | None:
+        with self._lock:
+            plot = self._plots.get(key)
+            if plot is not None and plot.expires < time.monotonic():
+                self._pop(key)
+                plot = None
+
+            if plot is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._plots.move_to_end(key)
+            return plot
+
+    def put(self, key: tuple, image: bytes, caption: str) -> None:
+        with self._lock:
+            if key in self._plots:
+                self._pop(key)
+            self._plots[key] = CachedPlot(image, caption, time.monotonic() + self.ttl_s)
+            self._size += len(image)
+
+            now = time.monotonic()
+            for old_key in [k for k, p in self._plots.items() if p.expires < now]:
+                self._pop(old_key)
+            while self._size > self.max_bytes and len(self._plots) > 1:
+                self._pop(next(iter(self._plots)))
+
+    # Telegram file_id of the first upload, repeat requests send this instead of the bytes
+    def set_file_id(self, key: tuple, file_id: str) -> None:
+        with self._lock:
+            plot = self._plots.get(key)
+            if plot is not None:
+                plot.file_id = file_id
@@ -0,0 +1,230 @@
+from __future__ import annotations
+
+from typing import Literal, TYPE_CHECKING
+
+import numpy as np
+
+from get_stats import WINDOW_SIZE, SUSTAINED_PERIOD, ANOMALY_THRESHOLDS, DETECTOR_MODE
+from baseline import SeasonalBaseline, wall_seconds, BASELINE_MAX_POINT_S
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+DetectorMode = Literal['rolling', 'seasonal', 'both']
+
+# What update() changes, rolled back when the newest row is revised
+CHECKPOINT_STATE = (
+    '_values', '_n_values', '_nobs', '_mean', '_m2', '_same_count',
+    '_abs_z', '_n_abs_z', '_abs_z_sum', '_abs_z_nan', '_abs_z_inf'
+)
+
+
+# Incremental version of analyze() for the newest point of every column of a
+# frame at once: rolling mean/variance use a sliding Welford update and the
+# sustained check a running sum of |z|, all vectorized over the columns, so
+# each new row costs O(1) per column. With a seasonal baseline, the Z-score
+# can instead (or also) compare each point with its hour of the week.
+class StreamingDetector:
+    def __init__(
+        self,
+        columns: list[str],
+        window_size: int = WINDOW_SIZE,
+        sustained_period: int = SUSTAINED_PERIOD,
+        thresholds: dict[str, tuple[float, float, float]] = ANOMALY_THRESHOLDS,
+        baseline: SeasonalBaseline | None = None,
+        mode: DetectorMode = DETECTOR_MODE
+    ) -> None:
+        self.columns = columns
+        self.window_size = window_size
+        self.sustained_period = sustained_period
+        self.baseline = baseline
+        self.mode = mode if baseline is not None else 'rolling'
+        self.high_threshold, self.low_threshold, self.sustained_threshold = \
+            np.array([thresholds[col_name] for col_name in columns], dtype=float).T
+        self.reset()
+
+    def reset(self) -> None:
+        n = len(self.columns)
+
+        self._values = np.full((self.window_size, n), np.nan)
+        self._n_values = 0
+        self._nobs = np.zeros(n)
+        self._mean = np.zeros(n)
+        self._m2 = np.zeros(n)
+        self._same_count = np.zeros(n)
+
+        self._abs_z = np.full((self.sustained_period, n), np.nan)
+        self._n_abs_z = 0
+        self._abs_z_sum = np.zeros(n)
+        self._abs_z_nan = np.zeros(n)
+        self._abs_z_inf = np.zeros(n)
+
+        self.last_datetime: pd.Timestamp | None = None
+        self._checkpoint: dict[str, np.ndarray | int] | None = None
+        self._checkpoint_row: np.ndarray | None = None
+
+    # State before the newest row, which may be a partial bucket that the next
+    # fetch revises (the cache re-fetches it and the store upserts it)
+    def _save_checkpoint(self, row: np.ndarray) -> None:
+        self._checkpoint = {}
+        for name in CHECKPOINT_STATE:
+            value = getattr(self, name)
+            self._checkpoint[name] = value.copy() if isinstance(value, np.ndarray) else value
+        self._checkpoint_row = row
+
+    def _push_abs_z(self, z: np.ndarray) -> np.ndarray:
+        i = self._n_abs_z % self.sustained_period
+        if self._n_abs_z >= self.sustained_period:
+            old = self._abs_z[i]
+            self._abs_z_nan -= np.isnan(old)
+            self._abs_z_inf -= np.isinf(old)
+            self._abs_z_sum -= np.where(np.isfinite(old), old, 0.0)
+
+        value = np.abs(z)
+        self._abs_z[i] = value
+        self._n_abs_z += 1
+        self._abs_z_nan += np.isnan(value)
+        self._abs_z_inf += np.isinf(value)
+        self._abs_z_sum += np.where(np.isfinite(value), value, 0.0)
+
+        mean = np.where(self._abs_z_inf > 0, np.inf, self._abs_z_sum / self.sustained_period)
+        ready = (self._n_abs_z >= self.sustained_period) & (self._abs_z_nan == 0)
+        return np.where(ready, mean, np.nan)
+
+    # Z-score of the mode from the rolling one and the seasonal one. Columns
+    # whose baseline bucket has too little data keep the rolling Z-score,
+    # "both" keeps the one closer to 0.
+    def _combine(self, rolling_z: np.ndarray, seasonal_z: np.ndarray) -> np.ndarray:
+        if self.mode == 'seasonal':
+            return np.where(np.isnan(seasonal_z), rolling_z, seasonal_z)
+
+        closer = np.isnan(rolling_z) | (np.abs(seasonal_z) < np.abs(rolling_z))
+        return np.where(~np.isnan(seasonal_z) & closer, seasonal_z, rolling_z)
+
+    # `wall_s` (local wall clock seconds of the point) is needed by the
+    # seasonal modes only
+    def update(self, values: np.ndarray, wall_s: float | None = None) -> dict[str, np.ndarray]:
+        x = np.asarray(values, dtype=float)
+        i = self._n_values % self.window_size
+        last = self._values[(i - 1) % self.window_size] if self._n_values else np.full(len(x), np.nan)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # Drop the value leaving the window
+            if self._n_values >= self.window_size:
+                old = self._values[i]
+                valid = ~np.isnan(old)
+                self._nobs -= valid
+                delta = np.where(valid, old - self._mean, 0.0)
+                self._mean = np.where(valid, self._mean - delta / self._nobs, self._mean)
+                self._m2 = np.where(valid, self._m2 - delta * (old - self._mean), self._m2)
+                empty = self._nobs == 0
+                self._mean[empty] = 0.0
+                self._m2[empty] = 0.0
+
+            # Add the new one
+            valid = ~np.isnan(x)
+            self._nobs += valid
+            delta = np.where(valid, x - self._mean, 0.0)
+            self._mean = np.where(valid, self._mean + delta / self._nobs, self._mean)
+            self._m2 = np.where(valid, self._m2 + delta * (x - self._mean), self._m2)
+            self._same_count = np.where(valid, np.where(x == last, self._same_count + 1, 1), 0)
+
+            self._values[i] = x
+            self._n_values += 1
+
+            # Like pandas, a constant window has exactly its value as mean and zero variance
+            ready = self._nobs >= self.window_size
+            constant = self._same_count >= self.window_size
+            mean = np.where(ready, np.where(constant, x, self._mean), np.nan)
+            std = np.where(
+                ready,
+                np.where(constant, 0.0, np.sqrt(np.maximum(self._m2 / (self._nobs - 1), 0.0))),
+                np.nan
+            )
+
+            diff = x - mean
+            z_score = np.where(
+                std > 0, diff / std,
+                np.where((diff == 0) | np.isnan(diff), np.nan, np.copysign(np.inf, diff))
+            )
+
+        seasonal_z = None
+        if self.mode != 'rolling' and wall_s is not None:
+            seasonal_z = self.baseline.score(wall_s, x)
+            z_score = self._combine(z_score, seasonal_z)
+
+        mean_abs_z = self._push_abs_z(z_score)
+
+        is_high_anomaly = z_score > self.high_threshold
+        is_low_anomaly = z_score < self.low_threshold
+
+        return {
+            'value': x,
+            'rolling_mean': mean,
+            'rolling_std': std,
+            'z_score': z_score,
+            'seasonal_z': seasonal_z if seasonal_z is not None else np.full(len(x), np.nan),
+            'is_high_anomaly': is_high_anomaly,
+            'is_low_anomaly': is_low_anomaly,
+            'is_anomaly': is_high_anomaly | is_low_anomaly,
+            'mean_abs_z': mean_abs_z,
+            'is_sustained_anomaly': mean_abs_z > self.sustained_threshold
+        }
+
+    # Points join the baseline after they are scored, once each even when the
+    # window restarts or overlaps the history it was built from, weighted by
+    # the seconds since the previous point (a gap in the data counts as
+    # BASELINE_MAX_POINT_S at most)
+    def _add_to_baseline(self, df: pd.DataFrame, rows: np.ndarray, wall_s: np.ndarray) -> None:
+        until = self.baseline.until
+        seconds = np.array([ts.timestamp() for ts in df['datetime']])
+        new = seconds > until if until is not None else np.ones(len(seconds), dtype=bool)
+        if not new.any():
+            return
+
+        if until is not None:
+            durations = np.diff(seconds[new], prepend=until)
+        elif new.sum() > 1:
+            durations = np.diff(seconds, prepend=2 * seconds[0] - seconds[1])
+        else:
+            durations = np.zeros(1)
+
+        self.baseline.add(wall_s[new], rows[new], np.clip(durations, 0, BASELINE_MAX_POINT_S))
+        self.baseline.until = seconds[-1]
+
+    def feed(self, df: pd.DataFrame) -> dict[str, np.ndarray] | None:
+        # Only rows newer than the last one seen are fed, and the last one
+        # again if its value changed since, from the state before it
+        skip = 0
+        if self.last_datetime is not None:
+            df = df[df['datetime'] >= self.last_datetime]
+            if not df.empty and df['datetime'].iloc[0] == self.last_datetime:
+                first = df[self.columns].iloc[0].to_numpy(dtype=float)
+                if np.array_equal(first, self._checkpoint_row, equal_nan=True):
+                    skip = 1
+                else:
+                    for name, value in self._checkpoint.items():
+                        setattr(self, name, value)
+
+        if len(df) <= skip:
+            return None
+
+        rows = df[self.columns].to_numpy(dtype=float)
+        wall_s = None
+        if self.baseline is not None:
+            wall_s = wall_seconds(df['datetime'])
+
+        result = None
+        for i in range(skip, len(rows)):
+            if i == len(rows) - 1:
+                self._save_checkpoint(rows[i])
+            result = self.update(rows[i], None if wall_s is None else wall_s[i])
+
+        # The newest row joins the baseline once a later one follows it, with
+        # its final value
+        if self.baseline is not None and self.baseline.ready and len(rows) > 1:
+            self._add_to_baseline(df.iloc[:-1], rows[:-1], wall_s[:-1])
+
+        self.last_datetime = df['datetime'].iloc[-1]
+
+        return result
@@ -0,0 +1,83 @@
+from __future__ import annotations
+
+from typing import Literal, TYPE_CHECKING
+
+import numpy as np
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+
+def minmax_indices(y: np.ndarray, n_buckets: int) -> np.ndarray:
+    n = len(y)
+    if n <= 2 * n_buckets:
+        return np.arange(n)
+
+    # Equal sized buckets, the last one padded, one row per bucket
+    size = -(-n // n_buckets)
+    n_blocks = -(-n // size)
+    low = np.full(n_blocks * size, np.inf)
+    high = np.full(n_blocks * size, -np.inf)
+    low[:n] = np.where(np.isnan(y), np.inf, y)
+    high[:n] = np.where(np.isnan(y), -np.inf, y)
+
+    offsets = np.arange(n_blocks) * size
+    indices = np.concatenate((
+        offsets + low.reshape(n_blocks, size).argmin(axis=1),
+        offsets + high.reshape(n_blocks, size).argmax(axis=1),
+        [0, n - 1]
+    ))
+    return np.unique(indices[indices < n])
+
+# Largest-Triangle-Three-Buckets: per bucket keep the point forming the largest
+# triangle with the previously kept point and the average of the next bucket
+def lttb_indices(y: np.ndarray, n_out: int, x: np.ndarray | None = None) -> np.ndarray:
+    n = len(y)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    x = np.arange(n, dtype=float) if x is None else x.astype(float)
+    y = np.where(np.isnan(y), np.nanmean(y) if not np.isnan(y).all() else 0.0, y)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    edges = np.append(edges, n)
+
+    indices = np.empty(n_out, dtype=np.int64)
+    indices[0], indices[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], max(edges[i + 1], edges[i] + 1)
+        next_lo, next_hi = edges[i + 1], max(edges[i + 2], edges[i + 1] + 1)
+        avg_x, avg_y = x[next_lo:next_hi].mean(), y[next_lo:next_hi].mean()
+
+        area = np.abs(
+            (x[a] - avg_x) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (avg_y - y[a])
+        )
+        a = lo + int(area.argmax())
+        indices[i + 1] = a
+
+    return np.unique(indices)
+
+# Rows of `df` to draw at `n_out` points wide, keeping the peaks of every column
+# in `columns` and every row flagged in `keep` (e.g. anomalies)
+def downsample(
+    df: pd.DataFrame,
+    columns: list[str],
+    n_out: int,
+    method: Literal['minmax', 'lttb'] = 'minmax',
+    keep: pd.Series | None = None
+) -> pd.DataFrame:
+    if len(df) <= n_out:
+        return df
+
+    indices = []
+    for col_name in columns:
+        y = df[col_name].to_numpy(dtype=float)
+        if method == 'lttb':
+            indices.append(lttb_indices(y, n_out))
+        else:
+            indices.append(minmax_indices(y, n_out // 2))
+
+    if keep is not None:
+        indices.append(np.flatnonzero(keep.to_numpy(dtype=bool)))
+
+    return df.iloc[np.unique(np.concatenate(indices))]
@@ -0,0 +1,128 @@
+from __future__ import annotations
+
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Iterator, Literal, TYPE_CHECKING
+import gzip
+import math
+
+from get_stats import fetch_scheduler, default_server, METRIC_COLUMNS
+import perf
+
+if TYPE_CHECKING:
+    import pandas as pd
+    from hcloud.servers.domain import MetricsType
+    from scheduler import TokenBucket
+
+
+EXPORT_CHUNK_POINTS = 1000  # Points per API request
+EXPORT_MAX_POINTS = 100_000  # Rows of an export, longer ranges get a coarser step
+EXPORT_MIN_STEP_S = 1
+EXPORT_WORKERS = 4  # Chunks fetched at once, and at most held in memory
+EXPORT_MAX_RANGE_S = 30 * 24 * 60 * 60
+GZIP_COMPRESS_LEVEL = 6  # Level 9 takes twice as long for a few % smaller files
+
+ExportFormat = Literal['csv', 'parquet']
+EXPORT_SUFFIXES: dict[ExportFormat, str] = {'csv': '.csv.gz', 'parquet': '.parquet'}
+
+executor = ThreadPoolExecutor(EXPORT_WORKERS, thread_name_prefix="export")
+
+
+# Finest step keeping an export of `range_s` within EXPORT_MAX_POINTS rows
+def export_step(range_s: int) -> int:
+    return max(EXPORT_MIN_STEP_S, math.ceil(range_s / EXPORT_MAX_POINTS))
+
+def chunk_ranges(start: datetime, end: datetime, step: int) -> Iterator[tuple[datetime, datetime]]:
+    chunk = timedelta(seconds=step * EXPORT_CHUNK_POINTS)
+    while start < end:
+        yield start, min(start + chunk, end)
+        start += chunk
+
+# One chunk, without the point at its end (the next chunk's first) unless it
+# is the last one. Exports share the monitor's share of the API budget, so
+# they never eat into the requests kept for button presses.
+def fetch_chunk(
+    types: list[MetricsType],
+    start: datetime,
+    end: datetime,
+    step: int,
+    server: str,
+    last: bool
+) -> pd.DataFrame:
+    with fetch_scheduler.background(), perf.span('export.fetch'):
+        df = fetch_scheduler.fetch(types, start, end, step, server)
+    return df if last else df[df['datetime'] < end]
+
+# Chunks in order, with at most EXPORT_WORKERS fetched ahead of the one
+# being written. With a `limit`, chunks wait for it here rather than in the
+# workers, which other exports share.
+def fetch_chunks(
+    types: list[MetricsType],
+    start: datetime,
+    end: datetime,
+    step: int,
+    server: str,
+    limit: TokenBucket | None = None
+) -> Iterator[pd.DataFrame]:
+    pending: deque[Future] = deque()
+    try:
+        for chunk_start, chunk_end in chunk_ranges(start, end, step):
+            if limit is not None:
+                limit.acquire()
+            pending.append(executor.submit(
+                fetch_chunk, types, chunk_start, chunk_end, step, server, chunk_end == end
+            ))
+            if len(pending) >= EXPORT_WORKERS:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+# Stream the metrics of `types` over [start, end] into `path` chunk by chunk,
+# so memory stays flat whatever the range, and return the number of rows
+def export_metrics(
+    path: Path,
+    types: list[MetricsType],
+    start: datetime,
+    end: datetime,
+    server: str | None = None,
+    format: ExportFormat = 'csv',
+    step: int | None = None
+) -> int:
+    server = server or default_server()
+    step = step or export_step(int((end - start).total_seconds()))
+    columns = ['datetime'] + [col for t in types for col in METRIC_COLUMNS[t]]
+    chunks = (df.reindex(columns=columns) for df in fetch_chunks(types, start, end, step, server))
+
+    rows = 0
+    if format == 'parquet':
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        writer = None
+        try:
+            for df in chunks:
+                table = pa.Table.from_pandas(df, preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(path, table.schema, compression='zstd')
+                writer.write_table(table.cast(writer.schema))
+                rows += len(df)
+        finally:
+            if writer is not None:
+                writer.close()
+        return rows
+
+    import numpy as np
+
+    with gzip.open(path, 'wt', newline='', compresslevel=GZIP_COMPRESS_LEVEL) as f:
+        for df in chunks:
+            # ISO 8601 UTC timestamps, formatted by numpy instead of per row
+            utc = df['datetime'].dt.tz_convert('UTC').dt.tz_localize(None).to_numpy()
+            df = df.assign(datetime=np.datetime_as_string(utc, unit='s', timezone='UTC'))
+            df.to_csv(f, header=rows == 0, index=False)
+            rows += len(df)
+    return rows
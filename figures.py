@@ -0,0 +1,192 @@
+from __future__ import annotations
+
+from io import BytesIO
+from pathlib import Path
+from typing import BinaryIO, Literal, TYPE_CHECKING
+
+import numpy as np
+import matplotlib.dates as mdates
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from PIL import Image
+
+from get_stats import SIGMA_LOW, SIGMA_HIGH
+
+if TYPE_CHECKING:
+    import pandas as pd
+    from matplotlib.axes import Axes
+
+PlotFormat = Literal['png', 'webp', 'jpeg']
+
+PNG_COMPRESS_LEVEL = 6  # zlib level, as used by matplotlib's own savefig
+
+
+# A figure built once with its axes, titles, legends and empty artists; each
+# render only swaps the artists' data, rescales and encodes the Agg buffer
+class PlotTemplate:
+    def __init__(self, nrows: int, size: tuple[float, float], dpi: int, tight: bool) -> None:
+        self.fig = Figure(figsize=size, dpi=dpi)
+        self.canvas = FigureCanvasAgg(self.fig)
+        self.axes: list[Axes] = list(np.atleast_1d(self.fig.subplots(nrows=nrows, sharex=True)))
+        self.tight = tight
+
+    def _x(self, datetimes: pd.Series) -> np.ndarray:
+        self.axes[-1].xaxis_date(datetimes.dt.tz)
+        return mdates.date2num(datetimes.dt.tz_convert('UTC').dt.tz_localize(None).to_numpy())
+
+    # Autoscale to the lines plus the (x, y) points of fills and scatters, which relim() skips
+    def _rescale(self, extra: list[tuple[Axes, np.ndarray, np.ndarray]] = []) -> None:
+        for ax in self.axes:
+            ax.relim()
+        for ax, x, y in extra:
+            finite = np.isfinite(x) & np.isfinite(y)
+            if finite.any():
+                ax.update_datalim(np.column_stack((x[finite], y[finite])))
+        for ax in self.axes:
+            ax.autoscale_view()
+
+    def encode(self, format: PlotFormat = 'png', quality: int = 85) -> bytes:
+        # Tick labels change with the data, so the layout is redone, but not rebuilt
+        if self.tight:
+            self.fig.tight_layout()
+        self.canvas.draw()
+
+        # The figure is opaque, dropping alpha makes every format smaller and faster
+        image = Image.frombuffer('RGBA', self.canvas.get_width_height(), self.canvas.buffer_rgba()).convert('RGB')
+        buffer = BytesIO()
+        if format == 'png':
+            image.save(buffer, format='PNG', compress_level=PNG_COMPRESS_LEVEL)
+        else:
+            image.save(buffer, format=format.upper(), quality=quality)
+        return buffer.getvalue()
+
+
+class CpuPlot(PlotTemplate):
+    def __init__(self, size: tuple[float, float], dpi: int) -> None:
+        super().__init__(1, size, dpi, tight=False)
+        ax = self.axes[0]
+
+        self.load, = ax.plot([], [], label='CPU Load')
+        self.mean, = ax.plot([], [], label='Rolling Mean', color='orange')
+        self.band = ax.fill_between([], [], [], alpha=0.2, color='orange', label=f'[-{SIGMA_LOW}σ,+{SIGMA_HIGH}σ] Range')
+        self.high = ax.scatter([], [], color='red', label='High Anomalies')
+        self.low = ax.scatter([], [], color='blue', label='Low Anomalies')
+        ax.set_title('CPU Load Over Time with Anomaly Detection')
+        ax.set_xlabel('Time')
+        ax.set_ylabel('CPU Load (%)')
+        ax.legend()
+        ax.grid(True)
+
+    def render(self, df: pd.DataFrame, format: PlotFormat = 'png', quality: int = 85) -> bytes:
+        ax = self.axes[0]
+        x = self._x(df['datetime'])
+        cpu = df['cpu'].to_numpy(dtype=float)
+        mean = df['rolling_mean'].to_numpy(dtype=float)
+        std = df['rolling_std'].to_numpy(dtype=float)
+
+        self.load.set_data(x, cpu)
+        self.mean.set_data(x, mean)
+        if hasattr(self.band, 'set_data'):
+            self.band.set_data(x, mean - 2*std, mean + 2*std)
+        else:  # matplotlib < 3.10
+            label = self.band.get_label()
+            self.band.remove()
+            self.band = ax.fill_between(x, mean - 2*std, mean + 2*std, alpha=0.2, color='orange', label=label)
+
+        high = df['is_high_anomaly'].to_numpy(dtype=bool)
+        low = df['is_low_anomaly'].to_numpy(dtype=bool)
+        self.high.set_offsets(np.column_stack((x[high], cpu[high])))
+        self.low.set_offsets(np.column_stack((x[low], cpu[low])))
+
+        self._rescale([
+            (ax, x, mean - 2*std),
+            (ax, x, mean + 2*std),
+        ])
+        return self.encode(format, quality)
+
+
+# Two stacked panels of (column, label, color, linewidth, alpha) lines, with
+# values divided by `scale` (e.g. bytes to kB)
+PanelSpec = tuple[str, str, list[tuple[str, str, str, float, float]], float]
+
+class TwoPanelPlot(PlotTemplate):
+    def __init__(self, size: tuple[float, float], dpi: int, panels: tuple[PanelSpec, PanelSpec]) -> None:
+        super().__init__(2, size, dpi, tight=True)
+        self.panels = []
+
+        for ax, (title, ylabel, lines, scale) in zip(self.axes, panels):
+            artists = []
+            for col_name, label, color, linewidth, alpha in lines:
+                line, = ax.plot([], [], label=label, color=color, linewidth=linewidth, alpha=alpha)
+                artists.append((col_name, line))
+            self.panels.append((artists, scale))
+
+            ax.set_ylabel(ylabel, color='black')
+            ax.tick_params(axis='y', labelcolor='black')
+            ax.set_title(title)
+            ax.legend()
+            ax.grid(True)
+
+        self.axes[-1].set_xlabel('Time')
+
+    def render(self, df: pd.DataFrame, format: PlotFormat = 'png', quality: int = 85) -> bytes:
+        x = self._x(df['datetime'])
+        for artists, scale in self.panels:
+            for col_name, line in artists:
+                line.set_data(x, df[col_name].to_numpy(dtype=float) / scale)
+
+        self._rescale()
+        return self.encode(format, quality)
+
+
+# Line width and alpha of the plain lines matplotlib defaults to
+DEFAULT_LINE = (1.5, 1.0)
+
+DISK_PANELS = (
+    ('Disk IOPS Over Time with Rolling Averages', 'IOPS', [
+        ('rolling_iops_read', 'Rolling IOPS Read', 'blue', *DEFAULT_LINE),
+        ('rolling_iops_write', 'Rolling IOPS Write', 'orange', *DEFAULT_LINE),
+        ('iops_read', 'IOPS Read', 'blue', 1, 0.3),
+        ('iops_write', 'IOPS Write', 'orange', 1, 0.3),
+    ], 1),
+    ('Disk Bandwidth Over Time with Rolling Averages', 'Bandwidth (kB)', [
+        ('rolling_bandwidth_read', 'Rolling Bandwidth Read', 'green', *DEFAULT_LINE),
+        ('rolling_bandwidth_write', 'Rolling Bandwidth Write', 'red', *DEFAULT_LINE),
+        ('bandwidth_read', 'Bandwidth Read', 'green', 1, 0.3),
+        ('bandwidth_write', 'Bandwidth Write', 'coral', 1, 0.3),
+    ], 1024),
+)
+
+NETWORK_PANELS = (
+    ('Network PPS Over Time with Rolling Averages', 'Packets per Second (PPS)', [
+        ('rolling_pps_in', 'Rolling PPS In', 'blue', *DEFAULT_LINE),
+        ('rolling_pps_out', 'Rolling PPS Out', 'orange', *DEFAULT_LINE),
+        ('pps_in', 'PPS In', 'blue', 1, 0.3),
+        ('pps_out', 'PPS Out', 'orange', 1, 0.3),
+    ], 1),
+    ('Network Bandwidth Over Time with Rolling Averages', 'Bandwidth (kB)', [
+        ('rolling_bandwidth_in', 'Rolling Bandwidth In', 'green', *DEFAULT_LINE),
+        ('rolling_bandwidth_out', 'Rolling Bandwidth Out', 'red', *DEFAULT_LINE),
+        ('bandwidth_in', 'Bandwidth In', 'green', 1, 0.3),
+        ('bandwidth_out', 'Bandwidth Out', 'coral', 1, 0.3),
+    ], 1024),
+)
+
+# One template per metric and output size, kept for the life of the process
+# (i.e. of each render worker)
+_templates: dict[tuple, PlotTemplate] = {}
+
+def get_template(metric: str, size: tuple[float, float], dpi: int) -> PlotTemplate:
+    key = (metric, size, dpi)
+    if key not in _templates:
+        if metric == 'cpu':
+            _templates[key] = CpuPlot(size, dpi)
+        else:
+            _templates[key] = TwoPanelPlot(size, dpi, DISK_PANELS if metric == 'disk' else NETWORK_PANELS)
+    return _templates[key]
+
+def write_image(path: Path | str | BinaryIO, image: bytes) -> None:
+    if isinstance(path, (str, Path)):
+        Path(path).write_bytes(image)
+    else:
+        path.write(image)
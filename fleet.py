@@ -0,0 +1,88 @@
+from __future__ import annotations
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from threading import Event
+from typing import TYPE_CHECKING
+import logging
+
+from get_stats import get_cache, get_store, fetch_scheduler, MAX_METRICS_VALUES, ALL_METRICS, FLEET_WORKERS, DETECTOR_MODE
+from detector import StreamingDetector
+from baseline import SeasonalBaseline, build_baseline
+import perf
+
+if TYPE_CHECKING:
+    import pandas as pd
+    import numpy as np
+
+
+fleet_executor = ThreadPoolExecutor(FLEET_WORKERS, thread_name_prefix="fleet")
+# Baselines are built one server at a time, on the monitor's API budget
+baseline_builds = ThreadPoolExecutor(1, thread_name_prefix="baseline")
+stop_building = Event()  # Set on exit, so that a build does not hold it up
+
+logger = logging.getLogger(__name__)
+
+
+def _build_baseline(baseline: SeasonalBaseline, server: str) -> None:
+    try:
+        with perf.span('baseline.build'):
+            build_baseline(baseline, server, stopped=stop_building.is_set)
+        if baseline.ready:
+            logger.info(f"{server}: seasonal baseline built")
+    except Exception as e:
+        logger.error(f"{server}: building the seasonal baseline: {e}")
+
+# Detector of `server` for the monitor. In the seasonal modes its baseline is
+# loaded from disk, or built from the API in the background, the rolling
+# Z-score standing in meanwhile.
+def new_detector(server: str, columns: list[str]) -> StreamingDetector:
+    if DETECTOR_MODE == 'rolling':
+        return StreamingDetector(columns)
+
+    baseline = SeasonalBaseline(columns, path=get_store(server).path.with_suffix(".baseline.npz"))
+    if not baseline.load():
+        baseline_builds.submit(_build_baseline, baseline, server)
+    return StreamingDetector(columns, baseline=baseline)
+
+# Fetch the last MAX_METRICS_VALUES points of `server` at `step`, store them
+# and feed the new rows to the detector
+def poll_metrics(
+    detector: StreamingDetector,
+    end: datetime,
+    step: int,
+    server: str | None = None
+) -> tuple[pd.DataFrame, dict[str, np.ndarray] | None]:
+    start = end - timedelta(seconds=step * MAX_METRICS_VALUES)
+
+    with fetch_scheduler.background(), perf.span('monitor.fetch'):
+        load = get_cache(server).get(ALL_METRICS, start, end, step)
+    with perf.span('monitor.store'):
+        get_store(server).append(load)
+    with perf.span('monitor.detect'):
+        latest_point = detector.feed(load)
+    if detector.baseline is not None:
+        detector.baseline.autosave()
+
+    return load, latest_point
+
+# poll_metrics() for every server at once, FLEET_WORKERS at a time, mapping
+# each server to its result or to the error that stopped it
+def poll_fleet(
+    detectors: dict[str, StreamingDetector],
+    end: datetime,
+    step: int
+) -> dict[str, tuple[pd.DataFrame, dict[str, np.ndarray] | None] | Exception]:
+    futures = {
+        server: fleet_executor.submit(poll_metrics, detector, end, step, server)
+        for server, detector in detectors.items()
+    }
+
+    results = {}
+    for server, future in futures.items():
+        try:
+            results[server] = future.result()
+        except Exception as e:
+            results[server] = e
+
+    return results
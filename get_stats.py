@@ -1,15 +1,35 @@
-from hcloud import Client
-from hcloud.servers.domain import MetricsType
+from __future__ import annotations
+
 from dotenv import dotenv_values
 from datetime import datetime
+from functools import lru_cache, partial
 from pathlib import Path
-from functools import reduce
+from threading import Lock
+from typing import BinaryIO, TYPE_CHECKING
+
+from cache import MetricsCache
+from store import MetricsStore
+from scheduler import FetchScheduler
+from memory import memory_caps
+import perf
 
-import matplotlib.pyplot as plt
-import pandas as pd
+# hcloud, pandas, numpy and matplotlib are imported on first use, so importing
+# this module is fast and does not touch the network
+if TYPE_CHECKING:
+    from hcloud import Client
+    from hcloud.servers.client import BoundServer
+    from hcloud.servers.domain import MetricsType
+    import pandas as pd
+    import numpy as np
 
 
 MAX_METRICS_VALUES = 500
+ALL_METRICS: list[MetricsType] = ['cpu', 'disk', 'network']
+METRIC_COLUMNS: dict[MetricsType, list[str]] = {
+    'cpu': ['cpu'],
+    'disk': ['iops_read', 'iops_write', 'bandwidth_read', 'bandwidth_write'],
+    'network': ['pps_in', 'pps_out', 'bandwidth_in', 'bandwidth_out'],
+}
 WINDOW_SIZE = 15
 
 # Define anomaly thresholds
@@ -20,49 +40,215 @@ LOW_ANOMALY_THRESHOLD = -SIGMA_LOW  # Z-score threshold for low usage anomalies
 SUSTAINED_ANOMALY_THRESHOLD = 2  # Absolute Z-score threshold for sustained anomalies
 SUSTAINED_PERIOD = 10  # Number of consecutive points to consider as a sustained anomaly
 
+# Per column (high, low, sustained) Z-score thresholds used by the monitor
+ANOMALY_THRESHOLDS: dict[str, tuple[float, float, float]] = {
+    col_name: (HIGH_ANOMALY_THRESHOLD, LOW_ANOMALY_THRESHOLD, SUSTAINED_ANOMALY_THRESHOLD)
+    for col_names in METRIC_COLUMNS.values() for col_name in col_names
+}
+
 config = dotenv_values()
 
-hetzner_client = Client(token=config["HCLOUD_TOKEN"])
-server = hetzner_client.servers.get_by_name(config["SERVER_NAME"])
+PLOT_SIZE = tuple(float(v) for v in config.get("PLOT_SIZE", "12x6").split("x"))  # Figure size in inches
+PLOT_DPI = int(config.get("PLOT_DPI", 200))
+PLOT_FORMAT = config.get("PLOT_FORMAT", "png")  # png, webp or jpeg
+PLOT_QUALITY = int(config.get("PLOT_QUALITY", 85))  # webp and jpeg only
+PLOT_WIDTH_PX = int(PLOT_SIZE[0] * PLOT_DPI)
+# Plots fetch PLOT_FETCH_FACTOR times the monitor's points (more than the
+# figure has pixels) and downsample them to PLOT_POINTS with "minmax" or "lttb"
+PLOT_FETCH_FACTOR = int(config.get("PLOT_FETCH_FACTOR", 8))
+PLOT_FETCH_VALUES = PLOT_FETCH_FACTOR * MAX_METRICS_VALUES
+PLOT_POINTS = min(PLOT_WIDTH_PX, PLOT_FETCH_VALUES // 2)  # About one point per pixel, always below the fetch
+PLOT_DOWNSAMPLE = config.get("PLOT_DOWNSAMPLE", "minmax")
+
+# SERVER_NAME may list several comma separated servers, or SERVER_LABEL_SELECTOR
+# (e.g. "env=prod") pick every server carrying those labels
+SERVER_NAMES = [name.strip() for name in config.get("SERVER_NAME", "").split(",") if name.strip()]
+SERVER_LABEL_SELECTOR = config.get("SERVER_LABEL_SELECTOR")
+FLEET_MODE = bool(SERVER_LABEL_SELECTOR) or len(SERVER_NAMES) > 1
+FLEET_WORKERS = int(config.get("FLEET_WORKERS", 16))  # Concurrent API requests of a fleet check
+
+METRICS_DB = Path(config.get("METRICS_DB", "tmp/metrics.db"))
+
+# "seasonal" scores monitor points against the same hour of past weeks instead
+# of the rolling window, "both" only alerts when both find them unusual (the
+# seasonal Z-score alone is not bounded by the window, so it is noisier)
+DETECTOR_MODE = config.get("DETECTOR_MODE", "rolling")
+
+# With MEMORY_BUDGET_MB set, every cache and queue is capped from that budget
+MEMORY_BUDGET_MB = int(config.get("MEMORY_BUDGET_MB", 0))
+MEMORY_CAPS = memory_caps(MEMORY_BUDGET_MB) if MEMORY_BUDGET_MB else None
+
+@lru_cache(maxsize=None)
+def get_client() -> Client:
+    from hcloud import Client
+    from requests.adapters import HTTPAdapter
+
+    # HCLOUD_API_ENDPOINT points the bot at another API, e.g. loadtest.py's stand-in
+    hetzner_client = Client(
+        token=config["HCLOUD_TOKEN"],
+        **({'api_endpoint': config["HCLOUD_API_ENDPOINT"]} if config.get("HCLOUD_API_ENDPOINT") else {})
+    )
+
+    # All fetches share the client's requests session, whose default pool keeps
+    # 10 connections; size it for the fleet workers so none are thrown away
+    session = getattr(getattr(hetzner_client, '_client', None), '_session', None)
+    if session is not None:
+        for scheme in ("https://", "http://"):
+            session.mount(scheme, HTTPAdapter(pool_maxsize=FLEET_WORKERS))
+
+    return hetzner_client
+
+# Monitored servers by name, resolved once with a single API call
+@lru_cache(maxsize=None)
+def get_fleet() -> dict[str, BoundServer]:
+    servers = get_client().servers
+    if SERVER_LABEL_SELECTOR:
+        return {server.name: server for server in servers.get_all(label_selector=SERVER_LABEL_SELECTOR)}
+
+    by_name = {server.name: server for server in servers.get_all()} if FLEET_MODE else {}
+    return {name: by_name[name] if name in by_name else servers.get_by_name(name) for name in SERVER_NAMES}
+
+# Server names in menu order, known without an API call unless selected by label
+def server_names() -> list[str]:
+    return list(get_fleet()) if SERVER_LABEL_SELECTOR else SERVER_NAMES
+
+def default_server() -> str:
+    return server_names()[0]
+
+def get_server(name: str | None = None) -> BoundServer:
+    return get_fleet()[name or default_server()]
+
+# History and cached series of each server, created on first use
+metrics_stores: dict[str, MetricsStore] = {}
+stats_caches: dict[str, MetricsCache] = {}
+_servers_lock = Lock()
+
+def get_store(server: str | None = None) -> MetricsStore:
+    server = server or default_server()
+    with _servers_lock:
+        if server not in metrics_stores:
+            path = METRICS_DB.with_name(f"{METRICS_DB.stem}-{server}{METRICS_DB.suffix}") if FLEET_MODE else METRICS_DB
+            metrics_stores[server] = MetricsStore(path)
+        return metrics_stores[server]
+
+# In memory budget mode the servers share the metrics caches' budget
+def get_cache(server: str | None = None) -> MetricsCache:
+    server = server or default_server()
+    max_bytes = MEMORY_CAPS.metrics_cache_bytes // len(server_names()) if MEMORY_CAPS else None
+    with _servers_lock:
+        if server not in stats_caches:
+            stats_caches[server] = MetricsCache(partial(get_stats, server=server), max_bytes=max_bytes)
+        return stats_caches[server]
 
 def get_stats(
-    type: MetricsType,
+    type: MetricsType | list[MetricsType],
     start: datetime,
     end: datetime, 
-    step: int | None = None
+    step: int | None = None,
+    server: str | None = None
 ) -> pd.DataFrame:
+    server = server or default_server()
 
-    response = server.get_metrics(
-        type=type,
-        start=start,
-        end=end,
-        step=step
-    )
+    # Serve from the local history when it covers the whole range
+    if step is not None:
+        types = type if isinstance(type, list) else [type]
+        with perf.span('store_query'):
+            df = get_store(server).query(
+                [col for t in types for col in METRIC_COLUMNS[t]], start, end, step
+            )
+        if df is not None:
+            return df
 
-    dfs = []
-    for key in response.metrics.time_series:
-        col_name = '_'.join(key.split(".")[-2:])
+    return fetch_scheduler.fetch(type, start, end, step, server)
+
+def fetch_stats(
+    type: MetricsType | list[MetricsType],
+    start: datetime,
+    end: datetime, 
+    step: int | None = None,
+    server: str | None = None
+) -> pd.DataFrame:
+
+    with perf.span('api'):
+        response = get_server(server).get_metrics(
+            type=type,
+            start=start,
+            end=end,
+            step=step
+        )
+    perf.incr('api_calls')
+
+    with perf.span('decode'):
+        df = time_series_to_frame(response.metrics.time_series)
+    perf.incr('api_points', df.size - len(df))
+
+    return df
 
-        dfs.append(pd.DataFrame(
-            data=response.metrics.time_series[key]["values"],
-            columns=["datetime", col_name],
-            dtype="float"
-        ))
+def time_series_to_frame(time_series: dict) -> pd.DataFrame:
+    import pandas as pd
 
-    df = reduce(lambda left, right: pd.merge(left, right, on='datetime', how='outer'), dfs)
+    timestamps, columns = decode_time_series(time_series)
 
-    df['datetime'] = pd.to_datetime(
-        df['datetime'].astype(int), unit='s', utc=True
-    ).dt.tz_convert('Europe/Rome')
+    df = pd.DataFrame(columns)
+    df.insert(0, 'datetime', pd.to_datetime(
+        timestamps, unit='s', utc=True
+    ).tz_convert('Europe/Rome'))
 
     return df
 
-def analyze(df: pd.DataFrame, col_name: str) -> pd.DataFrame:
-    new_df = df.copy(deep=True)
+def decode_time_series(time_series: dict) -> tuple[np.ndarray, dict[str, np.ndarray]]:
+    import numpy as np
+
+    timestamps = []
+    columns = {}
+    for key in time_series:
+        col_name = '_'.join(key.split(".")[-2:])
+        if col_name in columns: # e.g. a second network interface
+            col_name = '_'.join(key.split("."))
+
+        values = time_series[key]["values"]
+        timestamps.append(np.array([v[0] for v in values], dtype=np.int64))
+        columns[col_name] = np.array([v[1] for v in values], dtype=float)
+
+    if not timestamps:
+        return np.empty(0, dtype=np.int64), columns
+
+    # Series of one response normally share timestamps, align them only when they don't
+    shared = timestamps[0]
+    if all(np.array_equal(shared, ts) for ts in timestamps[1:]):
+        return shared, columns
 
-    # Calculate rolling statistics
-    new_df['rolling_mean'] = new_df[col_name].rolling(window=WINDOW_SIZE).mean()
-    new_df['rolling_std'] = new_df[col_name].rolling(window=WINDOW_SIZE).std()
+    shared = np.unique(np.concatenate(timestamps))
+    for (col_name, values), ts in zip(list(columns.items()), timestamps):
+        aligned = np.full(len(shared), np.nan)
+        aligned[np.searchsorted(shared, ts)] = values
+        columns[col_name] = aligned
+
+    return shared, columns
+
+fetch_scheduler = FetchScheduler(fetch_stats)
+
+# How many points of a plot fetched at `fetch_step` span one point of the
+# monitor over the same `lookback_s`, by which the rolling windows of the plot
+# are widened so that its anomalies mean what the monitor's alerts mean
+def window_scale(lookback_s: int, fetch_step: int) -> float:
+    return max(lookback_s // MAX_METRICS_VALUES, 1) / fetch_step
+
+def scaled_windows(scale: float) -> tuple[int, int]:
+    return max(round(WINDOW_SIZE * scale), 2), max(round(SUSTAINED_PERIOD * scale), 1)
+
+def analyze(df: pd.DataFrame, col_name: str, scale: float = 1.0) -> pd.DataFrame:
+    window_size, sustained_period = scaled_windows(scale)
+    # New columns only, the data of `df` is shared rather than copied
+    new_df = df.copy(deep=False)
+
+    # Calculate rolling statistics. pandas can leave a float residue in both
+    # for a constant window, which then has exactly its value as mean and zero
+    # std (as in StreamingDetector), so its Z-score is NaN rather than ~0 or ±inf
+    rolling = new_df[col_name].rolling(window=window_size)
+    constant = rolling.max() == rolling.min()
+    new_df['rolling_mean'] = rolling.mean().mask(constant, new_df[col_name])
+    new_df['rolling_std'] = rolling.std().mask(constant, 0.0)
 
     # Calculate z-scores
     new_df['z_score'] = (new_df[col_name] - new_df['rolling_mean']) / new_df['rolling_std']
@@ -71,100 +257,46 @@ def analyze(df: pd.DataFrame, col_name: str) -> pd.DataFrame:
     new_df['is_high_anomaly'] = new_df['z_score'] > HIGH_ANOMALY_THRESHOLD
     new_df['is_low_anomaly'] = new_df['z_score'] < LOW_ANOMALY_THRESHOLD
     new_df['is_anomaly'] = new_df['is_high_anomaly'] | new_df['is_low_anomaly']
-    new_df['is_sustained_anomaly'] = abs(new_df['z_score']).rolling(window=SUSTAINED_PERIOD).mean() > SUSTAINED_ANOMALY_THRESHOLD
+    new_df['is_sustained_anomaly'] = abs(new_df['z_score']).rolling(window=sustained_period).mean() > SUSTAINED_ANOMALY_THRESHOLD
 
     return new_df
 
-def save_cpu_plot(path: Path, df: pd.DataFrame) -> None:
-    tdf = df.copy(deep=True)
-    fig, ax = plt.subplots(figsize=(12, 6))
-    ax.plot(tdf['datetime'], tdf['cpu'], label='CPU Load')
-    ax.plot(tdf['datetime'], tdf['rolling_mean'], label='Rolling Mean', color='orange')
-    ax.fill_between(tdf['datetime'], 
-                    tdf['rolling_mean'] - 2*tdf['rolling_std'], 
-                    tdf['rolling_mean'] + 2*tdf['rolling_std'], 
-                    alpha=0.2, color='orange', label=f'[-{SIGMA_LOW}σ,+{SIGMA_HIGH}σ] Range')
-    ax.scatter(tdf[tdf['is_high_anomaly']]['datetime'], 
-               tdf[tdf['is_high_anomaly']]['cpu'], 
-               color='red', label='High Anomalies')
-    ax.scatter(tdf[tdf['is_low_anomaly']]['datetime'], 
-               tdf[tdf['is_low_anomaly']]['cpu'], 
-               color='blue', label='Low Anomalies')
-    ax.set_title('CPU Load Over Time with Anomaly Detection')
-    ax.set_xlabel('Time')
-    ax.set_ylabel('CPU Load (%)')
-    ax.legend()
-    ax.grid(True)
-    fig.savefig(path, dpi=200)
-    plt.close(fig)
-
-def save_disk_plot(path: Path, df: pd.DataFrame) -> None:
-    tdf = df.copy(deep=True)
-    fig, (ax1, ax2) = plt.subplots(nrows=2, figsize=(12, 6), sharex=True)
-
-    tdf['rolling_iops_read'] = tdf['iops_read'].rolling(window=WINDOW_SIZE).mean()
-    tdf['rolling_iops_write'] = tdf['iops_write'].rolling(window=WINDOW_SIZE).mean()
-    tdf['rolling_bandwidth_read'] = tdf['bandwidth_read'].rolling(window=WINDOW_SIZE).mean() / 1024
-    tdf['rolling_bandwidth_write'] = tdf['bandwidth_write'].rolling(window=WINDOW_SIZE).mean() / 1024
-
-    ax1.plot(tdf['datetime'], tdf['rolling_iops_read'], label='Rolling IOPS Read', color='blue')
-    ax1.plot(tdf['datetime'], tdf['rolling_iops_write'], label='Rolling IOPS Write', color='orange')
-    ax1.plot(tdf['datetime'], tdf['iops_read'], color='blue', linewidth=1, label='IOPS Read', alpha=0.3)
-    ax1.plot(tdf['datetime'], tdf['iops_write'], color='orange', linewidth=1, label='IOPS Write', alpha=0.3)
-    ax1.set_ylabel('IOPS', color='black')
-    ax1.tick_params(axis='y', labelcolor='black')
-    ax1.set_title('Disk IOPS Over Time with Rolling Averages')
-    ax1.legend()
-    ax1.grid(True)
-
-    ax2.plot(tdf['datetime'], tdf['rolling_bandwidth_read'], label='Rolling Bandwidth Read', color='green')
-    ax2.plot(tdf['datetime'], tdf['rolling_bandwidth_write'], label='Rolling Bandwidth Write', color='red')
-    ax2.plot(tdf['datetime'], tdf['bandwidth_read'] / 1024, color='green', linewidth=1, label='Bandwidth Read', alpha=0.3)
-    ax2.plot(tdf['datetime'], tdf['bandwidth_write'] / 1024, color='coral', linewidth=1, label='Bandwidth Write', alpha=0.3)
-    ax2.set_ylabel('Bandwidth (kB)', color='black')
-    ax2.tick_params(axis='y', labelcolor='black')
-    ax2.set_title('Disk Bandwidth Over Time with Rolling Averages')
-    ax2.legend()
-    ax2.grid(True)
-    
-    ax2.set_xlabel('Time')
-    fig.tight_layout()
-    fig.savefig(path, dpi=200)
-    plt.close(fig)
-
-def save_network_plot(path: Path, df: pd.DataFrame) -> None:
-    tdf = df.copy(deep=True)
-    fig, (ax1, ax2) = plt.subplots(nrows=2, figsize=(12, 6), sharex=True)
-
-    tdf['rolling_pps_in'] = tdf['pps_in'].rolling(window=WINDOW_SIZE).mean()
-    tdf['rolling_pps_out'] = tdf['pps_out'].rolling(window=WINDOW_SIZE).mean()
-    tdf['rolling_bandwidth_in'] = tdf['bandwidth_in'].rolling(window=WINDOW_SIZE).mean() / 1024
-    tdf['rolling_bandwidth_out'] = tdf['bandwidth_out'].rolling(window=WINDOW_SIZE).mean() / 1024
-
-    ax1.plot(tdf['datetime'], tdf['rolling_pps_in'], label='Rolling PPS In', color='blue')
-    ax1.plot(tdf['datetime'], tdf['rolling_pps_out'], label='Rolling PPS Out', color='orange')
-    ax1.plot(tdf['datetime'], tdf['pps_in'], color='blue', linewidth=1, label='PPS In', alpha=0.3)
-    ax1.plot(tdf['datetime'], tdf['pps_out'], color='orange', linewidth=1, label='PPS Out', alpha=0.3)
-    ax1.set_ylabel('Packets per Second (PPS)', color='black')
-    ax1.tick_params(axis='y', labelcolor='black')
-    ax1.set_title('Network PPS Over Time with Rolling Averages')
-    ax1.legend()
-    ax1.grid(True)
-
-    ax2.plot(tdf['datetime'], tdf['rolling_bandwidth_in'], label='Rolling Bandwidth In', color='green')
-    ax2.plot(tdf['datetime'], tdf['rolling_bandwidth_out'], label='Rolling Bandwidth Out', color='red')
-    ax2.plot(tdf['datetime'], tdf['bandwidth_in'] / 1024, color='green', linewidth=1, label='Bandwidth In', alpha=0.3)
-    ax2.plot(tdf['datetime'], tdf['bandwidth_out'] / 1024, color='coral', linewidth=1, label='Bandwidth Out', alpha=0.3)
-    ax2.set_ylabel('Bandwidth (kB)', color='black')
-    ax2.tick_params(axis='y', labelcolor='black')
-    ax2.set_title('Network Bandwidth Over Time with Rolling Averages')
-    ax2.legend()
-    ax2.grid(True)
-    
-    ax2.set_xlabel('Time')
-    fig.tight_layout()
-    fig.savefig(path, dpi=200)
-    plt.close(fig)
+# The save_*_plot functions render into a per-process figure template. `scale`
+# widens the rolling windows of finer data, as in analyze(), which has done
+# so for the cpu frame already
+def save_cpu_plot(path: Path | BinaryIO, df: pd.DataFrame) -> None:
+    from downsample import downsample
+    from figures import get_template, write_image
+
+    tdf = downsample(df, ['cpu'], PLOT_POINTS, PLOT_DOWNSAMPLE, keep=df['is_anomaly'])
+    image = get_template('cpu', PLOT_SIZE, PLOT_DPI).render(tdf, PLOT_FORMAT, PLOT_QUALITY)
+    write_image(path, image)
+
+def save_disk_plot(path: Path | BinaryIO, df: pd.DataFrame, scale: float = 1.0) -> None:
+    from downsample import downsample
+    from figures import get_template, write_image
+
+    window_size, _ = scaled_windows(scale)
+    tdf = df.assign(**{
+        f'rolling_{col_name}': df[col_name].rolling(window=window_size).mean()
+        for col_name in METRIC_COLUMNS['disk']
+    })
+    tdf = downsample(tdf, METRIC_COLUMNS['disk'], PLOT_POINTS, PLOT_DOWNSAMPLE)
+    image = get_template('disk', PLOT_SIZE, PLOT_DPI).render(tdf, PLOT_FORMAT, PLOT_QUALITY)
+    write_image(path, image)
+
+def save_network_plot(path: Path | BinaryIO, df: pd.DataFrame, scale: float = 1.0) -> None:
+    from downsample import downsample
+    from figures import get_template, write_image
+
+    window_size, _ = scaled_windows(scale)
+    tdf = df.assign(**{
+        f'rolling_{col_name}': df[col_name].rolling(window=window_size).mean()
+        for col_name in METRIC_COLUMNS['network']
+    })
+    tdf = downsample(tdf, METRIC_COLUMNS['network'], PLOT_POINTS, PLOT_DOWNSAMPLE)
+    image = get_template('network', PLOT_SIZE, PLOT_DPI).render(tdf, PLOT_FORMAT, PLOT_QUALITY)
+    write_image(path, image)
 
 if __name__ == "__main__":
     from datetime import timedelta
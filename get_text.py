@@ -1,30 +1,80 @@
+from __future__ import annotations
+
 from datetime import datetime, timedelta
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import pandas as pd
 
-from get_stats import get_stats, MAX_METRICS_VALUES
+from get_stats import get_cache, get_store, MAX_METRICS_VALUES, ALL_METRICS
 
 STATS_TIMEFRAME_S = 2000
 STEP = STATS_TIMEFRAME_S // MAX_METRICS_VALUES
+PERCENTILES_TIMEFRAME_S = 24 * 60 * 60
+PERCENTILES = (0.5, 0.95, 0.99)
+
+# "p50/p95/p99, 24h" / "p50/p95/p99, 33m" for a window of `span_s` seconds
+def percentiles_label(span_s: float) -> str:
+    span = f"{span_s / 3600:.0f}h" if span_s >= 3600 else f"{span_s / 60:.0f}m"
+    return f"p50/p95/p99, {span}"
+
+PERCENTILES_LABEL = percentiles_label(PERCENTILES_TIMEFRAME_S)
 
-def get_cpu_stats_text():
+# All the stats share one combined cpu+disk+network frame, the same one
+# fetched by the monitor loop, so a dashboard refresh is a single API call
+def get_all_stats(server: str | None = None) -> pd.DataFrame:
     end = datetime.now().astimezone()
     start = end - timedelta(seconds=STATS_TIMEFRAME_S)
-    df = get_stats('cpu', start, end, STEP)
+    return get_cache(server).get(ALL_METRICS, start, end, STEP)
+
+# Percentiles of each column over the last PERCENTILES_TIMEFRAME_S, merged
+# from the stored per-bucket sketches, or taken from `df` while the store
+# has nothing for a column yet. Each value comes with the label of the
+# window it actually covers, so a fallback is not passed off as 24h
+def get_percentiles(
+    df: pd.DataFrame,
+    columns: list[str],
+    scale: float = 1,
+    server: str | None = None
+) -> dict[str, tuple[str, str]]:
+    end = datetime.now().astimezone()
+    start = end - timedelta(seconds=PERCENTILES_TIMEFRAME_S)
+    quantiles = get_store(server).quantiles(columns, start, end, PERCENTILES)
+    frame_span_s = (df['datetime'].iloc[-1] - df['datetime'].iloc[0]).total_seconds()
+
+    result = {}
+    for col_name, values in quantiles.items():
+        if values is not None:
+            label = PERCENTILES_LABEL
+        else:
+            label = percentiles_label(frame_span_s)
+            values = df[col_name].quantile(PERCENTILES)
+        result[col_name] = (label, " / ".join(f"{value / scale:.2f}" for value in values))
+    return result
+
+def get_cpu_stats_text(df: pd.DataFrame | None = None, server: str | None = None):
+    if df is None:
+        df = get_all_stats(server)
 
     current_value = df['cpu'].iloc[-1]
+    p = get_percentiles(df, ['cpu'], server=server)
 
     text = f"*CPU load stats:*\n" + \
      f" _Load (act)_: {current_value:.2f}%\n" + \
      f" _Load (avg)_: {df['cpu'].mean():.2f}%\n" + \
      f" _Load (min)_: {df['cpu'].min():.2f}%\n" + \
      f" _Load (max)_: {df['cpu'].max():.2f}%\n" + \
-     f" _Load (std)_: {df['cpu'].std():.2f}%"
+     f" _Load (std)_: {df['cpu'].std():.2f}%\n" + \
+     f" _Load ({p['cpu'][0]})_: {p['cpu'][1]}%"
     
     return text
 
-def get_disk_stats_text():
-    end = datetime.now().astimezone()
-    start = end - timedelta(seconds=STATS_TIMEFRAME_S)
-    df = get_stats('disk', start, end, STEP)
+def get_disk_stats_text(df: pd.DataFrame | None = None, server: str | None = None):
+    if df is None:
+        df = get_all_stats(server)
+
+    p = get_percentiles(df, ['iops_read', 'iops_write'], server=server)
+    p.update(get_percentiles(df, ['bandwidth_read', 'bandwidth_write'], scale=1024, server=server))
 
     text = f"*DISK stats:*\n" + \
      f" _IOPS read (avg)_: {df['iops_read'].mean():.2f} iop/s\n" + \
@@ -34,14 +84,20 @@ def get_disk_stats_text():
      f" _LOAD read (avg)_: {df['bandwidth_read'].mean() / 1024:.2f} kB/s\n" + \
      f" _LOAD write (avg)_: {df['bandwidth_write'].mean() / 1024:.2f} kB/s\n" + \
      f" _LOAD read (std)_: {df['bandwidth_read'].std() / 1024:.2f} kB/s\n" + \
-     f" _LOAD write (std)_: {df['bandwidth_write'].std() / 1024:.2f} kB/s\n"
+     f" _LOAD write (std)_: {df['bandwidth_write'].std() / 1024:.2f} kB/s\n" + \
+     f" _IOPS read ({p['iops_read'][0]})_: {p['iops_read'][1]} iop/s\n" + \
+     f" _IOPS write ({p['iops_write'][0]})_: {p['iops_write'][1]} iop/s\n" + \
+     f" _LOAD read ({p['bandwidth_read'][0]})_: {p['bandwidth_read'][1]} kB/s\n" + \
+     f" _LOAD write ({p['bandwidth_write'][0]})_: {p['bandwidth_write'][1]} kB/s\n"
     
     return text
 
-def get_network_stats_text():
-    end = datetime.now().astimezone()
-    start = end - timedelta(seconds=STATS_TIMEFRAME_S)
-    df = get_stats('network', start, end, STEP)
+def get_network_stats_text(df: pd.DataFrame | None = None, server: str | None = None):
+    if df is None:
+        df = get_all_stats(server)
+
+    p = get_percentiles(df, ['pps_in', 'pps_out'], server=server)
+    p.update(get_percentiles(df, ['bandwidth_in', 'bandwidth_out'], scale=1024, server=server))
 
     text = f"*NETWORK stats:*\n" + \
      f" _PPS in (avg)_: {df['pps_in'].mean():.2f} packets/s\n" + \
@@ -51,6 +107,10 @@ def get_network_stats_text():
      f" _LOAD in (avg)_: {df['bandwidth_in'].mean() / 1024:.2f} kB/s\n" + \
      f" _LOAD out (avg)_: {df['bandwidth_out'].mean() / 1024:.2f} kB/s\n" + \
      f" _LOAD in (std)_: {df['bandwidth_in'].std() / 1024:.2f} kB/s\n" + \
-     f" _LOAD out (std)_: {df['bandwidth_out'].std() / 1024:.2f} kB/s\n"
+     f" _LOAD out (std)_: {df['bandwidth_out'].std() / 1024:.2f} kB/s\n" + \
+     f" _PPS in ({p['pps_in'][0]})_: {p['pps_in'][1]} packets/s\n" + \
+     f" _PPS out ({p['pps_out'][0]})_: {p['pps_out'][1]} packets/s\n" + \
+     f" _LOAD in ({p['bandwidth_in'][0]})_: {p['bandwidth_in'][1]} kB/s\n" + \
+     f" _LOAD out ({p['bandwidth_out'][0]})_: {p['bandwidth_out'][1]} kB/s\n"
     
     return text
\ No newline at end of file
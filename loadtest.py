@@ -0,0 +1,486 @@
+from __future__ import annotations
+
+# Load test of the bot's handlers: bursts of recorded updates (the CPU menu
+# button, the 30d CPU plot and the stats Update buttons) go through the real
+# handlers of one concurrency model, while local stub HTTP servers stand in
+# for the Telegram Bot API and the hcloud API. The models are bot.py's
+# threaded polling loop, bot.py's webhook server and async_bot.py's asyncio
+# engine. Reports throughput and, per kind of update, the queueing delay
+# (update sent -> handler started) and the handler latency, so the models can
+# be compared objectively:
+#
+#   python loadtest.py --mode polling --save polling.json
+#   python loadtest.py --mode async --compare polling.json
+
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+from pathlib import Path
+from threading import Condition, Lock, Thread
+from typing import Any, Callable
+from urllib.error import HTTPError, URLError
+from urllib.parse import parse_qs, urlparse
+from urllib.request import Request, urlopen
+from email.parser import BytesParser
+from email.policy import HTTP
+import argparse, asyncio, inspect, json, logging, statistics, tempfile, time
+
+
+TELEGRAM_LATENCY_S = 0.05  # Round trip of a Bot API call
+HCLOUD_LATENCY_S = 0.2  # Round trip of a metrics request, about what Hetzner takes
+WEBHOOK_CLIENTS = 40  # Connections Telegram opens to a webhook at most (max_connections)
+WEBHOOK_RETRY_S = 0.2  # Before an update refused with 429 is posted again
+LOAD_TIMEOUT_S = 300  # For every update of a run to be handled
+
+CHAT_ID = 1
+TOKEN = "1:loadtest"
+USER = {"id": CHAT_ID, "is_bot": False, "first_name": "Load"}
+BOT_USER = {"id": 2, "is_bot": True, "first_name": "Bot", "username": "loadtest_bot"}
+CHAT = {"id": CHAT_ID, "type": "private", "first_name": "Load"}
+
+KINDS = ['cpu_cmd', 'cpuplot_30d', 'cpu_stats_update', 'disk_stats_update', 'network_stats_update']
+
+
+# Parameters of a request from its query string and form body: the threaded
+# bot sends them in the query string, the asyncio one as a (multipart) form
+def request_params(query: str, content_type: str, body: bytes) -> dict[str, str]:
+    params = {name: values[0] for name, values in parse_qs(query).items()}
+    if content_type.startswith("application/x-www-form-urlencoded"):
+        params.update((name, values[0]) for name, values in parse_qs(body.decode()).items())
+    elif content_type.startswith("multipart/form-data"):
+        form = BytesParser(policy=HTTP).parsebytes(f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+        for part in form.iter_parts():
+            if part.get_filename() is None:
+                params[part.get_param('name', header='content-disposition')] = part.get_payload(decode=True).decode()
+    return params
+
+# A ThreadingHTTPServer on a free local port whose answers come from
+# `respond(method, path, params, body)` after `latency_s`, counting calls
+class StubServer:
+    def __init__(self, respond: Callable[[str, str, dict[str, str], bytes], Any], latency_s: float) -> None:
+        self.respond = respond
+        self.latency_s = latency_s
+        self.calls: dict[str, int] = defaultdict(int)
+        self._lock = Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def answer(self) -> None:
+                url = urlparse(self.path)
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                params = request_params(url.query, self.headers.get("Content-Type", ""), body)
+                payload = json.dumps(stub.respond(self.command, url.path, params, body)).encode()
+
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = do_POST = answer
+
+            def log_message(self, format, *args) -> None:
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        Thread(name="stub_http", target=self._server.serve_forever, daemon=True).start()
+
+    @property
+    def url(self) -> str:
+        return "http://%s:%d" % self._server.server_address[:2]
+
+    def called(self, name: str) -> None:
+        with self._lock:
+            self.calls[name] += 1
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+
+# Bot API stand-in: getUpdates long polls the updates pushed by the load
+# generator, sends and edits answer with a message (with a photo for plots)
+class TelegramStub:
+    def __init__(self, latency_s: float = TELEGRAM_LATENCY_S) -> None:
+        self.server = StubServer(self.respond, latency_s)
+        self._updates: list[dict] = []
+        self._changed = Condition()
+        self._message_ids = count(1_000_000)
+
+    def push(self, updates: list[dict]) -> None:
+        with self._changed:
+            self._updates.extend(updates)
+            self._changed.notify_all()
+
+    def _get_updates(self, params: dict[str, str]) -> list[dict]:
+        offset = int(params.get('offset', 0))
+        deadline = time.monotonic() + float(params.get('timeout', 0))
+        with self._changed:
+            self._updates = [update for update in self._updates if update['update_id'] >= offset]
+            while not self._updates and time.monotonic() < deadline:
+                self._changed.wait(deadline - time.monotonic())
+            return list(self._updates)
+
+    def _message(self, params: dict[str, str], photo: bool) -> dict:
+        message_id = int(params.get('message_id') or next(self._message_ids))
+        message = {"message_id": message_id, "date": int(time.time()), "chat": CHAT, "from": BOT_USER}
+        if photo:
+            message["photo"] = [{"file_id": f"photo-{message_id}", "file_unique_id": f"u{message_id}", "width": 1, "height": 1}]
+        else:
+            message["text"] = params.get('text', "")
+        return message
+
+    def respond(self, method: str, path: str, params: dict[str, str], body: bytes) -> dict:
+        name = path.rsplit("/", 1)[-1]
+        self.server.called(name)
+        if name == 'getUpdates':
+            return {"ok": True, "result": self._get_updates(params)}
+
+        time.sleep(self.server.latency_s)
+        if name == 'getMe':
+            result: Any = BOT_USER
+        elif name in ('sendPhoto', 'editMessageMedia'):
+            result = self._message(params, photo=True)
+        elif name in ('sendMessage', 'editMessageText', 'editMessageCaption', 'sendDocument'):
+            result = self._message(params, photo=False)
+        else:
+            result = True
+        return {"ok": True, "result": result}
+
+
+# hcloud API stand-in for one server, whose metrics come from bench.py's
+# FakeServer. bench.py imports get_stats, which reads its settings on import,
+# so it is only imported once the first metrics are requested.
+class HcloudStub:
+    def __init__(self, server_name: str, latency_s: float = HCLOUD_LATENCY_S) -> None:
+        self.server_name = server_name
+        self.server = StubServer(self.respond, latency_s)
+        self._metrics = None
+        self._lock = Lock()
+
+    def fake_server(self):
+        with self._lock:
+            if self._metrics is None:
+                from bench import FakeServer
+
+                self._metrics = FakeServer()
+            return self._metrics
+
+    def respond(self, method: str, path: str, params: dict[str, str], body: bytes) -> dict:
+        time.sleep(self.server.latency_s)
+        if path.endswith("/metrics"):
+            self.server.called('metrics')
+            start, end = datetime.fromisoformat(params['start']), datetime.fromisoformat(params['end'])
+            step = float(params.get('step') or max((end - start).total_seconds() / 500, 1))
+            metrics = self.fake_server().get_metrics(params['type'].split(","), start, end, step).metrics
+            return {"metrics": {
+                "start": params['start'], "end": params['end'], "step": step, "time_series": metrics.time_series
+            }}
+
+        self.server.called('servers')
+        return {"servers": [{"id": 1, "name": self.server_name}]}
+
+
+def message_update(update_id: int, text: str) -> dict:
+    return {"update_id": update_id, "message": {
+        "message_id": update_id, "date": int(time.time()), "chat": CHAT, "from": USER, "text": text
+    }}
+
+# Press of an inline button under a message of the bot
+def callback_update(update_id: int, data: str, photo: bool = False) -> dict:
+    message: dict[str, Any] = {"message_id": update_id, "date": int(time.time()), "chat": CHAT, "from": BOT_USER}
+    if photo:
+        message["photo"] = [{"file_id": "photo-0", "file_unique_id": "u0", "width": 1, "height": 1}]
+    else:
+        message["text"] = "stats"
+    return {"update_id": update_id, "callback_query": {
+        "id": str(update_id), "from": USER, "chat_instance": "1", "data": data, "message": message
+    }}
+
+def recorded_update(kind: str, update_id: int, cpu_cmd: str) -> dict:
+    if kind == 'cpu_cmd':
+        return message_update(update_id, cpu_cmd)
+    return callback_update(update_id, kind, photo=kind.endswith("plot_30d"))
+
+
+# The kind of each update and when it was sent, and when its handler started
+# and ended, keyed by update id (which is also the id of its message or
+# callback query). Results are per kind rather than per handler, whose names
+# differ between the threaded and the asyncio bot.
+class Recorder:
+    def __init__(self) -> None:
+        self.sent: dict[int, tuple[str, float]] = {}
+        self.handled: dict[int, tuple[float, float, bool]] = {}
+        self._done = Condition()
+
+    def send(self, update_id: int, kind: str) -> None:
+        self.sent.setdefault(update_id, (kind, time.perf_counter()))
+
+    def record(self, update_id: int, started: float, ended: float, failed: bool) -> None:
+        with self._done:
+            self.handled[update_id] = (started, ended, failed)
+            self._done.notify_all()
+
+    def wait(self, update_ids: list[int], timeout_s: float) -> bool:
+        deadline = time.monotonic() + timeout_s
+        with self._done:
+            while not all(update_id in self.handled for update_id in update_ids):
+                if time.monotonic() >= deadline:
+                    return False
+                self._done.wait(deadline - time.monotonic())
+            return True
+
+    def clear(self) -> None:
+        with self._done:
+            self.sent.clear()
+            self.handled.clear()
+
+# Time every registered message and callback handler of `bot` (a TeleBot or
+# an AsyncTeleBot), the handlers themselves are left untouched
+def instrument(bot, recorder: Recorder) -> None:
+    def update_id(update) -> int:
+        return int(getattr(update, 'message_id', None) or update.id)
+
+    def timed(fn: Callable) -> Callable:
+        if inspect.iscoroutinefunction(fn):
+            @wraps(fn)
+            async def wrapper(update, *args, **kwargs):
+                started, failed = time.perf_counter(), True
+                try:
+                    result = await fn(update, *args, **kwargs)
+                    failed = False
+                    return result
+                finally:
+                    recorder.record(update_id(update), started, time.perf_counter(), failed)
+            return wrapper
+
+        @wraps(fn)
+        def wrapper(update, *args, **kwargs):
+            started, failed = time.perf_counter(), True
+            try:
+                result = fn(update, *args, **kwargs)
+                failed = False
+                return result
+            finally:
+                recorder.record(update_id(update), started, time.perf_counter(), failed)
+        return wrapper
+
+    for handlers in (bot.message_handlers, bot.callback_query_handlers):
+        for handler in handlers:
+            handler['function'] = timed(handler['function'])
+
+
+def percentile(values: list[float], q: int) -> float:
+    if len(values) < 2:
+        return values[0] if values else 0.0
+    return statistics.quantiles(values, n=100, method='inclusive')[q - 1]
+
+def summarize(recorder: Recorder, elapsed_s: float) -> dict[str, dict[str, float]]:
+    by_kind: dict[str, list[tuple[float, float, bool]]] = defaultdict(list)
+    for update_id, (started, ended, failed) in recorder.handled.items():
+        kind, sent = recorder.sent[update_id]
+        by_kind[kind].append((started - sent, ended - started, failed))
+
+    results: dict[str, dict[str, float]] = {}
+    for kind, samples in sorted(by_kind.items()):
+        queued = [queue_s * 1000 for queue_s, _, _ in samples]
+        durations = [duration_s * 1000 for _, duration_s, _ in samples]
+        results[kind] = {
+            'count': len(samples),
+            'errors': sum(failed for _, _, failed in samples),
+            **{f'queue_p{q}_ms': percentile(queued, q) for q in (50, 95, 99)},
+            **{f'p{q}_ms': percentile(durations, q) for q in (50, 95, 99)},
+            'max_ms': max(durations),
+        }
+
+    results['total'] = {
+        'count': len(recorder.handled),
+        'errors': sum(failed for _, _, failed in recorder.handled.values()),
+        'elapsed_s': elapsed_s,
+        'updates_per_s': len(recorder.handled) / elapsed_s if elapsed_s else 0.0,
+    }
+    return results
+
+def report(results: dict[str, dict[str, float]], telegram: TelegramStub, hcloud: HcloudStub) -> str:
+    total = results['total']
+    lines = [
+        f"{total['count']:.0f} updates handled in {total['elapsed_s']:.2f} s: {total['updates_per_s']:.1f} updates/s, "
+        f"{total['errors']:.0f} errors, {sum(telegram.server.calls.values())} Bot API calls, "
+        f"{hcloud.server.calls['metrics']} metrics requests",
+        f"{'update':<22} {'count':>5} {'errors':>6}   queue p50 / p95 / p99 ms   handler p50 / p95 / p99 / max ms",
+    ]
+    for kind, result in results.items():
+        if kind == 'total':
+            continue
+        lines.append(
+            f"{kind:<22} {result['count']:>5.0f} {result['errors']:>6.0f}   "
+            f"{result['queue_p50_ms']:7.0f} {result['queue_p95_ms']:7.0f} {result['queue_p99_ms']:7.0f}      "
+            f"{result['p50_ms']:7.0f} {result['p95_ms']:7.0f} {result['p99_ms']:7.0f} {result['max_ms']:7.0f}"
+        )
+    return "\n".join(lines)
+
+# Kinds of updates whose p95 queueing delay plus latency got slower than
+# `tolerance` times the saved results
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    def total_p95(result: dict) -> float:
+        return result['queue_p95_ms'] + result['p95_ms']
+
+    return [
+        f"{kind}: p95 {total_p95(result):.0f} ms vs {total_p95(baseline[kind]):.0f} ms"
+        for kind, result in results.items()
+        if kind != 'total' and kind in baseline and total_p95(result) > total_p95(baseline[kind]) * tolerance
+    ]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Load test of the bot's handlers against local API stand-ins")
+    parser.add_argument("--mode", choices=["polling", "webhook", "async"], default="polling",
+                        help="bot.py polling or webhook server, or async_bot.py")
+    parser.add_argument("--kinds", nargs="+", choices=KINDS, default=KINDS, help="updates sent, in turn")
+    parser.add_argument("--bursts", type=int, default=5)
+    parser.add_argument("--burst-size", type=int, default=20, help="updates sent at once")
+    parser.add_argument("--interval", type=float, default=2.0, help="seconds between the starts of bursts")
+    parser.add_argument("--cold", action="store_true", help="empty the plot and metrics caches before each burst")
+    parser.add_argument("--telegram-latency", type=float, default=TELEGRAM_LATENCY_S)
+    parser.add_argument("--hcloud-latency", type=float, default=HCLOUD_LATENCY_S)
+    parser.add_argument("--save", type=Path, help="write the results as JSON")
+    parser.add_argument("--compare", type=Path, help="fail if slower than these saved results")
+    parser.add_argument("--tolerance", type=float, default=1.25, help="allowed slowdown factor")
+    args = parser.parse_args()
+
+    telegram = TelegramStub(args.telegram_latency)
+    hcloud = HcloudStub("bench", args.hcloud_latency)
+    workdir = Path(tempfile.mkdtemp())
+
+    # The bots read their settings from .env on import, give them the stand-ins
+    # (and throwaway history) instead
+    import dotenv
+
+    config = {
+        "TELEGRAM_TOKEN": TOKEN,
+        "TELEGRAM_CHAT_ID": str(CHAT_ID),
+        "TELEGRAM_API_URL": telegram.server.url + "/bot{0}/{1}",
+        "HCLOUD_TOKEN": "loadtest",
+        "HCLOUD_API_ENDPOINT": hcloud.server.url + "/v1",
+        "SERVER_NAME": "bench",
+        "METRICS_DB": str(workdir / "metrics.db"),
+        "SUBSCRIBERS_FILE": str(workdir / "subscribers.json"),
+    }
+    if args.mode == "webhook":
+        config["WEBHOOK_URL"] = "https://loadtest.invalid/"
+    dotenv.dotenv_values = lambda *args, **kwargs: dict(config)
+
+    import telebot
+    import bot
+    from webhook import WebhookServer
+
+    telebot.logger.setLevel(logging.WARNING)
+    recorder = Recorder()
+    update_ids = count(1)
+
+    if args.mode == "async":
+        import async_bot
+
+        instrument(async_bot.bot, recorder)
+        loop = asyncio.new_event_loop()
+        polling_task = loop.create_task(async_bot.bot.infinity_polling(timeout=1))
+        Thread(name="asyncio", target=loop.run_until_complete, args=(polling_task,), daemon=True).start()
+
+        def send(updates: list[dict]) -> None:
+            telegram.push(updates)
+    else:
+        instrument(bot.bot, recorder)
+
+    if args.mode == "webhook":
+        webhook = WebhookServer(bot.bot, secret_token="loadtest", port=0)
+        webhook.start()
+        url = "http://%s:%d/" % webhook.address
+        clients = ThreadPoolExecutor(WEBHOOK_CLIENTS)
+
+        # Telegram redelivers updates refused with 429, or whose connection
+        # failed (the server's listen backlog is short)
+        def post(update: dict) -> None:
+            body = json.dumps(update).encode()
+            while True:
+                try:
+                    urlopen(Request(url, body, {"X-Telegram-Bot-Api-Secret-Token": "loadtest"}))
+                    return
+                except HTTPError as e:
+                    if e.code != 429:
+                        raise
+                except (URLError, ConnectionError):
+                    pass
+                time.sleep(WEBHOOK_RETRY_S)
+
+        def send(updates: list[dict]) -> None:
+            for update in updates:
+                clients.submit(post, update)
+    elif args.mode == "polling":
+        polling = Thread(name="polling", target=bot.bot.infinity_polling, kwargs={'long_polling_timeout': 1}, daemon=True)
+        polling.start()
+
+        def send(updates: list[dict]) -> None:
+            telegram.push(updates)
+
+    def burst(size: int) -> list[int]:
+        if args.cold:
+            bot.plot_cache.clear()
+            for cache in list(bot.stats_caches.values()):
+                cache.clear()
+        updates = []
+        for i in range(size):
+            kind = args.kinds[i % len(args.kinds)]
+            updates.append(recorded_update(kind, next(update_ids), bot.cpu_cmd))
+            recorder.send(updates[-1]['update_id'], kind)
+        send(updates)
+        return [update['update_id'] for update in updates]
+
+    try:
+        # One of each first: resolves the server, starts the render workers
+        # and imports pandas and matplotlib
+        if not recorder.wait(burst(len(args.kinds)), LOAD_TIMEOUT_S):
+            raise SystemExit("Warm-up updates were not handled")
+        recorder.clear()
+
+        started = time.perf_counter()
+        sent: list[int] = []
+        for i in range(args.bursts):
+            time.sleep(max(started + i * args.interval - time.perf_counter(), 0))
+            sent += burst(args.burst_size)
+        if not recorder.wait(sent, LOAD_TIMEOUT_S):
+            print(f"{len(sent) - len(recorder.handled)} updates were not handled within {LOAD_TIMEOUT_S} s")
+        elapsed_s = max((ended for _, ended, _ in recorder.handled.values()), default=started) - started
+    finally:
+        if args.mode == "webhook":
+            webhook.stop()
+            clients.shutdown(wait=False, cancel_futures=True)
+        elif args.mode == "async":
+            loop.call_soon_threadsafe(polling_task.cancel)
+            async_bot.executor.shutdown(wait=False, cancel_futures=True)
+        else:
+            bot.bot.stop_polling()
+        bot.renderer.shutdown()
+
+    results = summarize(recorder, elapsed_s)
+    print(f"{args.mode}: {args.bursts} bursts of {args.burst_size} every {args.interval:g} s "
+          f"({', '.join(args.kinds)}), {'cold' if args.cold else 'warm'} caches")
+    print(report(results, telegram, hcloud))
+
+    if args.save:
+        args.save.write_text(json.dumps(results, indent=2))
+
+    if args.compare:
+        regressions = compare(results, json.loads(args.compare.read_text()), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
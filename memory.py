@@ -0,0 +1,158 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from pathlib import Path
+from threading import Lock
+import gc
+import os
+import sys
+import tracemalloc
+
+
+PLOT_CACHE_SHARE = 0.15  # Of the memory budget, for rendered plots
+METRICS_CACHE_SHARE = 0.15  # For the metrics caches of all servers together
+OUTBOX_SHARE = 0.05  # For alert photos waiting in the outbox
+OUTBOX_MESSAGE_BYTES = 256 * 1024  # About one alert photo
+EXPORT_SHARE = 0.05  # For exports queued or running
+EXPORT_JOB_BYTES = 4 * 1024 * 1024  # About one running export, its chunks in flight and the writer's buffers
+RENDER_TASKS_PER_WORKER = 200  # Renders before a worker process is replaced, in budget mode
+TRACE_FRAMES = 30  # Frames kept per allocation, enough to get from pandas internals back to our modules
+TOP_SUBSYSTEMS = 12
+
+REPO_DIR = Path(__file__).resolve().parent
+
+
+@dataclass(frozen=True)
+class MemoryCaps:
+    plot_cache_bytes: int
+    metrics_cache_bytes: int
+    outbox_messages: int
+    pending_exports: int
+    render_tasks_per_worker: int
+
+# Caps of the caches and queues that grow with use, from a budget for the
+# whole process. The rest of the budget is left to the working sets of
+# pandas and matplotlib, and to the interpreter itself.
+def memory_caps(budget_mb: int) -> MemoryCaps:
+    budget = budget_mb * 1024 * 1024
+    return MemoryCaps(
+        plot_cache_bytes=int(budget * PLOT_CACHE_SHARE),
+        metrics_cache_bytes=int(budget * METRICS_CACHE_SHARE),
+        outbox_messages=max(10, int(budget * OUTBOX_SHARE) // OUTBOX_MESSAGE_BYTES),
+        pending_exports=max(2, int(budget * EXPORT_SHARE) // EXPORT_JOB_BYTES),
+        render_tasks_per_worker=RENDER_TASKS_PER_WORKER
+    )
+
+# Resident set size of the process, the peak one where /proc is missing
+def rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        import resource
+
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+# Collect garbage and hand free heap pages back to the OS, which glibc keeps
+# otherwise, so that RSS follows what was actually freed
+def release_memory() -> None:
+    gc.collect()
+    try:
+        import ctypes
+
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+def format_bytes(size: float) -> str:
+    for unit in ("B", "KiB", "MiB"):
+        if abs(size) < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GiB"
+
+# Module of this repo that made an allocation (its innermost frame here), or
+# the package it happened in when none of ours is on the stack
+def subsystem(traceback: tracemalloc.Traceback) -> str:
+    for frame in reversed(traceback):
+        path = Path(frame.filename)
+        if path.parent == REPO_DIR:
+            return path.stem
+
+    filename = traceback[-1].filename
+    if filename.startswith("<"):
+        return filename
+    path = Path(filename)
+    if "site-packages" in path.parts:
+        return path.parts[path.parts.index("site-packages") + 1].removesuffix(".py")
+    return path.stem
+
+
+# tracemalloc snapshots taken on demand, summed per subsystem and compared
+# with the previous one: a subsystem growing from snapshot to snapshot while
+# the bot does the same work is leaking. Only the totals of the last snapshot
+# are kept, not the snapshot itself.
+class MemoryTracker:
+    def __init__(self, frames: int = TRACE_FRAMES) -> None:
+        self.frames = frames
+        self._previous: dict[str, int] = {}
+        self._lock = Lock()
+
+    @property
+    def tracing(self) -> bool:
+        return tracemalloc.is_tracing()
+
+    def start(self) -> None:
+        with self._lock:
+            if not tracemalloc.is_tracing():
+                self._previous = {}
+                tracemalloc.start(self.frames)
+
+    def stop(self) -> None:
+        with self._lock:
+            tracemalloc.stop()
+            self._previous = {}
+
+    # Allocated bytes per subsystem now, and their change since the last call
+    def snapshot(self) -> tuple[dict[str, int], dict[str, int]]:
+        with self._lock:
+            snapshot = tracemalloc.take_snapshot().filter_traces([
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, __file__),
+            ])
+
+            names: dict[tracemalloc.Traceback, str] = {}
+            sizes: dict[str, int] = {}
+            for trace in snapshot.traces:
+                name = names.get(trace.traceback)
+                if name is None:
+                    name = names[trace.traceback] = subsystem(trace.traceback)
+                sizes[name] = sizes.get(name, 0) + trace.size
+            del snapshot, names
+
+            changes = {name: size - self._previous.get(name, 0) for name, size in sizes.items()}
+            self._previous = sizes
+            return sizes, changes
+
+    # Text for the admin: RSS against the budget, `sizes` of the caches and
+    # queues, then the largest subsystems when tracing
+    def report(self, sizes: dict[str, str], budget_mb: int = 0) -> str:
+        budget = f" of a {budget_mb} MiB budget" if budget_mb else ""
+        lines = [f"*Memory:* RSS {format_bytes(rss_bytes())}{budget}"]
+        lines += [f" `{name}`: {size}" for name, size in sizes.items()]
+
+        if not self.tracing:
+            lines.append("Allocations are not traced, /memory trace starts tracing them.")
+            return "\n".join(lines)
+
+        first = not self._previous
+        allocated, changes = self.snapshot()
+        traced, peak = tracemalloc.get_traced_memory()
+        lines.append(f"*Traced:* {format_bytes(traced)}, peak {format_bytes(peak)}")
+        lines.append("*By subsystem:*" if first else "*By subsystem (change since the last snapshot):*")
+        for name, size in sorted(allocated.items(), key=lambda item: -item[1])[:TOP_SUBSYSTEMS]:
+            change = "" if first else f" ({'+' if changes[name] >= 0 else '-'}{format_bytes(abs(changes[name]))})"
+            lines.append(f" `{name}`: {format_bytes(size)}{change}")
+
+        return "\n".join(lines)
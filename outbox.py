@@ -0,0 +1,215 @@
+from __future__ import annotations
+
+from collections import deque
+from dataclasses import dataclass
+from threading import Condition, Thread
+from typing import Any, Callable
+import logging
+import time
+
+from telebot.apihelper import ApiTelegramException
+
+import perf
+
+
+OUTBOX_WORKERS = 4  # Requests to Telegram in flight, at most one per chat
+MESSAGES_PER_S = 30  # Telegram's global limit for bots
+CHAT_INTERVAL_S = 1.0  # Between two messages to the same private chat
+GROUP_INTERVAL_S = 3.0  # Between two messages to the same group, about 20 per minute
+MAX_QUEUED_MESSAGES = 1000  # Messages waiting for delivery before new ones are dropped
+MAX_RETRIES = 5  # Times a message refused with 429 is retried
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Delivery:
+    chat: int
+    send: Callable[[], Any]
+    on_done: Callable[[int, Any], None] | None = None
+    waiting: Callable[[], bool] | None = None  # Held back (with its chat's later messages) while True
+    retries: int = 0
+
+
+# File id of the photo a send_photo or edit_message_media call returned, if any
+def photo_file_id(result: Any) -> str | None:
+    photo = getattr(result, 'photo', None)
+    return photo[-1].file_id if photo else None
+
+
+# Outbound Telegram messages, sent from worker threads so that callers never
+# wait on the Bot API. Messages to one chat keep their order, chats take turns,
+# and sends are paced to Telegram's per chat and global limits. A 429 puts the
+# message back in front of its chat's queue for the retry_after it asked for.
+class Outbox:
+    def __init__(
+        self,
+        workers: int = OUTBOX_WORKERS,
+        messages_per_s: float = MESSAGES_PER_S,
+        chat_interval_s: float = CHAT_INTERVAL_S,
+        group_interval_s: float = GROUP_INTERVAL_S,
+        max_queued: int = MAX_QUEUED_MESSAGES
+    ) -> None:
+        self.workers = workers
+        self.messages_per_s = messages_per_s
+        self.chat_interval_s = chat_interval_s
+        self.group_interval_s = group_interval_s
+        self.max_queued = max_queued
+        self.sent = 0
+        self.retried = 0
+        self.dropped = 0
+        self.failed = 0
+
+        self._chats: dict[int, deque[Delivery]] = {}
+        self._ready_at: dict[int, float] = {}
+        self._busy: set[int] = set()
+        self._queued = 0
+        self._tokens = float(messages_per_s)
+        self._updated = time.monotonic()
+        self._stopping = False
+        self._changed = Condition()
+        self._threads: list[Thread] = []
+
+    @property
+    def queued(self) -> int:
+        return self._queued
+
+    # Queue `send` (a Bot API call) for `chat`, `on_done` gets its result, or
+    # None when it failed. Returns False when the queue is full.
+    def submit(
+        self,
+        chat: int,
+        send: Callable[[], Any],
+        on_done: Callable[[int, Any], None] | None = None,
+        waiting: Callable[[], bool] | None = None
+    ) -> bool:
+        with self._changed:
+            if self._queued >= self.max_queued:
+                self.dropped += 1
+                perf.incr('outbox_dropped')
+                return False
+
+            self._chats.setdefault(chat, deque()).append(Delivery(chat, send, on_done, waiting))
+            self._queued += 1
+            self._changed.notify()
+            return True
+
+    # Send a photo to every chat, uploading the bytes only once: the first chat
+    # gets them, the others wait for the file_id of that upload. Every chat's
+    # message is queued right away, so it keeps its place among the chat's others.
+    def broadcast_photo(
+        self,
+        chats: list[int],
+        photo: bytes | str,
+        send: Callable[[int, bytes | str], Any],
+        on_done: Callable[[int, Any], None] | None = None
+    ) -> None:
+        if not chats:
+            return
+
+        upload = {'photo': photo, 'pending': isinstance(photo, bytes)}
+
+        def uploaded(chat: int, result: Any) -> None:
+            upload['photo'] = photo_file_id(result) or photo
+            upload['pending'] = False
+            if on_done is not None:
+                on_done(chat, result)
+
+        first, rest = chats[0], chats[1:]
+        if not self.submit(first, lambda: send(first, photo), uploaded):
+            upload['pending'] = False
+
+        for chat in rest:
+            self.submit(chat, lambda chat=chat: send(chat, upload['photo']), on_done, lambda: upload['pending'])
+
+    def _interval(self, chat: int) -> float:
+        return self.group_interval_s if chat < 0 else self.chat_interval_s
+
+    # Next delivery whose chat is free and due, in turn, or the seconds to wait
+    def _take(self, now: float) -> Delivery | float:
+        self._tokens = min(self.messages_per_s, self._tokens + (now - self._updated) * self.messages_per_s)
+        self._updated = now
+
+        if self._tokens < 1:
+            return (1 - self._tokens) / self.messages_per_s
+
+        wait = float('inf')
+
+        for chat, deliveries in self._chats.items():
+            if chat in self._busy or not deliveries or (deliveries[0].waiting and deliveries[0].waiting()):
+                continue
+            ready_at = self._ready_at.get(chat, 0.0)
+            if ready_at > now:
+                wait = min(wait, ready_at - now)
+                continue
+
+            # The chat goes to the back of the line
+            del self._chats[chat]
+            self._chats[chat] = deliveries
+            self._busy.add(chat)
+            self._queued -= 1
+            self._tokens -= 1
+            return deliveries.popleft()
+
+        return wait
+
+    def _work(self) -> None:
+        while True:
+            with self._changed:
+                while True:
+                    if self._stopping and self._queued == 0:
+                        return
+                    delivery = self._take(time.monotonic())
+                    if isinstance(delivery, Delivery):
+                        break
+                    self._changed.wait(None if delivery == float('inf') else delivery)
+
+            result, retry_after = None, None
+            try:
+                with perf.span('outbox.send'):
+                    result = delivery.send()
+                self.sent += 1
+            except ApiTelegramException as e:
+                if e.error_code == 429 and delivery.retries < MAX_RETRIES:
+                    retry_after = e.result_json.get('parameters', {}).get('retry_after', 1)
+                elif "message is not modified" not in e.description:
+                    logger.error(f"Sending to {delivery.chat}: {e}")
+                    self.failed += 1
+            except Exception as e:
+                logger.error(f"Sending to {delivery.chat}: {e}")
+                self.failed += 1
+
+            if retry_after is None and delivery.on_done is not None:
+                try:
+                    delivery.on_done(delivery.chat, result)
+                except Exception as e:
+                    logger.error(e)
+
+            with self._changed:
+                self._busy.discard(delivery.chat)
+                self._ready_at[delivery.chat] = time.monotonic() + max(self._interval(delivery.chat), retry_after or 0)
+                if retry_after is not None:
+                    delivery.retries += 1
+                    self.retried += 1
+                    perf.incr('outbox_retried')
+                    self._chats.setdefault(delivery.chat, deque()).appendleft(delivery)
+                    self._queued += 1
+                elif not self._chats.get(delivery.chat):
+                    self._chats.pop(delivery.chat, None)
+                self._changed.notify_all()
+
+    def start(self) -> None:
+        for i in range(self.workers):
+            thread = Thread(name=f"outbox_{i}", target=self._work, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    # Deliver what is queued, waiting at most `timeout` seconds
+    def stop(self, timeout: float | None = None) -> None:
+        with self._changed:
+            self._stopping = True
+            self._changed.notify_all()
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(None if deadline is None else max(deadline - time.monotonic(), 0))
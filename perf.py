@@ -0,0 +1,156 @@
+from __future__ import annotations
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+from inspect import iscoroutinefunction
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from typing import Callable, Iterator
+import time
+
+
+# Histogram bucket upper bounds in seconds, Prometheus style
+BUCKETS_S = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, float('inf'))
+
+
+class Histogram:
+    def __init__(self) -> None:
+        self.counts = [0] * len(BUCKETS_S)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value_s: float) -> None:
+        self.counts[bisect_left(BUCKETS_S, value_s)] += 1
+        self.count += 1
+        self.sum += value_s
+
+    # Upper bound of the bucket holding the q-quantile
+    def quantile(self, q: float) -> float:
+        rank = q * self.count
+        cumulative = 0
+        for bound, count in zip(BUCKETS_S, self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return BUCKETS_S[-1]
+
+
+_histograms: dict[str, Histogram] = {}
+_counters: dict[str, float] = {}
+_gauges: dict[str, Callable[[], float]] = {}
+_lock = Lock()
+
+
+def observe(name: str, value_s: float) -> None:
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = Histogram()
+        histogram.observe(value_s)
+
+def incr(name: str, value: float = 1) -> None:
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+# Values read from elsewhere (e.g. cache hit counters) at report time
+def gauge(name: str, read: Callable[[], float]) -> None:
+    with _lock:
+        _gauges[name] = read
+
+@contextmanager
+def span(name: str) -> Iterator[None]:
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - started)
+
+def timed(name: str) -> Callable:
+    def decorator(fn: Callable) -> Callable:
+        if iscoroutinefunction(fn):
+            @wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with span(name):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def snapshot() -> tuple[dict[str, Histogram], dict[str, float]]:
+    with _lock:
+        histograms = {name: h for name, h in sorted(_histograms.items())}
+        counters = dict(sorted(_counters.items()))
+        gauges = dict(_gauges)
+
+    for name, read in gauges.items():
+        counters[name] = read()
+
+    return histograms, counters
+
+def report() -> str:
+    histograms, counters = snapshot()
+
+    lines = ["*Latency (p50 / p95 / mean, count):*"]
+    for name, h in histograms.items():
+        mean_ms = h.sum / h.count * 1000 if h.count else 0.0
+        lines.append(
+            f" `{name}`: ≤{h.quantile(0.5) * 1000:g} / ≤{h.quantile(0.95) * 1000:g} / "
+            f"{mean_ms:.1f} ms, {h.count}"
+        )
+
+    lines.append("*Counters:*")
+    for name, value in counters.items():
+        lines.append(f" `{name}`: {value:g}")
+
+    return "\n".join(lines)
+
+def prometheus() -> str:
+    histograms, counters = snapshot()
+
+    lines = []
+    for name, h in histograms.items():
+        metric = f"bot_{name.replace('.', '_')}_seconds"
+        lines.append(f"# TYPE {metric} histogram")
+        cumulative = 0
+        for bound, count in zip(BUCKETS_S, h.counts):
+            cumulative += count
+            le = "+Inf" if bound == float('inf') else f"{bound:g}"
+            lines.append(f'{metric}_bucket{{le="{le}"}} {cumulative}')
+        lines.append(f"{metric}_sum {h.sum}")
+        lines.append(f"{metric}_count {h.count}")
+
+    for name, value in counters.items():
+        metric = f"bot_{name.replace('.', '_')}"
+        lines.append(f"# TYPE {metric} gauge")
+        lines.append(f"{metric} {value:g}")
+
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+
+        body = prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+# Prometheus text format on http://<host>:<port>/metrics, in a daemon thread
+def serve_metrics(port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    Thread(name="metrics_http", target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,106 @@
+from __future__ import annotations
+
+from concurrent.futures import ProcessPoolExecutor
+from threading import BoundedSemaphore, Lock
+from typing import Callable, TYPE_CHECKING
+from io import BytesIO
+
+import perf
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+
+RENDER_WORKERS = 2
+MAX_PENDING_RENDERS = 4  # Renders queued or running before new ones are refused
+RENDER_TIMEOUT_S = 30
+
+
+class RenderQueueFull(Exception):
+    pass
+
+
+def _init_worker() -> None:
+    import matplotlib
+    matplotlib.use('agg')
+
+def _render(plot: Callable[..., None], df: pd.DataFrame, kwargs: dict) -> bytes:
+    buffer = BytesIO()
+    plot(buffer, df, **kwargs)
+    return buffer.getvalue()
+
+
+class Renderer:
+    def __init__(
+        self,
+        workers: int = RENDER_WORKERS,
+        max_pending: int = MAX_PENDING_RENDERS,
+        timeout_s: float = RENDER_TIMEOUT_S,
+        tasks_per_worker: int | None = None
+    ) -> None:
+        self.workers = workers
+        self.timeout_s = timeout_s
+        # Replacing the workers after about that many renders each bounds
+        # what matplotlib and the figure templates can accumulate in them
+        self.tasks_per_worker = tasks_per_worker
+        self._slots = BoundedSemaphore(max_pending)
+        self._pool: ProcessPoolExecutor | None = None
+        self._pool_tasks = 0
+        self._lock = Lock()
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            # Renders already submitted finish in the old pool
+            if self._pool is not None and self.tasks_per_worker and \
+               self._pool_tasks >= self.tasks_per_worker * self.workers:
+                self._pool.shutdown(wait=False)
+                self._pool = None
+                perf.incr('render_pool_recycled')
+
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(self.workers, initializer=_init_worker)
+                self._pool_tasks = 0
+            self._pool_tasks += 1
+            return self._pool
+
+    # Render `plot` (one of the save_*_plot functions, given `kwargs`) to image
+    # bytes in a worker process
+    def render(self, plot: Callable[..., None], df: pd.DataFrame, **kwargs) -> bytes:
+        if not self._slots.acquire(blocking=False):
+            perf.incr('renders_refused')
+            raise RenderQueueFull(f"{plot.__name__}: too many pending renders")
+
+        try:
+            pool = self._get_pool()
+            future = pool.submit(_render, plot, df, kwargs)
+            try:
+                with perf.span('render'):
+                    image = future.result(timeout=self.timeout_s)
+                perf.incr('renders')
+                perf.incr('render_bytes', len(image))
+                return image
+            except TimeoutError:
+                # A running render cannot be cancelled, and its worker would
+                # stay busy while the slot is handed to new work
+                self._terminate(pool)
+                raise
+        finally:
+            self._slots.release()
+
+    # Replace `pool` and kill its workers. Other renders still in it fail with
+    # BrokenProcessPool, the next ones start a new pool.
+    def _terminate(self, pool: ProcessPoolExecutor) -> None:
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+        processes = list((getattr(pool, '_processes', None) or {}).values())
+        pool.shutdown(wait=False, cancel_futures=True)
+        for process in processes:
+            process.terminate()
+        perf.incr('render_pool_terminated')
+
+    def shutdown(self) -> None:
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False, cancel_futures=True)
+                self._pool = None
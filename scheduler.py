@@ -0,0 +1,212 @@
+from __future__ import annotations
+
+from collections import deque
+from concurrent.futures import Future
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from threading import Condition, Lock, local
+from typing import Callable, Iterator, TYPE_CHECKING
+import time
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+
+API_REQUESTS_PER_HOUR = 3600  # Hetzner Cloud API quota per project
+API_BURST = 3600  # Bucket size, the API refills one request per second up to the hourly quota
+BACKGROUND_RESERVE = 360  # Requests kept for interactive use when the budget runs low
+
+
+# Blocking token bucket refilled at `requests_per_hour`. The scheduler's API
+# budget is one; another one on top of it limits a kind of request, e.g.
+# baseline builds of every server together, so that they cannot take all of it
+class TokenBucket:
+    def __init__(self, requests_per_hour: int, burst: int = 1) -> None:
+        self.rate = requests_per_hour / 3600
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._condition = Condition()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    @property
+    def tokens(self) -> float:
+        with self._condition:
+            self._refill()
+            return self._tokens
+
+    # Take a token once `reserve()` more are left. `reserve` is asked again
+    # whenever a waiter wakes, so lowering it and calling wake() lets a waiter
+    # through sooner.
+    def acquire(self, reserve: Callable[[], int] = lambda: 0) -> None:
+        with self._condition:
+            while True:
+                self._refill()
+                needed = 1 + reserve()
+                if self._tokens >= needed:
+                    self._tokens -= 1
+                    return
+
+                self._condition.wait((needed - self._tokens) / self.rate)
+
+    def wake(self) -> None:
+        with self._condition:
+            self._condition.notify_all()
+
+
+# A request being made, which callers wanting a range inside it wait for
+@dataclass
+class InFlight:
+    start: datetime
+    end: datetime
+    future: Future
+    background: bool  # Still waiting for budget above the interactive reserve
+
+
+class FetchScheduler:
+    def __init__(
+        self,
+        fetch: Callable[[str | list[str], datetime, datetime, int | None, str | None], pd.DataFrame],
+        requests_per_hour: int = API_REQUESTS_PER_HOUR,
+        burst: int = API_BURST,
+        background_reserve: int = BACKGROUND_RESERVE
+    ) -> None:
+        self.fetch_fn = fetch
+        self.budget = TokenBucket(requests_per_hour, burst)
+        self.background_reserve = background_reserve
+        self.calls = 0
+        self.coalesced = 0
+
+        self._inflight: dict[tuple, list[InFlight]] = {}
+        self._lock = Lock()
+        self._local = local()
+
+    # Requests made in this block only use the budget above the interactive reserve
+    @contextmanager
+    def background(self) -> Iterator[None]:
+        self._local.background = True
+        try:
+            yield
+        finally:
+            self._local.background = False
+
+    @property
+    def tokens(self) -> float:
+        return self.budget.tokens
+
+    def fetch(
+        self,
+        type: str | list[str],
+        start: datetime,
+        end: datetime,
+        step: int | None = None,
+        server: str | None = None
+    ) -> pd.DataFrame:
+        key = (server, ','.join(type) if isinstance(type, list) else type, step)
+        tolerance = timedelta(seconds=step or 1)
+
+        background = getattr(self._local, 'background', False)
+
+        # Share an in-flight request that already covers this range (single-flight)
+        with self._lock:
+            inflight = self._inflight.setdefault(key, [])
+            leader = next((
+                flight for flight in inflight
+                if flight.start <= start and flight.end >= end - tolerance
+            ), None)
+
+            if leader is None:
+                flight = InFlight(start, end, Future(), background)
+                inflight.append(flight)
+            else:
+                self.coalesced += 1
+                promote = leader.background and not background
+                if promote:
+                    leader.background = False
+
+        if leader is not None:
+            if promote:
+                self.budget.wake()
+            df = leader.future.result()
+            return df[(df['datetime'] >= start) & (df['datetime'] <= end)].reset_index(drop=True)
+
+        try:
+            # `flight.background` is re-read while waiting, an interactive
+            # caller joining this request promotes it
+            self.budget.acquire(lambda: self.background_reserve if flight.background else 0)
+            df = self.fetch_fn(type, start, end, step, server)
+            self.calls += 1
+            flight.future.set_result(df)
+            return df
+        except BaseException as e:
+            flight.future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                inflight.remove(flight)
+                if not inflight:
+                    del self._inflight[key]
+
+MONITOR_MIN_INTERVAL_S = 5  # Check interval while z-scores are climbing
+MONITOR_MAX_INTERVAL_S = 5 * 60  # Check interval while every metric is flat
+MONITOR_START_INTERVAL_S = 20
+MONITOR_CALLS_PER_HOUR = 600  # API calls the monitor may make in any hour
+MONITOR_MIN_STEP = 1  # Finest step requested from the API
+POINTS_PER_CHECK = 5  # New points each check brings, step = interval // POINTS_PER_CHECK
+CALM_Z = 2.5  # Back off while every |Z-score| stays below this...
+CALM_MEAN_Z = 1.3  # ...and every recent mean |Z-score| (about 0.8 for noise) too
+TIGHTEN_Z = 3.0  # Drop to the minimum interval once a |Z-score| reaches this...
+TIGHTEN_MEAN_Z = 1.8  # ...or a recent mean |Z-score| does
+
+
+# Check interval and step of the monitor: doubles the interval while the
+# metrics are flat, drops to the minimum when they move, and never makes more
+# than `calls_per_hour` API calls in a sliding hour
+class MonitorPacer:
+    def __init__(
+        self,
+        min_interval_s: int = MONITOR_MIN_INTERVAL_S,
+        max_interval_s: int = MONITOR_MAX_INTERVAL_S,
+        start_interval_s: int = MONITOR_START_INTERVAL_S,
+        calls_per_hour: int = MONITOR_CALLS_PER_HOUR,
+        min_step: int = MONITOR_MIN_STEP
+    ) -> None:
+        self.min_interval_s = min_interval_s
+        self.max_interval_s = max_interval_s
+        self.calls_per_hour = calls_per_hour
+        self.min_step = min_step
+        self.interval_s = min(max(start_interval_s, min_interval_s), max_interval_s)
+        self._calls: deque[tuple[float, int]] = deque()
+        self._calls_in_hour = 0
+
+    @property
+    def step(self) -> int:
+        return max(self.min_step, self.interval_s // POINTS_PER_CHECK)
+
+    # A check of a fleet makes one call per server
+    def record_call(self, now: float | None = None, calls: int = 1) -> None:
+        self._calls.append((time.monotonic() if now is None else now, calls))
+        self._calls_in_hour += calls
+
+    # Adjust the interval to the newest detector output (max |Z-score| and max
+    # recent mean |Z-score| over all columns)
+    def update(self, max_abs_z: float, max_mean_abs_z: float) -> None:
+        if max_abs_z >= TIGHTEN_Z or max_mean_abs_z >= TIGHTEN_MEAN_Z:
+            self.interval_s = self.min_interval_s
+        elif max_abs_z < CALM_Z and max_mean_abs_z < CALM_MEAN_Z:
+            self.interval_s = min(self.interval_s * 2, self.max_interval_s)
+
+    # Seconds to wait before the next check
+    def next_delay(self, now: float | None = None) -> float:
+        now = time.monotonic() if now is None else now
+        while self._calls and self._calls[0][0] <= now - 3600:
+            self._calls_in_hour -= self._calls.popleft()[1]
+
+        if self._calls_in_hour < self.calls_per_hour:
+            return self.interval_s
+        return max(self.interval_s, self._calls[0][0] + 3600 - now)
@@ -0,0 +1,94 @@
+from __future__ import annotations
+
+import numpy as np
+
+
+RELATIVE_ACCURACY = 0.01  # Any quantile is within 1% of the exact value
+MIN_VALUE = 1e-9  # Smaller values (metrics are never negative) count as zero
+
+
+# DDSketch: values are counted in logarithmic bins of width `gamma`, so bins
+# of sketches with the same accuracy merge by adding counts and quantiles
+# keep a bounded relative error whatever the number of values
+class DDSketch:
+    def __init__(self, relative_accuracy: float = RELATIVE_ACCURACY) -> None:
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = np.log(self.gamma)
+        self.keys = np.empty(0, dtype=np.int32)
+        self.counts = np.empty(0, dtype=np.int64)
+        self.zero_count = 0
+
+    @property
+    def count(self) -> int:
+        return self.zero_count + int(self.counts.sum())
+
+    def _add_bins(self, keys: np.ndarray, counts: np.ndarray) -> None:
+        keys, inverse = np.unique(np.concatenate((self.keys, keys)), return_inverse=True)
+        self.keys = keys.astype(np.int32)
+        self.counts = np.bincount(
+            inverse, weights=np.concatenate((self.counts, counts)), minlength=len(keys)
+        ).astype(np.int64)
+
+    # Count of values below MIN_VALUE and bin keys of the others
+    def _bin(self, values: np.ndarray) -> tuple[int, np.ndarray]:
+        values = np.asarray(values, dtype=float)
+        values = values[~np.isnan(values)]
+        small = values < MIN_VALUE
+        return int(small.sum()), np.ceil(np.log(values[~small]) / self._log_gamma).astype(np.int32)
+
+    def add(self, values: np.ndarray) -> None:
+        n_small, keys = self._bin(values)
+        self.zero_count += n_small
+        self._add_bins(keys, np.ones(len(keys), dtype=np.int64))
+
+    # Take back values added before (e.g. points since replaced)
+    def remove(self, values: np.ndarray) -> None:
+        n_small, keys = self._bin(values)
+        self.zero_count = max(self.zero_count - n_small, 0)
+        self._add_bins(keys, -np.ones(len(keys), dtype=np.int64))
+        kept = self.counts > 0
+        self.keys, self.counts = self.keys[kept], self.counts[kept]
+
+    def merge(self, other: DDSketch) -> None:
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Cannot merge sketches of different accuracy")
+
+        self.zero_count += other.zero_count
+        self._add_bins(other.keys, other.counts)
+
+    @classmethod
+    def merged(cls, sketches: list[DDSketch], relative_accuracy: float = RELATIVE_ACCURACY) -> DDSketch:
+        merged = cls(relative_accuracy)
+        if sketches:
+            merged.zero_count = sum(sketch.zero_count for sketch in sketches)
+            merged._add_bins(
+                np.concatenate([sketch.keys for sketch in sketches]),
+                np.concatenate([sketch.counts for sketch in sketches])
+            )
+        return merged
+
+    def quantile(self, q: float) -> float:
+        count = self.count
+        if count == 0:
+            return float('nan')
+
+        rank = q * (count - 1)
+        if rank < self.zero_count:
+            return 0.0
+
+        cumulative = self.zero_count + np.cumsum(self.counts)
+        i = min(int(np.searchsorted(cumulative, rank, side='right')), len(self.keys) - 1)
+        return float(2 * self.gamma ** self.keys[i] / (self.gamma + 1))
+
+    def to_bytes(self) -> bytes:
+        return np.int64(self.zero_count).tobytes() + self.keys.tobytes() + self.counts.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data: bytes, relative_accuracy: float = RELATIVE_ACCURACY) -> DDSketch:
+        sketch = cls(relative_accuracy)
+        n = (len(data) - 8) // 12
+        sketch.zero_count = int(np.frombuffer(data, dtype=np.int64, count=1)[0])
+        sketch.keys = np.frombuffer(data, dtype=np.int32, count=n, offset=8).copy()
+        sketch.counts = np.frombuffer(data, dtype=np.int64, count=n, offset=8 + 4 * n).copy()
+        return sketch
@@ -0,0 +1,252 @@
+from __future__ import annotations
+
+from datetime import datetime
+from pathlib import Path
+from threading import Lock
+from typing import TYPE_CHECKING
+import time, sqlite3
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+
+RAW_RETENTION_S = 2 * 24 * 60 * 60  # Raw points, at the monitor loop resolution
+ROLLUP_RETENTION_S = {  # Rollup resolution (s) -> retention (s)
+    60: 7 * 24 * 60 * 60,
+    10 * 60: 60 * 24 * 60 * 60,
+    60 * 60: 2 * 365 * 24 * 60 * 60,
+}
+SKETCH_MIN_BUCKETS = 24  # Percentiles merge the coarsest sketches giving at least this many buckets
+MAX_MISSING_BUCKETS = 2  # A range served from the store may only lack its partial first and last buckets
+
+
+class MetricsStore:
+    def __init__(
+        self,
+        path: Path,
+        raw_retention_s: int = RAW_RETENTION_S,
+        rollup_retention_s: dict[int, int] = ROLLUP_RETENTION_S
+    ) -> None:
+        self.path = Path(path)
+        self.raw_retention_s = raw_retention_s
+        self.rollup_retention_s = rollup_retention_s
+
+        self._db: sqlite3.Connection | None = None
+        self._last_ts: int | None = None
+        self._lock = Lock()
+
+    # The database is opened on first use, not at import
+    def _connect(self) -> sqlite3.Connection:
+        with self._lock:
+            if self._db is not None:
+                return self._db
+
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            db = sqlite3.connect(self.path, check_same_thread=False)
+            with db:
+                db.executescript("""
+                    PRAGMA journal_mode=WAL;
+                    CREATE TABLE IF NOT EXISTS points (
+                        ts INTEGER NOT NULL,
+                        name TEXT NOT NULL,
+                        value REAL NOT NULL,
+                        PRIMARY KEY (ts, name)
+                    ) WITHOUT ROWID;
+                    CREATE TABLE IF NOT EXISTS sketches (
+                        resolution INTEGER NOT NULL,
+                        ts INTEGER NOT NULL,
+                        name TEXT NOT NULL,
+                        sketch BLOB NOT NULL,
+                        PRIMARY KEY (resolution, ts, name)
+                    ) WITHOUT ROWID;
+                    CREATE TABLE IF NOT EXISTS rollups (
+                        resolution INTEGER NOT NULL,
+                        ts INTEGER NOT NULL,
+                        name TEXT NOT NULL,
+                        min REAL NOT NULL,
+                        max REAL NOT NULL,
+                        sum REAL NOT NULL,
+                        count INTEGER NOT NULL,
+                        PRIMARY KEY (resolution, ts, name)
+                    ) WITHOUT ROWID;
+                """)
+            self._last_ts = db.execute("SELECT MAX(ts) FROM points").fetchone()[0]
+            self._db = db
+            return db
+
+    # Store the rows of `df` from the last stored point on. That point may have
+    # come from an incomplete bucket, so its re-fetched value replaces it.
+    def append(self, df: pd.DataFrame) -> int:
+        import numpy as np
+        import pandas as pd
+        from sketch import DDSketch
+
+        db = self._connect()
+        ts = (df['datetime'] - pd.Timestamp(0, tz='UTC')) // pd.Timedelta(seconds=1)
+        new = df[ts >= self._last_ts] if self._last_ts is not None else df
+        if new.empty:
+            return 0
+
+        new_ts = ts[new.index]
+        first_ts, last_ts = int(new_ts.iloc[0]), int(new_ts.iloc[-1])
+        names = [name for name in new.columns if name != 'datetime']
+
+        with self._lock, db:
+            stored = {}
+            if self._last_ts is not None:
+                stored = {
+                    (t, name): value for t, name, value in db.execute(
+                        "SELECT ts, name, value FROM points WHERE ts >= ? AND ts <= ?", (first_ts, self._last_ts)
+                    )
+                }
+            rows = [
+                (int(t), name, float(v))
+                for name in names
+                for t, v in zip(new_ts, new[name]) if pd.notna(v) and stored.get((int(t), name)) != float(v)
+            ]
+            if not rows:
+                return 0
+
+            db.executemany("INSERT OR REPLACE INTO points VALUES (?, ?, ?)", rows)
+
+            # Rebuild the rollup buckets touched by the new points from the raw ones
+            for resolution in self.rollup_retention_s:
+                db.execute("""
+                    INSERT OR REPLACE INTO rollups
+                    SELECT ?, ts / ? * ? AS bucket, name, MIN(value), MAX(value), SUM(value), COUNT(value)
+                    FROM points WHERE ts >= ? AND ts <= ?
+                    GROUP BY bucket, name
+                """, (resolution, resolution, resolution, first_ts // resolution * resolution, last_ts))
+
+            # Bucket sketches are updated in place: replaced values are taken
+            # back and new ones added
+            for resolution in self.rollup_retention_s:
+                added: dict[tuple[int, str], list[float]] = {}
+                removed: dict[tuple[int, str], list[float]] = {}
+                for t, name, value in rows:
+                    bucket = t // resolution * resolution
+                    added.setdefault((bucket, name), []).append(value)
+                    if (t, name) in stored:
+                        removed.setdefault((bucket, name), []).append(stored[t, name])
+
+                # Buckets after the last stored point's one are new
+                last_bucket = self._last_ts // resolution * resolution if self._last_ts is not None else -1
+                for (bucket, name), values in added.items():
+                    row = db.execute(
+                        "SELECT sketch FROM sketches WHERE resolution = ? AND ts = ? AND name = ?",
+                        (resolution, bucket, name)
+                    ).fetchone() if bucket <= last_bucket else None
+                    sketch = DDSketch.from_bytes(row[0]) if row else DDSketch()
+                    if (bucket, name) in removed:
+                        sketch.remove(np.array(removed[bucket, name]))
+                    sketch.add(np.array(values))
+                    db.execute(
+                        "INSERT OR REPLACE INTO sketches VALUES (?, ?, ?, ?)",
+                        (resolution, bucket, name, sketch.to_bytes())
+                    )
+
+            now = int(time.time())
+            db.execute("DELETE FROM points WHERE ts < ?", (now - self.raw_retention_s,))
+            for resolution, retention_s in self.rollup_retention_s.items():
+                for table in ('rollups', 'sketches'):
+                    db.execute(
+                        f"DELETE FROM {table} WHERE resolution = ? AND ts < ?",
+                        (resolution, now - retention_s)
+                    )
+
+            self._last_ts = max(last_ts, self._last_ts if self._last_ts is not None else last_ts)
+
+        return len(rows)
+
+    # Range of `names` averaged to `step` buckets, or None when the store
+    # does not fully cover [start, end] at a resolution finer than `step`,
+    # including stretches without data inside it (e.g. while the bot was down)
+    def query(self, names: list[str], start: datetime, end: datetime, step: int) -> pd.DataFrame | None:
+        import pandas as pd
+
+        db = self._connect()
+        start_ts, end_ts = int(start.timestamp()), int(end.timestamp())
+        if self._last_ts is None or self._last_ts < end_ts - step:
+            return None
+
+        resolution = max((r for r in self.rollup_retention_s if r <= step), default=None)
+        placeholders = ','.join('?' * len(names))
+
+        with self._lock:
+            if resolution is None:
+                first_ts = db.execute("SELECT MIN(ts) FROM points").fetchone()[0]
+                query = f"""
+                    SELECT ts / ? * ? AS bucket, name, AVG(value)
+                    FROM points WHERE ts >= ? AND ts <= ? AND name IN ({placeholders})
+                    GROUP BY bucket, name
+                """
+                params = (step, step, start_ts, end_ts, *names)
+            else:
+                first_ts = db.execute(
+                    "SELECT MIN(ts) FROM rollups WHERE resolution = ?", (resolution,)
+                ).fetchone()[0]
+                query = f"""
+                    SELECT ts / ? * ? AS bucket, name, SUM(sum) / SUM(count)
+                    FROM rollups WHERE resolution = ? AND ts >= ? AND ts <= ? AND name IN ({placeholders})
+                    GROUP BY bucket, name
+                """
+                params = (step, step, resolution, start_ts, end_ts, *names)
+
+            if first_ts is None or first_ts > start_ts + step:
+                return None
+
+            rows = db.execute(query, params).fetchall()
+
+        df = pd.DataFrame(rows, columns=['datetime', 'name', 'value'])
+        df = df.pivot(index='datetime', columns='name', values='value')
+        if any(name not in df.columns for name in names):
+            return None
+
+        expected = end_ts // step - start_ts // step + 1
+        if len(df) < expected - MAX_MISSING_BUCKETS:
+            return None
+
+        df = df[names].reset_index().rename_axis(columns=None)
+        df['datetime'] = pd.to_datetime(
+            df['datetime'], unit='s', utc=True
+        ).dt.tz_convert('Europe/Rome')
+
+        return df
+
+    # Quantiles `qs` of each of `names` over [start, end], merged from the
+    # per-bucket sketches (so the window edges are rounded to whole buckets),
+    # None for names without any stored point in the window
+    def quantiles(
+        self,
+        names: list[str],
+        start: datetime,
+        end: datetime,
+        qs: tuple[float, ...] = (0.5, 0.95, 0.99)
+    ) -> dict[str, list[float] | None]:
+        from sketch import DDSketch
+
+        db = self._connect()
+        start_ts, end_ts = int(start.timestamp()), int(end.timestamp())
+        resolutions = sorted(self.rollup_retention_s)
+        resolution = max(
+            (r for r in resolutions if (end_ts - start_ts) // r >= SKETCH_MIN_BUCKETS),
+            default=resolutions[0]
+        )
+        placeholders = ','.join('?' * len(names))
+
+        with self._lock:
+            rows = db.execute(f"""
+                SELECT name, sketch FROM sketches
+                WHERE resolution = ? AND ts >= ? AND ts <= ? AND name IN ({placeholders})
+            """, (resolution, start_ts // resolution * resolution, end_ts, *names)).fetchall()
+
+        sketches: dict[str, list[DDSketch]] = {name: [] for name in names}
+        for name, data in rows:
+            sketches[name].append(DDSketch.from_bytes(data))
+
+        result = {}
+        for name in names:
+            merged = DDSketch.merged(sketches[name])
+            result[name] = [merged.quantile(q) for q in qs] if merged.count else None
+
+        return result
@@ -0,0 +1,48 @@
+from __future__ import annotations
+
+from pathlib import Path
+from threading import Lock
+import json
+
+
+# Chats receiving alerts, kept in a small JSON file so subscriptions survive
+# restarts. Chats in `default` are subscribed until they unsubscribe.
+class SubscriberRegistry:
+    def __init__(self, path: Path, default: list[int] = []) -> None:
+        self.path = Path(path)
+        self._lock = Lock()
+
+        if self.path.exists():
+            self._chats = list(json.loads(self.path.read_text()))
+        else:
+            self._chats = list(default)
+
+    def _save(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(self._chats))
+        tmp.replace(self.path)
+
+    def chats(self) -> list[int]:
+        with self._lock:
+            return list(self._chats)
+
+    def __contains__(self, chat: int) -> bool:
+        with self._lock:
+            return chat in self._chats
+
+    def subscribe(self, chat: int) -> bool:
+        with self._lock:
+            if chat in self._chats:
+                return False
+            self._chats.append(chat)
+            self._save()
+            return True
+
+    def unsubscribe(self, chat: int) -> bool:
+        with self._lock:
+            if chat not in self._chats:
+                return False
+            self._chats.remove(chat)
+            self._save()
+            return True
@@ -0,0 +1,126 @@
+from __future__ import annotations
+
+from hmac import compare_digest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Full, Queue
+from threading import Thread
+import json
+import logging
+
+from telebot import TeleBot, types
+
+import perf
+
+
+WEBHOOK_WORKERS = 2  # Threads running handlers
+MAX_QUEUED_UPDATES = 32  # Updates waiting for a worker before new ones are refused
+MAX_UPDATE_BYTES = 1024 * 1024
+RETRY_AFTER_S = 5  # Sent with 429 when the queue is full, Telegram redelivers later
+
+logger = logging.getLogger(__name__)
+
+
+# Receives Telegram updates over HTTP and dispatches them to the bot's
+# registered handlers from a bounded queue. Meant to sit behind a TLS
+# terminating reverse proxy, Telegram only delivers webhooks over HTTPS.
+class WebhookServer:
+    def __init__(
+        self,
+        bot: TeleBot,
+        secret_token: str,
+        host: str = "127.0.0.1",
+        port: int = 8080,
+        path: str = "/",
+        workers: int = WEBHOOK_WORKERS,
+        max_queued: int = MAX_QUEUED_UPDATES
+    ) -> None:
+        self.bot = bot
+        self.secret_token = secret_token
+        self.path = path
+        self.workers = workers
+        self.accepted = 0
+        self.rejected = 0
+
+        self._queue: Queue[types.Update | None] = Queue(max_queued)
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._threads: list[Thread] = []
+
+    @property
+    def address(self) -> tuple[str, int]:
+        return self._server.server_address[:2]
+
+    def _make_handler(self) -> type[BaseHTTPRequestHandler]:
+        webhook = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self) -> None:
+                status = webhook.receive(self)
+                self.send_response_only(status)
+                if status == 429:
+                    self.send_header("Retry-After", str(RETRY_AFTER_S))
+                self.end_headers()
+
+            def log_message(self, format, *args) -> None:
+                pass
+
+        return Handler
+
+    # HTTP status for one delivery, 2xx tells Telegram not to redeliver it
+    def receive(self, request: BaseHTTPRequestHandler) -> int:
+        if request.path != self.path:
+            return 404
+
+        secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not compare_digest(secret.encode(), self.secret_token.encode()):
+            return 403
+
+        # Anything malformed, from the length header to a body that is JSON
+        # but not an update object, is the sender's fault and gets a 400
+        try:
+            length = int(request.headers.get("Content-Length", 0))
+            if length > MAX_UPDATE_BYTES:
+                return 413
+            if length < 0:
+                raise ValueError(f"negative Content-Length {length}")
+            update = types.Update.de_json(json.loads(request.rfile.read(length)))
+            if update is None:
+                raise ValueError("empty update")
+        except Exception as e:
+            logger.warning(f"Bad update: {e}")
+            return 400
+
+        try:
+            self._queue.put_nowait(update)
+        except Full:
+            self.rejected += 1
+            perf.incr('webhook_rejected')
+            return 429
+
+        self.accepted += 1
+        perf.incr('webhook_updates')
+        return 200
+
+    def _work(self) -> None:
+        while (update := self._queue.get()) is not None:
+            try:
+                with perf.span('webhook.dispatch'):
+                    self.bot.process_new_updates([update])
+            except Exception as e:
+                logger.error(e)
+
+    def start(self) -> None:
+        for i in range(self.workers):
+            thread = Thread(name=f"webhook_worker_{i}", target=self._work, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+        Thread(name="webhook_http", target=self._server.serve_forever, daemon=True).start()
+
+    # Stop accepting updates, then let the workers finish the queued ones
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()